@@ -1,74 +1,278 @@
 #! /usr/bin/env python
 #
-# Wrapper launcher for the Java GCM server application used for bi-directional
-# comms between GCM and HowAlarming mobile apps.
+# Pushes alarm events to the HowAlarming mobile apps via Firebase Cloud
+# Messaging (formerly GCM).
 #
-# For more information and source code of the Java server, please see:
-# https://github.com/jethrocarr/howalarming-gcm
+# Events are sent to the devices listed in the configuration (registration
+# tokens from the apps) and/or a topic the apps subscribe to, through the FCM
+# HTTP v1 API. It authenticates with an OAuth2 token for a service account
+# (`service_account`, the path to it's JSON key from the Firebase console),
+# fetched and refreshed by the google-auth package, the legacy server key API
+# having been retired by Google.
+#
+# The v1 API takes one device per request, so each event's message is built
+# once and pushed to every device over a single kept-alive HTTPS connection.
+# Devices failing with a server error or rate limit are retried together with
+# exponential backoff (honouring Retry-After), and if still failing only they
+# are retried by the consumer later. Tokens the push service reports as no
+# longer registered or invalid are logged and not retried, remove them from
+# the configuration. Refused credentials are logged and the event dropped,
+# retrying can't help until the configuration is fixed.
+#
+# The original Java server (https://github.com/jethrocarr/howalarming-gcm)
+# also accepts commands from the apps, eg remote arm/disarm. It can still be
+# used with `gateway: java`, in which case this application only launches the
+# prebuilt JAR from resources/gcmserver with params from the YAML
+# configuration. It uses the legacy API with `api_key`, so may no longer be
+# able to deliver.
 #
 # Refer to the README for more information.
 #
 
+import startup     # must be first, times the imports that follow
 import os
-import socket
 import sys
-import time
-import datetime
-import string
-import re
-import signal
-import select
 import json
-import os
-import yaml         # requires pyyaml third party package
+import time
+import config
+import consumer
+import ratelimit
+
+
+PUSH_URL = 'https://fcm.googleapis.com/v1/projects/%s/messages:send'
+SCOPE = 'https://www.googleapis.com/auth/firebase.messaging'
+
+# Retries within a single delivery, before handing back to the consumer's
+# own (much slower) retry.
+RETRIES = 4
+BACKOFF = 0.5
+
+# Responses worth trying again, anything else means the device (or the
+# request) is bad.
+TRANSIENT = (429, 500, 502, 503, 504)
+UNAUTHORIZED = 401
+
+# Types the apps raise a visible, high priority notification for.
+URGENT = ('alarm', 'fault', 'recovery')
+
+# Types pushed unless `triggers` says otherwise, the same as the other sinks
+# are configured with. Keypad and info frames would be a notification each.
+DEFAULT_TRIGGERS = ['alarm', 'fault', 'recovery', 'armed', 'disarmed']
+
+
+def describe(target):
+    # Tokens are long and best kept out of the log in full.
+    if target.startswith('/topics/'):
+        return target
+    return 'device ' + target[:12] + '...'
+
+
+def error_status(response):
+    # The v1 API's reason for an error, eg UNREGISTERED.
+    try:
+        return str(response.json()['error']['status'])
+    except (ValueError, KeyError, TypeError):
+        return ''
+
+
+class Credentials:
+    # OAuth2 access tokens for the service account, refreshed as they
+    # expire.
+
+    def __init__(self, path, session):
+        from google.oauth2 import service_account   # requires google-auth third party package
+        import google.auth.transport.requests
+        self.credentials = service_account.Credentials.from_service_account_file(path, scopes=[SCOPE])
+        self.request = google.auth.transport.requests.Request(session)
+        self.project_id = self.credentials.project_id
+
+    def token(self):
+        if not self.credentials.valid:
+            self.credentials.refresh(self.request)
+        return self.credentials.token
+
+
+class Alerter:
+
+    def __init__(self, config):
+        # Libraries are imported once the sink is enabled rather than at
+        # module load, keeping startup fast when it isn't.
+        import requests
+        self.requests     = requests
+
+        # One session for the life of the sink, so every push after the
+        # first reuses the same TLS connection.
+        self.session      = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.credentials  = Credentials(config['service_account'], self.session)
+
+        # Push Settings
+        self.url          = config.get('url') or PUSH_URL % (config.get('project_id') or self.credentials.project_id)
+        self.devices      = config.get('devices', [])
+        self.topic        = config.get('topic')
+        self.triggers     = config.get('triggers', DEFAULT_TRIGGERS)
+        self.limiter      = ratelimit.Limiter(config.get('rate_limit'))
+
+        if not self.devices and not self.topic:
+            raise KeyError('alert_gcm needs devices and/or a topic to push to')
+
+
+    def message(self, alarm_event):
+        # The apps read the event from data (where every value must be a
+        # string), the notification is shown by the OS when the app isn't
+        # running.
+        urgent = alarm_event['type'] in URGENT
+        return {
+            'data':         dict((key, value if isinstance(value, basestring) else json.dumps(value)) for key, value in alarm_event.items()),
+            'notification': {
+                'title':        'HowAlarming ' + alarm_event['type'],
+                'body':         alarm_event.get('message', ''),
+                },
+            'android':      {'priority': 'HIGH' if urgent else 'NORMAL'},
+            'apns':         {'headers': {'apns-priority': '10' if urgent else '5'}},
+            }
+
+
+    def push(self, message, target):
+        # Returns (pushed, retry_after), pushed is None when the request
+        # failed in a way worth retrying.
+        request = dict(message)
+        if target.startswith('/topics/'):
+            request['topic'] = target[len('/topics/'):]
+        else:
+            request['token'] = target
+
+        try:
+            response = self.session.post(self.url, data=json.dumps({'message': request}), timeout=10,
+                                         headers={'Authorization': 'Bearer ' + self.credentials.token()})
+        except self.requests.RequestException as err:
+            consumer.log('Warning: push request failed: ' + str(err))
+            return None, None
+
+        if response.status_code == 200:
+            return True, None
+
+        if response.status_code == UNAUTHORIZED:
+            # Every push would be refused the same.
+            raise consumer.Rejected('push service refused the credentials with HTTP ' + str(response.status_code))
+
+        if response.status_code not in TRANSIENT:
+            # Unregistered (404) or invalid (400) token, no point retrying.
+            consumer.log('Warning: push to ' + describe(target) + ' rejected with HTTP ' + str(response.status_code) + ' ' + error_status(response) + ', remove it from the configuration')
+            return False, None
+
+        consumer.log('Warning: push service returned HTTP ' + str(response.status_code))
+        try:
+            return None, float(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None, None
+
+
+    def send(self, message, targets):
+        # Push to each target (a device, or /topics/<name>), retrying those
+        # that fail transiently together. Returns the targets still failing.
+        delay = BACKOFF
+        for attempt in range(RETRIES + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+
+            retry = []
+            for target in targets:
+                pushed, retry_after = self.push(message, target)
+                if pushed is None:
+                    retry.append(target)
+                    if retry_after:
+                        delay = max(delay, retry_after)
+            if not retry:
+                return []
+            targets = retry
+
+        return targets
+
+
+    def targets(self):
+        targets = list(self.devices)
+        if self.topic:
+            targets.append('/topics/' + self.topic)
+        return targets
+
+
+    def handle(self, alarm_event, body):
+        consumer.log("Recieved alert suitable for pushing to mobile apps")
+        consumer.log(body)
+        self.deliver(alarm_event, self.targets())
+
+
+    def retry(self, alarm_event, body, destinations=None):
+        # Just the devices that failed last time, if known, so the others
+        # don't get the notification twice.
+        targets = self.targets()
+        if destinations is not None:
+            targets = [target for target in targets if target in destinations]
+        consumer.log("Retrying push to " + str(len(targets)) + " device(s)")
+        self.deliver(alarm_event, targets)
+
 
-# Unbuffered Logging
-sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+    def deliver(self, alarm_event, targets):
+        failed = self.send(self.message(alarm_event), targets)
+        if failed:
+            raise consumer.DeliveryError('unable to push to ' + ', '.join(describe(target) for target in failed), failed)
+        consumer.log("... successful")
 
 
-# Load configuration from YAML file and assign configuration values.
-try:
-    config         = yaml.load(open('config.yaml', 'r'))
+def java(settings):
+    # Launch the Java server, which talks to beanstalkd itself.
+    try:
+        # Beanstalkd Message Queue settings
+        beanstalk_host             = settings['beanstalkd']['host']
+        beanstalk_port             = settings['beanstalkd']['port']
 
-    # Beanstalkd Message Queue settings
-    beanstalk_host             = config['beanstalkd']['host']
-    beanstalk_port             = int(config['beanstalkd']['port'])
-    beanstalk_tubes_commands   = config['beanstalkd']['tubes']['commands']
-    beanstalk_tubes_events     = config['beanstalkd']['tubes']['events']
+        # GCM
+        gcm_api_key                = settings['alert_gcm']['api_key']
+        gcm_sender_id              = settings['alert_gcm'].get('sender_id')
 
-    # GCM
-    gcm_api_key                = config['alert_gcm']['api_key']
-    gcm_sender_id              = config['alert_gcm']['sender_id']
+    except (KeyError, AttributeError) as err:
+        print 'Fatal: Unable to find required configuration in config.yaml'
+        raise
 
-    # Make sure the queue we listen to exists
-    if 'alert_gcm' not in config['beanstalkd']['tubes']['events']:
-	print "Fatal: Config must define the alert_gcm event queue for this application."
-	raise BaseException
+    if not gcm_sender_id:
+        print 'Fatal: The Java server requires alert_gcm.sender_id'
+        raise BaseException
 
-except IOError:
-    print 'Fatal: Could not open configuration file'
-    raise
+    # The Java application runs using environmentals for it's configuration, so we
+    # take the config we've loaded in via YAML and set appropiate environmentals.
 
-except (KeyError, AttributeError) as err:
-    print 'Fatal: Unable to find required configuration in config.yaml'
-    raise
+    os.environ["GCM_SENDER_ID"]             = str(gcm_sender_id)
+    os.environ["GCM_API_KEY"]               = str(gcm_api_key)
+    os.environ["BEANSTALK_HOST"]            = str(beanstalk_host)
+    os.environ["BEANSTALK_PORT"]            = str(beanstalk_port)
+    os.environ["BEANSTALK_TUBES_EVENTS"]    = "alert_gcm"
+    os.environ["BEANSTALK_TUBES_COMMANDS"]  = "commands" # TODO: Nasty hard coding for prototype phase
 
+    print "!!!!!!!"
+    print "WARNING: EXPERIMENTAL JAVA SERVER, BUGGY AND HARDCODING AWAITS"
+    print "!!!!!!!"
 
-# The Java application runs using environmentals for it's configuration, so we
-# take the config we've loaded in via YAML and set appropiate environmentals.
 
-os.environ["GCM_SENDER_ID"]		= str(gcm_sender_id)
-os.environ["GCM_API_KEY"]		= str(gcm_api_key)
-os.environ["BEANSTALK_HOST"]		= str(beanstalk_host)
-os.environ["BEANSTALK_PORT"]		= str(beanstalk_port)
-os.environ["BEANSTALK_TUBES_EVENTS"]	= "alert_gcm"
-os.environ["BEANSTALK_TUBES_COMMANDS"]	= "commands" # TODO: Nasty hard coding for prototype phase
+    # Run the application in foreground until it terminates.
+    os.system("java -jar resources/gcmserver/HowAlarmingServer-all-latest.jar")
 
-print "!!!!!!!"
-print "WARNING: EXPERIMENTAL JAVA SERVER, BUGGY AND HARDCODING AWAITS"
-print "!!!!!!!"
 
 
-# Run the application in foreground until it terminates.
-os.system("java -jar resources/gcmserver/HowAlarmingServer-all-latest.jar")
+if __name__ == '__main__':
+    try:
+        settings = config.load()
+    except IOError:
+        print 'Fatal: Could not open configuration file'
+        raise
+    except config.ConfigError as err:
+        print 'Fatal: Invalid configuration, ' + str(err)
+        raise
 
+    if (settings.get('alert_gcm') or {}).get('gateway') == 'java':
+        # Unbuffered Logging
+        sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+        java(settings)
+    else:
+        consumer.run('alert_gcm', Alerter, 'system: pushing alerts to the mobile apps')
@@ -7,169 +7,291 @@
 # 'armed' and 'disarmed' events for testing, but once setup, probably only want
 # alerts for 'alarm', 'recovery' and 'fault'
 #
+# Plivo fetches what to say from the call's answer URL once it's answered. By
+# default that's one of the generic messages under resources/plivo, fetched
+# from GitHub. With `answer_url` set (the address Plivo can reach this host
+# at), the answer XML is served from here on `answer_port` instead, rendered
+# once per event with the event's message (zone names and all) and cached
+# by event id, so an answered call doesn't wait on GitHub and says what
+# actually happened. It listens on every interface unless `answer_bind` gives
+# the address of the one Plivo reaches it through.
+#
+# When only some calls fail, only those numbers are called again on retry.
+#
+# Calls are placed through a circuit breaker on the Plivo API (see breaker.py,
+# settings under `breaker`), so while it's unreachable events fail straight
+# away rather than each waiting on it.
+#
 
-import os
-import socket
-import sys
+import startup     # must be first, times the imports that follow
 import time
-import datetime
-import string
-import re
-import signal
-import select
-import smtplib
-import email.utils
-import json
-import yaml         # requires pyyaml third party package
-import beanstalkc   # requires beanstalkc third party package
-
-import plivo        # required third party package
-
-# Unbuffered Logging
-sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
-
-class HowAlarming:
-
-    def __init__(self):
-        # Load configuration from YAML file and assign configuration values.
-        try:
-            self.config         = yaml.load(open('config.yaml', 'r'))
-
-            # Beanstalkd Message Queue settings
-            self.beanstalk_host             = self.config['beanstalkd']['host']
-            self.beanstalk_port             = int(self.config['beanstalkd']['port'])
-            self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
-            self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
-
-            # Plivo Settings
-            self.auth_id      = self.config['alert_plivo']['auth_id']
-            self.auth_token   = self.config['alert_plivo']['auth_token']
-            self.call_from    = self.config['alert_plivo']['call_from']
-            self.call_to      = self.config['alert_plivo']['call_to']
-            self.triggers     = self.config['alert_plivo']['triggers']
-
-            # Make sure the queue we listen to exists
-            if 'alert_plivo' not in self.config['beanstalkd']['tubes']['events']:
-                print "Fatal: Config must define the alert_plivo event queue for this application."
-                raise BaseException
-
-        except IOError:
-            print 'Fatal: Could not open configuration file'
-            raise
-
-        except (KeyError, AttributeError) as err:
-            print 'Fatal: Unable to find required configuration in config.yaml'
-            raise
-
-
-    def beanstalk_connect(self):
-        try:
-            self.beanstalk = beanstalkc.Connection(host=self.beanstalk_host, port=self.beanstalk_port)
-            print 'system: Beanstalkd connected on ' + str(self.beanstalk_host) + ' on port ' + str(self.beanstalk_port)
-        except socket.error, (value,message):
-            print "Fatal: Unable to connect to beanstalkd"
-            raise
-
-
-    def beanstalk_poll(self):
-        # Poll for any commands in the event tube for Plivo
-
-        self.beanstalk.watch('alert_plivo')
-        job = self.beanstalk.reserve() # blocking call
-
-        if job:
-            # Event recieved, is it on the list of types we care about?
+import threading
+import collections
+from xml.sax.saxutils import escape
+import breaker
+import consumer
+import ratelimit
+
+
+DEFAULT_ANSWER_PORT = 8088
+
+# Events kept rendered, far more than will ever be ringing at once.
+ANSWER_CACHE = 256
+
+# Spoken ahead of the event's message.
+SPEAK = {
+    'alarm':    'Alarm! Alarm! How alarming is in an alarm condition.',
+    'recovery': 'How alarming has recovered.',
+    'fault':    'How alarming has detected a fault.',
+    }
+SPEAK_DEFAULT = 'A how alarming event has occured.'
+
+
+def render(alarm_event):
+    # Answer XML for the event.
+    speak = SPEAK.get(alarm_event.get('type'), SPEAK_DEFAULT)
+    message = alarm_event.get('message')
+    if message:
+        speak += ' ' + message + '.'
+    if isinstance(speak, unicode):
+        speak = speak.encode('utf-8')
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<Response>\n    <Speak>' + escape(speak) + '</Speak>\n</Response>\n'
+
+
+def answer_server_class():
+    # The answer server is only defined (and it's libraries imported) once
+    # answers are served locally, keeping startup fast when they aren't.
+    import hashlib
+    import BaseHTTPServer
+    import SocketServer
+
+    class AnswerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            # /answer/<event id>.xml, anything else (or an event long gone
+            # from the cache) gets the generic message rather than a silent
+            # call.
+            path = self.path.split('?', 1)[0]
+            body = None
+            if path.startswith('/answer/') and path.endswith('.xml'):
+                body = self.server.lookup(path[len('/answer/'):-len('.xml')])
+            if body is None:
+                body = self.server.generic
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Plivo can be told to use either.
+        do_POST = do_GET
+
+        def log_message(self, format, *args):
+            pass
+
+    class AnswerServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        request_queue_size = 128
+
+        def __init__(self, address):
+            BaseHTTPServer.HTTPServer.__init__(self, address, AnswerHandler)
+            self.lock = threading.Lock()
+            self.cache = collections.OrderedDict()
+            self.generic = render({})
+
+        def add(self, alarm_event, body):
+            # Render the event's answer XML unless it already has been (eg on
+            # a retry), returning it's id.
+            eid = hashlib.sha1(body).hexdigest()[:16]
+            self.lock.acquire()
             try:
-                alarm_event = json.loads(job.body)
-
-                if alarm_event['type'] in self.triggers:
-                    print "Recieved alert suitable for sending to plivo, triggering call for each destination number configured..."
-                    print job.body
-
-                    # Dial each number configured via Plivo service
-                    for phone in self.call_to:
-
-                        # Generic messages to play back to Plivo when conditions occur. Github
-                        # probably isn't the greatest place to host this, but it's also probably
-                        # not the worst either given the high awareness of API changes and any
-                        # breakages. There's no way to have Plivo play a message without doing
-                        # a callback either. :-(
-                        message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/event.xml'
-
-                        if alarm_event['type'] == 'alarm':
-                            message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/alarm.xml'
-
-                        if alarm_event['type'] == 'recovery':
-                            message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/recovery.xml'
-
-                        if alarm_event['type'] == 'fault':
-                            message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/fault.xml'
-
-
-                        # Place call via the Plivo service.
-                        try:
-                            p = plivo.RestAPI(self.auth_id, self.auth_token)
-
-                            params = {
-                                'to':            phone,
-                                'from':          self.call_from,
-                                'caller_name':   'HowAlarming',
-                                'answer_url':    message_url,
-                                'answer_method': 'GET',
-                                }
-
-                            response = p.make_call(params)
-
-                            if response[0] != 201:
-                                print "Warning: A caller infrastructure error occured when attempting to call " + str(phone) +"."
-                        except:
-                            print "Warning: An unexpected fault occured when attempting to call " + str(phone) +"."
-
-
-                    # We don't know the call ID (not returned via the API
-                    # for some annoying reason) so we need to check what
-                    # calls are active. This assumes your Plivo account isn't
-                    # used a whole heap... PRs for better solution welcome.
-
-                    active = True
-
-                    while active:
-
-                        try:
-                            response = p.get_live_calls()
-
-                            if len(response[1]["calls"]) >= 1:
-                                print "Info: Waiting for calls to complete..."
-                                time.sleep(1)
-                            else:
-                                print "Info: No calls remaining, proceeding to next message(s)."
-                                active = False
+                if eid not in self.cache:
+                    self.cache[eid] = render(alarm_event)
+                    if len(self.cache) > ANSWER_CACHE:
+                        self.cache.popitem(last=False)
+            finally:
+                self.lock.release()
+            return eid
+
+        def lookup(self, eid):
+            self.lock.acquire()
+            try:
+                return self.cache.get(eid)
+            finally:
+                self.lock.release()
+
+    return AnswerServer
+
+
+answer_server = None
+answer_lock = threading.Lock()
+
+
+def serve_answers(port, host=''):
+    # The one answer server, started on first use. Alerters are built again
+    # on reload and share it, changes to the port or address apply on
+    # restart.
+    global answer_server
+    answer_lock.acquire()
+    try:
+        if answer_server is None:
+            answer_server = answer_server_class()((host, port))
+            thread = threading.Thread(target=answer_server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        return answer_server
+    finally:
+        answer_lock.release()
+
+
+class Alerter:
+
+    def __init__(self, config):
+        # Libraries are imported once the sink is enabled rather than at
+        # module load, keeping startup fast when it isn't.
+        import plivo    # required third party package
+        self.plivo        = plivo
+
+        # Plivo Settings
+        self.auth_id      = config['auth_id']
+        self.auth_token   = config['auth_token']
+        self.call_from    = config['call_from']
+        self.call_to      = config['call_to']
+        self.triggers     = config['triggers']
+        self.limiter      = ratelimit.Limiter(config.get('rate_limit'))
+        self.api_url      = config.get('api_url')
+        self.breaker      = breaker.get('alert_plivo', self.api_url or 'api.plivo.com', config.get('breaker'))
+
+        # Answer XML served locally
+        self.answer_url   = config.get('answer_url')
+        self.answers      = None
+        if self.answer_url:
+            self.answers = serve_answers(config.get('answer_port', DEFAULT_ANSWER_PORT), config.get('answer_bind', ''))
+
+
+    def handle(self, alarm_event, body):
+        consumer.log("Recieved alert suitable for sending to plivo, triggering call for each destination number configured...")
+        consumer.log(body)
+        self.dial(alarm_event, body, True, self.call_to)
+
+
+    def retry(self, alarm_event, body, destinations=None):
+        # Just the numbers that failed last time, if known, so the others
+        # aren't called again. Each was admitted by it's limiter on the first
+        # attempt, a retry mustn't be suppressed now or the alarm is lost.
+        numbers = self.call_to
+        if destinations is not None:
+            numbers = [phone for phone in self.call_to if str(phone) in destinations]
+        consumer.log("Retrying calls to " + ', '.join(str(phone) for phone in numbers) + "...")
+        self.dial(alarm_event, body, False, numbers)
+
+
+    def dial(self, alarm_event, body, limit, numbers):
+        if self.api_url:
+            p = self.plivo.RestAPI(self.auth_id, self.auth_token, url=self.api_url)
+        else:
+            p = self.plivo.RestAPI(self.auth_id, self.auth_token)
+        failed = []
+
+        # Generic messages to play back to Plivo when conditions occur. Github
+        # probably isn't the greatest place to host this, but it's also probably
+        # not the worst either given the high awareness of API changes and any
+        # breakages. There's no way to have Plivo play a message without doing
+        # a callback either. :-(
+        message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/event.xml'
+
+        if alarm_event['type'] == 'alarm':
+            message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/alarm.xml'
+
+        if alarm_event['type'] == 'recovery':
+            message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/recovery.xml'
+
+        if alarm_event['type'] == 'fault':
+            message_url = 'https://raw.githubusercontent.com/jethrocarr/howalarming/master/resources/plivo/fault.xml'
+
+        if self.answers:
+            message_url = self.answer_url.rstrip('/') + '/answer/' + self.answers.add(alarm_event, body) + '.xml'
+
+        # Dial each number configured via Plivo service
+        placed = 0
+        for phone in numbers:
+
+            # Limit calls to each number on it's own too, so a storm doesn't
+            # keep one phone ringing.
+            suppressed = self.limiter.admit(alarm_event, phone) if limit else 0
+            if suppressed is None:
+                consumer.log("Rate limited, not calling " + str(phone) + ".")
+                continue
+            if suppressed:
+                consumer.log("Info: Calling " + str(phone) + ", " + str(suppressed) + " more event(s) suppressed since the last call.")
+
+            if not self.breaker.allow():
+                consumer.log("Warning: Plivo is failing, not calling " + str(phone) + ", trying it again in " + str(self.breaker.retry_in()) + "s.")
+                failed.append(str(phone))
+                continue
+
+            # Place call via the Plivo service. Only faults reaching Plivo
+            # count against it's breaker, not it refusing a call.
+            reached = False
+            try:
+                params = {
+                    'to':            phone,
+                    'from':          self.call_from,
+                    'caller_name':   'HowAlarming',
+                    'answer_url':    message_url,
+                    'answer_method': 'GET',
+                    }
+
+                response = p.make_call(params)
+                reached = response[0] < 500
+
+                if response[0] != 201:
+                    consumer.log("Warning: A caller infrastructure error occured when attempting to call " + str(phone) +".")
+                    failed.append(str(phone))
+                else:
+                    placed += 1
+                    self.limiter.reported(suppressed, phone)
+            except Exception:
+                consumer.log("Warning: An unexpected fault occured when attempting to call " + str(phone) +".")
+                failed.append(str(phone))
+            finally:
+                state = self.breaker.record(reached)
+                if state == breaker.OPEN:
+                    consumer.log("Warning: Plivo has failed " + str(self.breaker.failures) + " time(s) in a row, not calling for " + str(int(self.breaker.reset)) + "s.")
+                elif state == breaker.CLOSED:
+                    consumer.log("Info: Plivo has recovered.")
+
+
+        # We don't know the call ID (not returned via the API
+        # for some annoying reason) so we need to check what
+        # calls are active. This assumes your Plivo account isn't
+        # used a whole heap... PRs for better solution welcome.
+        #
+        # The consumer runtime keeps the job alive whilst we wait.
+
+        active = placed > 0
+
+        while active:
 
-                        except:
-                            print "Warning: An unexpected fault occured whilst querying call status..."
-                            active = True
+            try:
+                response = p.get_live_calls()
 
+                if len(response[1]["calls"]) >= 1:
+                    consumer.log("Info: Waiting for calls to complete...")
+                    time.sleep(1)
                 else:
-                    print 'Non-alerting event, ignoring (type: '+ alarm_event['type'] +')'
+                    consumer.log("Info: No calls remaining, proceeding to next message(s).")
+                    active = False
 
-            except KeyError:
-                print "Warning: Unable to process message, invalid JSON: ", job.body
+            except Exception:
+                consumer.log("Warning: An unexpected fault occured whilst querying call status...")
+                time.sleep(1)
 
-            job.delete()
-        return
+        if failed:
+            raise consumer.DeliveryError('unable to call ' + ', '.join(failed), failed)
 
 
 
 if __name__ == '__main__':
-        try:
-            c = HowAlarming()
-            c.beanstalk_connect()
-
-            print 'system: ready to robodial with a vengance!'
-            while(True):
-                c.beanstalk_poll()
-
-        except KeyboardInterrupt:
-            print 'system: User Terminated'
-        except socket.error, err:
-            print 'system: socket error ' + str(err[0])
+    consumer.run('alert_plivo', Alerter, 'system: ready to robodial with a vengance!')
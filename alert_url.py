@@ -7,119 +7,275 @@
 # 'armed' and 'disarmed' events for testing, but once setup, probably only want
 # alerts for 'alarm', 'recovery' and 'fault'
 #
+# By default each URL is hit with a GET of the URL with the event type
+# appended. With `method: post` the event is POSTed as JSON instead, either
+# as-is or rendered from `template`, where $type, $code, $message, $raw and
+# $timestamp are replaced with the event's values encoded as JSON (so don't
+# quote them), eg:
+#
+#   template: '{"text": $message, "kind": $type}'
+#
+# Adding a `batch` block collects the events arriving within `max_latency`
+# seconds, up to `max_size` of them, into a single JSON array POSTed to each
+# URL. Each event is only acknowledged once it's batch has been accepted, so
+# the consumer needs enough `workers` to hold a full batch in flight. With a
+# single worker batching is turned off, each event would only wait out
+# `max_latency` on it's own.
+#
+# When only some URLs fail, only those are retried, the others aren't sent
+# the event again.
+#
+# Each URL has a circuit breaker (see breaker.py, settings under `breaker`),
+# so once a URL has failed repeatedly it's skipped straight away rather than
+# costing a timeout every event, and only tried again now and then until it
+# recovers.
+#
 
-import os
-import socket
-import sys
-import time
-import datetime
-import string
-import re
-import signal
-import select
+import startup     # must be first, times the imports that follow
 import json
-import requests
-import yaml         # requires pyyaml third party package
-import beanstalkc   # requires beanstalkc third party package
+import string
+import threading
+import breaker
+import consumer
+import ratelimit
 
 
-# Unbuffered Logging
-sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+BATCH_DEFAULTS = {
+    'max_size':     50,
+    'max_latency':  2.0,
+    }
 
-class HowAlarming:
+FIELDS = ('type', 'code', 'message', 'raw', 'timestamp')
 
-    def __init__(self):
-        # Load configuration from YAML file and assign configuration values.
-        try:
-            self.config         = yaml.load(open('config.yaml', 'r'))
 
-            # Beanstalkd Message Queue settings
-            self.beanstalk_host             = self.config['beanstalkd']['host']
-            self.beanstalk_port             = int(self.config['beanstalkd']['port'])
-            self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
-            self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
+class Batcher:
+    # Collects payloads for one URL, sending them as a single array once
+    # max_size is reached or max_latency has passed since the first arrived.
 
-            # url Settings
-            self.urls         = self.config['alert_url']['urls']
-            self.triggers     = self.config['alert_url']['triggers']
+    def __init__(self, alerter, url, max_size, max_latency):
+        self.alerter = alerter
+        self.url = url
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
 
-            # Make sure the queue we listen to exists
-            if 'alert_url' not in self.config['beanstalkd']['tubes']['events']:
-                print "Fatal: Config must define the alert_url event queue for this application."
-                raise BaseException
+    def submit(self, payload):
+        # Blocks until the batch holding payload has been sent, returning
+        # whether it was accepted.
+        slot = {'payload': payload, 'done': threading.Event(), 'ok': False}
 
-        except IOError:
-            print 'Fatal: Could not open configuration file'
-            raise
+        self.lock.acquire()
+        try:
+            self.pending.append(slot)
+            if len(self.pending) >= self.max_size:
+                batch = self.take()
+            else:
+                batch = None
+                if self.timer is None:
+                    self.timer = threading.Timer(self.max_latency, self.expire)
+                    self.timer.daemon = True
+                    self.timer.start()
+        finally:
+            self.lock.release()
 
-        except (KeyError, AttributeError) as err:
-            print 'Fatal: Unable to find required configuration in config.yaml'
-            raise
+        if batch:
+            self.send(batch)
+        slot['done'].wait()
+        return slot['ok']
 
+    def take(self):
+        # Must hold lock.
+        batch = self.pending
+        self.pending = []
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return batch
 
-    def beanstalk_connect(self):
+    def expire(self):
+        self.lock.acquire()
         try:
-            self.beanstalk = beanstalkc.Connection(host=self.beanstalk_host, port=self.beanstalk_port)
-            print 'system: Beanstalkd connected on ' + str(self.beanstalk_host) + ' on port ' + str(self.beanstalk_port)
-        except socket.error, (value,message):
-            print "Fatal: Unable to connect to beanstalkd"
-            raise
+            batch = self.take()
+        finally:
+            self.lock.release()
 
+        if batch:
+            self.send(batch)
 
-    def beanstalk_poll(self):
-        # Poll for any commands in the event tube for url
+    def send(self, batch):
+        ok = False
+        try:
+            ok = self.alerter.attempt(self.url, self.alerter.post, self.url, '[' + ','.join(slot['payload'] for slot in batch) + ']')
+        finally:
+            for slot in batch:
+                slot['ok'] = ok
+                slot['done'].set()
 
-        self.beanstalk.watch('alert_url')
-        job = self.beanstalk.reserve() # blocking call
 
-        if job:
-            # Event recieved, is it on the list of types we care about?
-            try:
-                alarm_event = json.loads(job.body)
+class Alerter:
 
-                if alarm_event['type'] in self.triggers:
-                    print "Recieved alert suitable for sending to url, triggering call for each configured URL"
-                    print job.body
+    def __init__(self, config):
+        # Libraries are imported once the sink is enabled rather than at
+        # module load, keeping startup fast when it isn't.
+        import requests
+        self.requests     = requests
 
-                    # Dial each number configured via url service
-                    for url in self.urls:
+        # One session so connections to the endpoints are kept alive.
+        self.session      = requests.Session()
 
-                        # Assemble the URL to HTTP GET
-                        url = url + alarm_event['type']
-                        print "Hitting URL "+ url
+        # url Settings
+        self.urls         = config['urls']
+        self.triggers     = config['triggers']
+        self.limiter      = ratelimit.Limiter(config.get('rate_limit'))
+        self.method       = config.get('method', 'get')
+        self.template     = None
+        if config.get('template'):
+            self.template = string.Template(config['template'])
 
-                        # Send a GET request to the URL.
-                        try:
-                            request = requests.get(url, timeout=5)
+        self.breakers     = dict((url, breaker.get('alert_url', url, config.get('breaker'))) for url in self.urls)
 
-                            if request.status_code != 200:
-                                print "Warning: An HTTP response code of "+ request.status_code +" was recieved"
-                            else:
-                                print "... successful"
-                        except:
-                            print "Warning: An unexpected fault occured when attempting to hit URL: "+ url
+        self.batchers     = None
+        if 'batch' in config:
+            settings = dict(BATCH_DEFAULTS)
+            settings.update(config['batch'])
+            self.batchers = dict((url, Batcher(self, url, settings['max_size'], settings['max_latency'])) for url in self.urls)
 
-                else:
-                    print 'Non-alerting event, ignoring (type: '+ alarm_event['type'] +')'
 
-            except KeyError:
-                print "Warning: Unable to process message, invalid JSON: ", job.body
+    def concurrency(self, workers):
+        # A batch is filled by events delivered side by side, with a single
+        # worker each event would wait out max_latency on it's own.
+        if self.batchers and workers < 2:
+            consumer.log("Warning: alert_url batching needs the consumer's workers raised, sending events one at a time")
+            self.batchers = None
 
-            job.delete()
-        return
 
+    def render(self, alarm_event):
+        if self.template is None:
+            return json.dumps(alarm_event)
+        return self.template.safe_substitute(dict((field, json.dumps(alarm_event.get(field))) for field in FIELDS))
 
 
-if __name__ == '__main__':
+    def attempt(self, url, send, *args):
+        # send(*args) through url's breaker, failing fast whilst it's open.
+        endpoint = self.breakers[url]
+        if not endpoint.allow():
+            consumer.log("Warning: URL " + url + " is failing, not trying it again for " + str(endpoint.retry_in()) + "s")
+            return False
+
+        ok = False
+        try:
+            ok = send(*args)
+        finally:
+            state = endpoint.record(ok)
+            if state == breaker.OPEN:
+                consumer.log("Warning: URL " + url + " has failed " + str(endpoint.failures) + " time(s) in a row, skipping it for " + str(int(endpoint.reset)) + "s")
+            elif state == breaker.CLOSED:
+                consumer.log("Info: URL " + url + " has recovered")
+        return ok
+
+
+    def post(self, url, payload):
+        consumer.log("Posting to URL "+ url)
+        try:
+            request = self.session.post(url, data=payload, headers={'Content-Type': 'application/json'}, timeout=5)
+
+            if request.status_code not in (200, 201, 202, 204):
+                consumer.log("Warning: An HTTP response code of "+ str(request.status_code) +" was recieved")
+                return False
+            consumer.log("... successful")
+            return True
+        except self.requests.RequestException:
+            consumer.log("Warning: An unexpected fault occured when attempting to hit URL: "+ url)
+            return False
+
+
+    def get(self, url):
+        consumer.log("Hitting URL "+ url)
+
+        # Send a GET request to the URL.
         try:
-            c = HowAlarming()
-            c.beanstalk_connect()
+            request = self.session.get(url, timeout=5)
+
+            if request.status_code != 200:
+                consumer.log("Warning: An HTTP response code of "+ str(request.status_code) +" was recieved")
+                return False
+            consumer.log("... successful")
+            return True
+        except self.requests.RequestException:
+            consumer.log("Warning: An unexpected fault occured when attempting to hit URL: "+ url)
+            return False
+
+
+    def handle(self, alarm_event, body):
+        consumer.log("Recieved alert suitable for sending to url, triggering call for each configured URL")
+        consumer.log(body)
+        self.deliver(alarm_event, body, True, self.urls)
+
+
+    def retry(self, alarm_event, body, destinations=None):
+        # Just the URLs that failed last time, if known. Each was admitted by
+        # it's limiter on the first attempt, a retry mustn't be suppressed
+        # now or the event is lost.
+        urls = self.urls
+        if destinations is not None:
+            urls = [url for url in self.urls if url in destinations]
+        consumer.log("Retrying alert to " + ', '.join(urls))
+        self.deliver(alarm_event, body, False, urls)
+
+
+    def admit(self, alarm_event, url, limit):
+        # Events suppressed since the last to reach url, None if this one
+        # should be too.
+        if not limit:
+            return 0
+        return self.limiter.admit(alarm_event, url)
+
 
-            print 'system: url curl\'n at the ready capt\'n'
-            while(True):
-                c.beanstalk_poll()
+    def deliver(self, alarm_event, body, limit, urls):
+        failed = []
 
-        except KeyboardInterrupt:
-            print 'system: User Terminated'
-        except socket.error, err:
-            print 'system: socket error ' + str(err[0])
+        if self.method == 'get':
+            # Hit each URL configured, with the event type appended
+            for url in urls:
+                suppressed = self.admit(alarm_event, url, limit)
+                if suppressed is None:
+                    consumer.log("Rate limited, not hitting URL "+ url)
+                elif not self.attempt(url, self.get, url + alarm_event['type']):
+                    failed.append(url)
+                else:
+                    self.limiter.reported(suppressed, url)
+
+        elif self.batchers:
+            # Each URL's batch is sent independently, wait on them together.
+            # Batching already turns a burst into one request, so there's no
+            # limit per URL.
+            payload = self.render(alarm_event)
+            results = {}
+            threads = []
+            for url in urls:
+                thread = threading.Thread(target=lambda url=url: results.__setitem__(url, self.batchers[url].submit(payload)))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            failed = [url for url in urls if not results.get(url)]
+
+        else:
+            for url in urls:
+                suppressed = self.admit(alarm_event, url, limit)
+                if suppressed is None:
+                    consumer.log("Rate limited, not posting to URL "+ url)
+                elif not self.attempt(url, self.post, url, self.render(ratelimit.annotate(alarm_event, suppressed))):
+                    failed.append(url)
+                else:
+                    self.limiter.reported(suppressed, url)
+
+        if failed:
+            raise consumer.DeliveryError('unable to hit ' + ', '.join(failed), failed)
+
+
+
+if __name__ == '__main__':
+    consumer.run('alert_url', Alerter, 'system: url curl\'n at the ready capt\'n')
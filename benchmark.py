@@ -0,0 +1,902 @@
+#! /usr/bin/env python
+#
+# Benchmarks for the HowAlarming components, run against the beanstalkd
+# instance from config.yaml using scratch tubes (prefixed "benchmark_") so they
+# don't interfere with a running system. Intended for comparing performance
+# between changes, run on the target hardware for meaningful numbers.
+#
+# Usage: ./benchmark.py <benchmark>
+#
+
+import os
+import sys
+import time
+import json
+import select
+import signal
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+import config
+import httplib
+import urllib2
+import urlparse
+import priority
+import query
+import rules
+import statemap
+import tail
+import transport
+from xml.sax.saxutils import escape
+import beanstalkc   # requires beanstalkc third party package
+
+
+def beanstalk_connect(settings):
+    return beanstalkc.Connection(host=settings['beanstalkd']['host'], port=settings['beanstalkd']['port'])
+
+
+def drain(beanstalk, tube):
+    beanstalk.watch(tube)
+    beanstalk.ignore('default')
+    while True:
+        job = beanstalk.reserve(timeout=0)
+        if not job:
+            break
+        job.delete()
+
+
+def bench_priority(settings):
+    # Time taken for a consumer to receive an alarm queued behind a growing
+    # backlog of info events, with and without the priority policy. With
+    # priorities the alarm should stay the first job reserved regardless of
+    # backlog size.
+    tube = 'benchmark_priority'
+    beanstalk = beanstalk_connect(settings)
+    beanstalk.use(tube)
+    drain(beanstalk, tube)
+
+    policies = (('none', priority.Policy({'types': dict((t, priority.DEFAULT_PRIORITY) for t in priority.DEFAULT_TYPES)})),
+                ('priorities', priority.Policy(settings.get('priorities'))))
+
+    info = {'type': 'info', 'code': '609', 'message': 'zone Study PIR open', 'raw': '609001', 'timestamp': int(time.time())}
+    alarm = {'type': 'alarm', 'code': '621', 'message': 'fire key alarm detected', 'raw': '621', 'timestamp': int(time.time())}
+
+    print '%-12s %8s %10s %14s' % ('policy', 'backlog', 'position', 'latency (ms)')
+
+    for name, policy in policies:
+        for backlog in (0, 10, 100, 1000, 10000):
+            body = json.dumps(info)
+            for i in range(backlog):
+                beanstalk.put(body, priority=policy.priority(info))
+
+            begin = time.time()
+            beanstalk.put(json.dumps(alarm), priority=policy.priority(alarm))
+
+            position = 0
+            while True:
+                position += 1
+                job = beanstalk.reserve()
+                job.delete()
+                if json.loads(job.body)['type'] == 'alarm':
+                    break
+            latency = time.time() - begin
+
+            drain(beanstalk, tube)
+            print '%-12s %8d %10d %14.2f' % (name, backlog, position, latency * 1000)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_transport(settings):
+    # Latency from an event being put to a consumer on another thread having
+    # it, for each transport. The unix transport uses a broker on a scratch
+    # socket, beanstalk is skipped if beanstalkd isn't reachable.
+    count = 2000
+    tube = 'benchmark_transport'
+    event = {'type': 'info', 'code': '609', 'message': 'zone Study PIR open', 'raw': '609001', 'timestamp': int(time.time())}
+
+    import broker
+    path = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    server = broker.serve(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    print '%-12s %10s %10s %10s %10s %12s' % ('transport', 'mean (us)', 'p50 (us)', 'p95 (us)', 'p99 (us)', 'events/s')
+
+    for backend in ('inprocess', 'unix', 'beanstalk'):
+        scratch = dict(settings.data)
+        scratch['transport'] = {'backend': backend, 'socket': path}
+
+        try:
+            producer = transport.connect(scratch)
+            consumer = transport.connect(scratch)
+        except transport.TransportError as err:
+            print '%-12s skipped, %s' % (backend, err)
+            continue
+        consumer.watch([tube])
+        while True:
+            job = consumer.reserve(timeout=0)
+            if not job:
+                break
+            job.delete()
+
+        latencies = []
+        def consume():
+            for i in range(count):
+                job = consumer.reserve()
+                latencies.append(time.time() - json.loads(job.body)['sent'])
+                job.delete()
+
+        reader = threading.Thread(target=consume)
+        reader.start()
+
+        # Paced, so we measure the latency of a quiet system rather than
+        # queueing behind our own backlog.
+        for i in range(count):
+            event['sent'] = time.time()
+            producer.put([tube], json.dumps(event))
+            time.sleep(0.0002)
+        reader.join()
+
+        # And flat out, for throughput.
+        begin = time.time()
+        reader = threading.Thread(target=consume)
+        reader.start()
+        for i in range(count):
+            event['sent'] = time.time()
+            producer.put([tube], json.dumps(event))
+        reader.join()
+        rate = count / (time.time() - begin)
+
+        paced = latencies[:count]
+        print '%-12s %10.0f %10.0f %10.0f %10.0f %12.0f' % (backend, sum(paced) / len(paced) * 1e6, percentile(paced, 0.5) * 1e6,
+                percentile(paced, 0.95) * 1e6, percentile(paced, 0.99) * 1e6, rate)
+
+        producer.close()
+        consumer.close()
+
+    server.shutdown()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def stub_push_server(transient):
+    # Minimal stand in for the FCM v1 push API. Every device in the transient
+    # set fails with HTTP 503 the first time it's pushed to.
+    counts = {'requests': 0, 'connections': 0, 'devices': 0}
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # headers are written separately
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            counts['connections'] += 1
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            counts['requests'] += 1
+
+            device = request['message'].get('token')
+            if device in transient:
+                transient.discard(device)
+                status, body = 503, json.dumps({'error': {'code': 503, 'status': 'UNAVAILABLE'}})
+            else:
+                counts['devices'] += 1
+                status, body = 200, json.dumps({'name': 'projects/benchmark/messages/' + str(counts['requests'])})
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, counts
+
+
+class StubCredentials:
+    # Stands in for the service account's OAuth2 tokens.
+
+    def __init__(self, path, session):
+        self.project_id = 'benchmark'
+
+    def token(self):
+        return 'benchmark'
+
+
+def service_account(path):
+    # A throwaway service account key file, enough for alert_gcm to start.
+    # Returns whether one could be made.
+    try:
+        key = subprocess.check_output(['openssl', 'genrsa', '2048'], stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    with open(path, 'w') as f:
+        json.dump({'type': 'service_account', 'project_id': 'benchmark', 'private_key_id': 'benchmark', 'private_key': key,
+                   'client_email': 'benchmark@benchmark.iam.gserviceaccount.com', 'client_id': '0',
+                   'token_uri': 'https://oauth2.googleapis.com/token'}, f)
+    return True
+
+
+def measure_process(command, env, ready, timeout=60):
+    # Start command, returning seconds until a line starting with ready is
+    # printed (or the first line, if ready is None) and it's resident memory
+    # at that point in MB. Returns None if it doesn't get there.
+    begin = time.time()
+    try:
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+    except OSError:
+        return None
+
+    try:
+        while time.time() - begin < timeout:
+            if not select.select([process.stdout], [], [], 1)[0]:
+                continue
+            line = process.stdout.readline()
+            if not line:
+                return None
+            if ready is None or line.startswith(ready):
+                elapsed = time.time() - begin
+                rss = 0.0
+                for status in open('/proc/' + str(process.pid) + '/status'):
+                    if status.startswith('VmRSS:'):
+                        rss = int(status.split()[1]) / 1024.0
+                return elapsed, rss
+        return None
+    finally:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.wait()
+
+
+def bench_gcm(settings):
+    # Push delivery against a local stub of the push API, checking every
+    # device is pushed to once, failed devices retried and the connection
+    # reused. Then startup time and memory of the Python sink against the
+    # Java server.
+    import yaml     # requires pyyaml third party package
+    import consumer
+    import alert_gcm
+    alert_gcm.BACKOFF = 0.01
+    alert_gcm.Credentials = StubCredentials
+    log = consumer.log
+    consumer.log = lambda msg: None
+
+    count = 20
+    devices = ['device%04d' % i for i in range(250)]
+    transient = set(devices[::10])
+    server, counts = stub_push_server(set(transient))
+    url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/v1/projects/benchmark/messages:send'
+
+    alerter = alert_gcm.Alerter({'service_account': 'benchmark.json', 'devices': devices, 'url': url})
+    event = {'type': 'alarm', 'code': '621', 'message': 'fire key alarm detected', 'raw': '621', 'timestamp': int(time.time())}
+
+    latencies = []
+    for i in range(count):
+        begin = time.time()
+        alerter.handle(event, json.dumps(event))
+        latencies.append(time.time() - begin)
+
+    retried = len(transient)
+    consumer.log = log
+
+    print 'delivery: %d events to %d devices, %d requests (%.1f per event), %d connection(s)' % (count, len(devices), counts['requests'], counts['requests'] / float(count), counts['connections'])
+    print 'delivery: %d device pushes, %d expected with %d retried: %s' % (counts['devices'], count * len(devices), retried, 'ok' if counts['devices'] == count * len(devices) and counts['connections'] == 1 else 'FAILED')
+    print 'delivery: latency per event p50 %.1f ms, p95 %.1f ms' % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000)
+    print
+
+    # A scratch configuration using the in-process transport, so the Python
+    # sink starts without needing beanstalkd.
+    scratch_dir = tempfile.mkdtemp()
+    path = os.path.join(scratch_dir, 'config.yaml')
+    key = os.path.join(scratch_dir, 'service_account.json')
+    scratch = dict(settings.data)
+    scratch['transport'] = {'backend': 'inprocess'}
+    scratch['beanstalkd'] = dict(settings['beanstalkd'], tubes={'commands': settings['beanstalkd']['tubes']['commands'], 'events': ['alert_gcm']})
+    scratch['alert_gcm'] = {'service_account': key, 'devices': devices[:1], 'url': url}
+    yaml.safe_dump(scratch, open(path, 'w'))
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, HOWALARMING_CONFIG=path)
+    java_env = dict(os.environ, GCM_SENDER_ID='0', GCM_API_KEY='benchmark', BEANSTALK_HOST=str(settings['beanstalkd']['host']),
+                    BEANSTALK_PORT=str(settings['beanstalkd']['port']), BEANSTALK_TUBES_EVENTS='alert_gcm', BEANSTALK_TUBES_COMMANDS='commands')
+
+    print '%-10s %14s %10s' % ('gateway', 'startup (ms)', 'rss (MB)')
+    for name, command, environment, ready in (
+            ('python', [sys.executable, os.path.join(here, 'alert_gcm.py')], env, 'system: pushing alerts'),
+            ('java', ['java', '-jar', os.path.join(here, 'resources/gcmserver/HowAlarmingServer-all-latest.jar')], java_env, None)):
+        result = None
+        if name != 'python' or service_account(key):
+            result = measure_process(command, environment, ready)
+        if result is None:
+            print '%-10s skipped, unable to start' % name
+        else:
+            print '%-10s %14.0f %10.1f' % (name, result[0] * 1000, result[1])
+
+    for name in (path, config.cache_path(path), key):
+        if os.path.exists(name):
+            os.unlink(name)
+    os.rmdir(scratch_dir)
+    server.shutdown()
+
+
+def bench_rules(settings):
+    # Time to route an event as the number of rules grows, which should stay
+    # flat, against checking every rule in turn. Compiling the rules and the
+    # first sighting of each kind of event is reported separately.
+    events = [{'type': event_type, 'code': '%03d' % code, 'zone': '%03d' % zone, 'timestamp': int(time.time())}
+              for event_type in ('alarm', 'info', 'fault') for code in range(600, 640) for zone in range(1, 9)]
+    count = 100000
+
+    print '%8s %12s %16s %16s' % ('rules', 'warm (ms)', 'indexed (us)', 'scanned (us)')
+    for size in (10, 100, 1000, 10000):
+        settings = []
+        for i in range(size):
+            rule = {'name': 'rule %d' % i, 'sinks': ['sink%d' % (i % 5)]}
+            if i % 3 == 0:
+                rule['codes'] = ['%03d' % (600 + i % 200)]
+            elif i % 3 == 1:
+                rule['zones'] = ['%03d' % (i % 64)]
+                rule['types'] = ['alarm']
+            else:
+                rule['types'] = ['info']
+                rule['between'] = (22 * 60, 6 * 60)
+            settings.append(rule)
+        begin = time.time()
+        routes = rules.Rules(settings)
+        for event in events:
+            routes.route(event)
+        warm = time.time() - begin
+
+        begin = time.time()
+        for i in xrange(count):
+            routes.route(events[i % len(events)])
+        indexed = (time.time() - begin) / count
+
+        begin = time.time()
+        scans = count / 100
+        for i in xrange(scans):
+            event = events[i % len(events)]
+            [rule for rule in routes.rules if rule.matches(event['code'], event['type'], event['zone'])]
+        scanned = (time.time() - begin) / scans
+
+        print '%8d %12.1f %16.2f %16.2f' % (size, warm * 1000, indexed * 1e6, scanned * 1e6)
+
+
+def bench_decoder(settings):
+    # Time envisalinkd takes to decode each kind of frame from the alarm,
+    # with publishing and logging stubbed out.
+    import envisalinkd
+    e = envisalinkd.Envisalink()
+    e.resetData()
+    e.printNormal = lambda msg: None
+    e.beanstalk_push = lambda message: None
+    e.sendCommand = lambda *args: None
+    e.panelstate.changed = lambda event: True
+
+    zones = sorted(e.zones)
+    frames = (
+        ('zone',            ['609' + zone for zone in zones] + ['610' + zone for zone in zones]),
+        ('partition zone',  ['6011' + zone for zone in zones] + ['6021' + zone for zone in zones]),
+        ('partition',       ['6501', '6511', '65210', '6551', '6561', '6741', '7511', '8401']),
+        ('keypad LEDs',     ['510%02X' % leds for leds in range(256)] + ['511%02X' % leds for leds in range(256)]),
+        ('trouble',         ['849%02X' % bits for bits in range(128)]),
+        ('fixed',           ['621', '622', '800', '801', '829', '842', '912']),
+        ('other',           ['500000', '502001', '5610023', '550123001019']),
+        )
+    count = 20000
+
+    # Best of several rounds, to keep noise from other processes out.
+    print '%-16s %12s' % ('frames', 'us/frame')
+    for name, words in frames:
+        best = None
+        for round in range(5):
+            begin = time.time()
+            for i in xrange(count):
+                e.decodeResponse(words[i % len(words)])
+            elapsed = time.time() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        print '%-16s %12.2f' % (name, best / count * 1e6)
+
+
+def bench_tail(settings):
+    # Latency from envisalinkd publishing an event to `cli.py --tail` viewers
+    # receiving it, as the number of viewers grows. Every viewer filters on
+    # zone, only a quarter of them wanting the events published.
+    path = os.path.join(tempfile.mkdtemp(), 'tail.sock')
+    feed = tail.Feed(path, 100)
+    feed.start()
+    count = 200
+
+    def view(stream, received, lock):
+        for line in stream:
+            stamp = time.time()
+            lock.acquire()
+            received.append(stamp - json.loads(line)['sent'])
+            lock.release()
+
+    # Viewers from earlier rounds stay connected, each round publishing to
+    # a zone of it's own.
+    print '%8s %10s %10s %10s' % ('viewers', 'p50 (ms)', 'p99 (ms)', 'max (ms)')
+    for round, size in enumerate((1, 10, 50, 200)):
+        zone = '%03d' % (round + 1)
+        received = []
+        lock = threading.Lock()
+        connected = len(feed.viewers)
+
+        for i in range(size):
+            stream = tail.follow(path, 0, None, None, [zone if i % 4 == 0 else '999'])
+            thread = threading.Thread(target=view, args=(stream, received, lock))
+            thread.daemon = True
+            thread.start()
+
+        while len(feed.viewers) < connected + size:
+            time.sleep(0.01)
+
+        for i in range(count):
+            event = {'type': 'info', 'code': '609', 'zone': zone, 'sent': time.time()}
+            feed.publish(event, json.dumps(event))
+            time.sleep(0.005)
+
+        expected = count * len(range(0, size, 4))
+        deadline = time.time() + 10
+        while len(received) < expected and time.time() < deadline:
+            time.sleep(0.01)
+        print '%8d %10.2f %10.2f %10.2f' % (size, percentile(received, 0.5) * 1000, percentile(received, 0.99) * 1000, max(received) * 1000)
+
+
+def bench_query(settings):
+    # Response time of envisalinkd's query API as concurrent clients grow,
+    # with events being published throughout as they would be by the panel.
+    leds = ('ready', 'armed', 'memory', 'bypass', 'trouble', 'program', 'fire', 'backlight')
+    state = query.State(leds)
+    feed = tail.Feed(os.path.join(tempfile.mkdtemp(), 'tail.sock'), 1000)
+    server = query.serve(0, state, feed, lambda: 'logged in')
+    port = server.server_address[1]
+
+    def event(i):
+        zone = '%03d' % (i % 64 + 1)
+        return {'type': 'info', 'code': ('609', '610')[i % 2], 'zone': zone, 'raw': '609' + zone, 'message': 'zone ' + zone, 'timestamp': int(time.time())}
+
+    for i in range(1000):
+        feed.publish(event(i), json.dumps(event(i)))
+
+    publishing = threading.Event()
+    def publish():
+        i = 0
+        while not publishing.is_set():
+            e = event(i)
+            state.apply(e)
+            feed.publish(e, json.dumps(e))
+            i += 1
+            time.sleep(0.005)
+    thread = threading.Thread(target=publish)
+    thread.daemon = True
+    thread.start()
+
+    paths = ('/state', '/events?limit=20', '/events?zone=005&since=' + str(int(time.time()) - 60))
+    requests = 200
+
+    print '%-36s %8s %10s %10s %10s' % ('path', 'clients', 'p50 (ms)', 'p99 (ms)', 'req/s')
+    for path in paths:
+        for clients in (1, 10, 50):
+            latencies = []
+            lock = threading.Lock()
+
+            def client():
+                for i in range(requests / clients or 1):
+                    begin = time.time()
+                    connection = httplib.HTTPConnection('127.0.0.1', port)
+                    connection.request('GET', path)
+                    connection.getresponse().read()
+                    connection.close()
+                    lock.acquire()
+                    latencies.append(time.time() - begin)
+                    lock.release()
+
+            threads = [threading.Thread(target=client) for i in range(clients)]
+            begin = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - begin
+            print '%-36s %8d %10.2f %10.2f %10.0f' % (path[:36], clients, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, len(latencies) / elapsed)
+
+    publishing.set()
+    server.shutdown()
+
+
+def stub_plivo_server():
+    # Minimal stand in for Plivo's REST API. Placing a call fetches the call's
+    # answer_url straight away, as Plivo does once the call is answered,
+    # keeping the XML and how long it took. No call is ever live.
+    answers = []
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            try:
+                params = json.loads(data)
+            except ValueError:
+                params = dict((key, values[-1]) for key, values in urlparse.parse_qs(data).items())
+
+            begin = time.time()
+            xml = urllib2.urlopen(params['answer_url'], timeout=10).read()
+            answers.append((params.get('to'), xml, time.time() - begin))
+            self.reply(201, {'message': 'call fired', 'request_uuid': str(len(answers))})
+
+        def do_GET(self):
+            self.reply(200, {'calls': []})
+
+        def reply(self, status, response):
+            body = json.dumps(response)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, answers
+
+
+def bench_plivo(settings):
+    # Response time of alert_plivo's answer server, which Plivo waits on once
+    # a call is answered, as concurrent fetches grow. Then calls placed
+    # through a local stand in for Plivo, checking each is answered with the
+    # event's own message.
+    import consumer
+    import alert_plivo
+    answers = alert_plivo.serve_answers(0, '127.0.0.1')
+    port = answers.server_address[1]
+
+    events = []
+    for i in range(200):
+        zone = '%03d' % (i % 64 + 1)
+        event = {'type': 'alarm', 'code': '601', 'raw': '6011' + zone, 'message': 'alarm. partition = 1 zone = Zone ' + zone, 'timestamp': int(time.time()) + i}
+        events.append((event, json.dumps(event)))
+
+    count = 10000
+    begin = time.time()
+    for i in xrange(count):
+        alert_plivo.render(events[i % len(events)][0])
+    rendered = (time.time() - begin) / count
+    ids = [answers.add(event, body) for event, body in events]
+    begin = time.time()
+    for i in xrange(count):
+        answers.lookup(ids[i % len(ids)])
+    cached = (time.time() - begin) / count
+    print 'render %.1f us per event, cached lookup %.1f us' % (rendered * 1e6, cached * 1e6)
+    print
+
+    requests = 400
+    print '%8s %10s %10s %10s' % ('clients', 'p50 (ms)', 'p99 (ms)', 'req/s')
+    for clients in (1, 10, 50):
+        latencies = []
+        lock = threading.Lock()
+
+        def client(offset):
+            for i in range(requests / clients or 1):
+                begin = time.time()
+                connection = httplib.HTTPConnection('127.0.0.1', port)
+                connection.request('GET', '/answer/' + ids[(offset + i) % len(ids)] + '.xml')
+                connection.getresponse().read()
+                connection.close()
+                lock.acquire()
+                latencies.append(time.time() - begin)
+                lock.release()
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        begin = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - begin
+        print '%8d %10.2f %10.2f %10.0f' % (clients, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, len(latencies) / elapsed)
+    print
+
+    server, placed = stub_plivo_server()
+    log = consumer.log
+    consumer.log = lambda msg: None
+    try:
+        alerter = alert_plivo.Alerter({'auth_id': 'MABENCHMARK', 'auth_token': 'benchmark', 'call_from': '666', 'call_to': ['1001', '1002'], 'triggers': ['alarm'],
+                                       'api_url': 'http://127.0.0.1:' + str(server.server_address[1]), 'answer_url': 'http://127.0.0.1:' + str(port) + '/'})
+    except ImportError:
+        consumer.log = log
+        print 'calls: skipped, plivo isn\'t installed'
+        server.shutdown()
+        answers.shutdown()
+        return
+
+    calls = 20
+    for event, body in events[:calls]:
+        alerter.handle(event, body)
+    consumer.log = log
+
+    expected = [escape(event['message']) for event, body in events[:calls] for phone in alerter.call_to]
+    spoken = [xml for phone, xml, took in placed]
+    matched = sum(1 for message, xml in zip(expected, spoken) if message in xml)
+    print 'calls: %d placed, %d expected, %d answered with the event\'s message' % (len(placed), len(expected), matched)
+    print 'calls: answer fetched in p50 %.2f ms, max %.2f ms' % (percentile([took for phone, xml, took in placed], 0.5) * 1000, max(took for phone, xml, took in placed) * 1000)
+    if matched != len(expected):
+        print 'calls: FAILED, answered with:'
+        print spoken[0] if spoken else '(nothing)'
+
+    server.shutdown()
+    answers.shutdown()
+
+
+def bench_statemap(settings):
+    # Time for local readers to get a consistent copy of the panel state from
+    # envisalinkd's state map, with the state changing as fast as it can be
+    # written. Every state written has all zones open or all closed, with the
+    # partition armed or disarmed to match, so a torn read shows as a mix.
+    path = os.path.join(tempfile.mkdtemp(), 'howalarming.state')
+    publisher = statemap.Publisher(path)
+    states = []
+    for i in range(2):
+        zones = dict(('%03d' % zone, {'open': bool(i), 'alarm': False, 'tamper': False, 'fault': False}) for zone in range(1, 65))
+        partitions = {'1': {'state': ('disarmed', 'armed')[i], 'ready': not i}}
+        states.append({'zones': zones, 'partitions': partitions, 'keypad': {'lit': ['ready'], 'flashing': []}, 'updated': int(time.time())})
+
+    # The writer is a process of it's own, as envisalinkd is.
+    writer = os.fork()
+    if writer == 0:
+        i = 0
+        while True:
+            publisher.publish(i, states[i % 2], 'armed')
+            i += 1
+    first = statemap.Reader(path).sequence()
+    begin = time.time()
+
+    print '%8s %12s %12s %8s' % ('readers', 'us per read', 'reads/s', 'torn')
+    for readers in (1, 4, 16):
+        results = []
+        lock = threading.Lock()
+
+        def read():
+            reader = statemap.Reader(path)
+            count = 2000
+            torn = 0
+            begin = time.time()
+            for i in xrange(count):
+                state = reader.read()
+                opened = set(zone['open'] for zone in state['zones'].values())
+                if len(opened) != 1 or state['partitions']['1']['state'] != ('disarmed', 'armed')[opened.pop()]:
+                    torn += 1
+            elapsed = time.time() - begin
+            reader.close()
+            lock.acquire()
+            results.append((count, elapsed, torn))
+            lock.release()
+
+        threads = [threading.Thread(target=read) for i in range(readers)]
+        begin = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - begin
+        reads = sum(count for count, took, torn in results)
+        print '%8d %12.1f %12.0f %8d' % (readers, sum(took for count, took, torn in results) / reads * 1e6, reads / elapsed, sum(torn for count, took, torn in results))
+
+    writes = (statemap.Reader(path).sequence() - first) / 2 / (time.time() - begin)
+    os.kill(writer, signal.SIGKILL)
+    os.waitpid(writer, 0)
+    publisher.close()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+    print
+    print 'writer: %.0f states written per second alongside' % writes
+
+
+def bench_ordering(settings):
+    # Events for a handful of zones delivered by a pool of workers, each
+    # delivery taking a random time, as a slow sink with `workers` raised
+    # would. Counts events delivered before an earlier event of their zone,
+    # with and without the sequencer, and the throughput of each. One in 50
+    # events never arrives, to check it's reported as lost.
+    import Queue
+    import random
+    import ordering
+    random.seed(1)
+    count = 2000
+    zones = ['%03d' % zone for zone in range(1, 9)]
+
+    events = []
+    streams = {}
+    for i in range(count):
+        zone = random.choice(zones)
+        streams[zone] = streams.get(zone, 0) + 1
+        events.append({'type': 'info', 'zone': zone, 'sequence': {'run': 1, 'event': i + 1, 'stream': 'zone ' + zone, 'tube': i + 1, 'in_stream': streams[zone]}})
+    lost = set(range(25, count, 50))
+
+    print '%-10s %8s %12s %14s %8s' % ('ordering', 'workers', 'events/s', 'out of order', 'lost')
+    for ordered in (False, True):
+        for workers in (4, 16):
+            jobs = Queue.Queue()
+            for i, event in enumerate(events):
+                if i not in lost:
+                    jobs.put(event)
+            logged = []
+            gaps = ordering.Gaps(logged.append, gap_wait=0.2)
+            sequencer = ordering.Sequencer(0.05, logged.append) if ordered else None
+            delivered = {}
+            disorder = [0]
+            lock = threading.Lock()
+
+            def worker():
+                while True:
+                    try:
+                        event = jobs.get_nowait()
+                    except Queue.Empty:
+                        return
+                    gaps.arrived(event)
+                    ticket = sequencer.begin(event) if sequencer else None
+                    time.sleep(random.random() * 0.004)
+                    lock.acquire()
+                    number = event['sequence']['in_stream']
+                    if number < delivered.get(event['zone'], 0):
+                        disorder[0] += 1
+                    delivered[event['zone']] = max(number, delivered.get(event['zone'], 0))
+                    lock.release()
+                    if sequencer:
+                        sequencer.end(ticket)
+
+            threads = [threading.Thread(target=worker) for i in range(workers)]
+            begin = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - begin
+
+            # Gaps are reported once later events have been waiting on them
+            # long enough, ordered or not.
+            time.sleep(0.3)
+            gaps.arrived({'sequence': {'run': 1, 'event': count + 1, 'stream': 'system', 'tube': count + 1, 'in_stream': 1}})
+            reported = sum(int(line.split()[1]) for line in logged if 'missing from the tube' in line)
+            print '%-10s %8d %12.0f %14d %8s' % (('off', 'on')[ordered], workers, (count - len(lost)) / elapsed, disorder[0], reported)
+    print
+    print '%d events never arrived' % len(lost)
+
+
+def bench_publisher(settings):
+    # envisalinkd publishing from the main loop (decoding frames) and from
+    # timer threads (sending commands) at once, against a queue slowed down
+    # to varying degrees. Checks every event is put exactly once, numbered
+    # in order on each tube, and that sending to the alarm and decoding
+    # don't slow down with the queue.
+    import envisalinkd
+    e = envisalinkd.Envisalink()
+    e.resetData()
+    e.printNormal = lambda msg: None
+    e.panelstate.changed = lambda event: True
+    e.inSnapshot = lambda event: False
+    e.feed = tail.Feed(os.path.join(tempfile.mkdtemp(), 'tail.sock'), 100)
+
+    class Socket:
+        def send(self, data):
+            return len(data)
+
+    class SlowQueue:
+        # Stands in for a connection to a slow beanstalkd.
+        def __init__(self):
+            self.delay = 0
+            self.bodies = []
+        def put_many(self, puts):
+            time.sleep(self.delay)
+            for tubes, body, priority in puts:
+                for tube in tubes:
+                    self.bodies.append((tube, json.loads(body)))
+
+    e.socket = Socket()
+    e.publisher_queue = SlowQueue()
+    e.publisher = threading.Thread(target=e.publisherRun)
+    e.publisher.daemon = True
+    e.publisher.start()
+
+    zones = sorted(e.zones)
+    frames = ['609' + zone for zone in zones] + ['610' + zone for zone in zones]
+    count = 2000
+    timers = 4
+
+    print '%10s %14s %14s %14s %14s %8s' % ('put delay', 'send p50 (us)', 'send p99 (us)', 'decode p50', 'decode p99', 'events')
+    for delay in (0, 0.005, 0.05):
+        e.publisher_queue.delay = delay
+        e.publisher_queue.bodies = []
+        first = e.sequence
+        sends = []
+        decodes = []
+        lock = threading.Lock()
+
+        def timer():
+            for i in range(count / timers / 4):
+                begin = time.time()
+                e.sendCommand(0, 'poll')
+                took = time.time() - begin
+                lock.acquire()
+                sends.append(took)
+                lock.release()
+                time.sleep(0.0005)
+
+        threads = [threading.Thread(target=timer) for i in range(timers)]
+        for t in threads:
+            t.start()
+        for i in range(count):
+            begin = time.time()
+            e.decodeResponse(frames[i % len(frames)])
+            decodes.append(time.time() - begin)
+        for t in threads:
+            t.join()
+
+        expected = count + len(sends)
+        deadline = time.time() + 60
+        while e.sequence - first < expected and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(delay + 0.1)
+
+        published = [body for tube, body in e.publisher_queue.bodies if body['sequence']['event'] > first]
+        events = set(body['sequence']['event'] for body in published)
+        ordered = True
+        for tube in e.beanstalk_tubes_events:
+            numbers = [body['sequence']['tube'] for name, body in e.publisher_queue.bodies if name == tube]
+            ordered = ordered and numbers == range(numbers[0], numbers[0] + len(numbers)) if numbers else ordered
+        print '%10.3f %14.1f %14.1f %14.1f %14.1f %8s' % (delay, percentile(sends, 0.5) * 1e6, percentile(sends, 0.99) * 1e6,
+                                                        percentile(decodes, 0.5) * 1e6, percentile(decodes, 0.99) * 1e6,
+                                                        'ok' if len(events) == expected and ordered else 'FAILED')
+
+    e.stopPublisher()
+
+
+BENCHMARKS = {
+    'decoder': bench_decoder,
+    'gcm': bench_gcm,
+    'ordering': bench_ordering,
+    'plivo': bench_plivo,
+    'priority': bench_priority,
+    'publisher': bench_publisher,
+    'query': bench_query,
+    'rules': bench_rules,
+    'statemap': bench_statemap,
+    'tail': bench_tail,
+    'transport': bench_transport,
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print 'Usage: ' + sys.argv[0] + ' <' + '|'.join(sorted(BENCHMARKS)) + '>'
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]](config.load())
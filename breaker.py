@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+#
+# Circuit breakers for the endpoints the alert sinks deliver to (each URL of
+# alert_url, the Plivo API), so a dead endpoint fails straight away instead of
+# costing a timeout on every event while the tube backs up behind it.
+#
+# A breaker starts closed, passing every attempt. After `failures` attempts in
+# a row have failed it opens, and attempts fail fast without going near the
+# endpoint. Once `reset` seconds have passed the next attempt is let through
+# as a probe (half-open): if it succeeds the breaker closes again, otherwise
+# it reopens for another `reset` seconds. Other attempts fail fast while the
+# probe is in flight.
+#
+# Breakers are kept per sink and endpoint for the life of the process, so they
+# survive the alerters being rebuilt on reload. Their state and counts are
+# kept in `registry`, served as Prometheus metrics when the consumer has a
+# `metrics_port`.
+#
+
+import time
+import threading
+import metrics
+
+
+DEFAULTS = {
+    'failures':     5,      # consecutive failures before opening
+    'reset':        30,     # seconds open before probing
+    }
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half-open', 'open'
+
+# Gauge values for each state.
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+registry = metrics.Registry()
+registry.describe('howalarming_breaker_state', 'gauge', 'Circuit breaker state, 0 closed, 1 half-open, 2 open.')
+registry.describe('howalarming_breaker_failures_total', 'counter', 'Attempts that failed.')
+registry.describe('howalarming_breaker_rejected_total', 'counter', 'Attempts failed fast while open.')
+registry.describe('howalarming_breaker_opened_total', 'counter', 'Times the breaker has opened.')
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+class Breaker:
+
+    def __init__(self, sink, endpoint, settings=None):
+        self.labels = {'sink': sink, 'endpoint': endpoint}
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0       # in a row
+        self.opened = None
+        self.probing = False
+        self.configure(settings)
+        registry.set('howalarming_breaker_state', STATES[CLOSED], **self.labels)
+
+    def configure(self, settings):
+        values = dict(DEFAULTS)
+        values.update(settings or {})
+        self.threshold = max(1, int(values['failures']))
+        self.reset = float(values['reset'])
+
+    def allow(self):
+        # Whether to attempt the endpoint, if so the result must be passed to
+        # record.
+        self.lock.acquire()
+        try:
+            if self.state == OPEN and time.time() - self.opened >= self.reset:
+                self.change(HALF_OPEN)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            registry.inc('howalarming_breaker_rejected_total', **self.labels)
+            return False
+        finally:
+            self.lock.release()
+
+    def record(self, ok):
+        # Returns the state the breaker changed to, None if it didn't.
+        self.lock.acquire()
+        try:
+            self.probing = False
+            if ok:
+                self.failures = 0
+                if self.state != CLOSED:
+                    return self.change(CLOSED)
+                return None
+
+            self.failures += 1
+            registry.inc('howalarming_breaker_failures_total', **self.labels)
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+                self.opened = time.time()
+                registry.inc('howalarming_breaker_opened_total', **self.labels)
+                return self.change(OPEN)
+            return None
+        finally:
+            self.lock.release()
+
+    def change(self, state):
+        # Must hold lock.
+        self.state = state
+        registry.set('howalarming_breaker_state', STATES[state], **self.labels)
+        return state
+
+    def retry_in(self):
+        # Seconds until the next probe.
+        if self.state != OPEN:
+            return 0
+        return max(0, int(self.opened + self.reset - time.time()))
+
+
+def get(sink, endpoint, settings=None):
+    # The breaker for the sink's endpoint, with settings applied.
+    breakers_lock.acquire()
+    try:
+        key = (sink, endpoint)
+        if key not in breakers:
+            breakers[key] = Breaker(sink, endpoint, settings)
+        else:
+            breakers[key].configure(settings)
+        return breakers[key]
+    finally:
+        breakers_lock.release()
@@ -0,0 +1,114 @@
+#! /usr/bin/env python
+#
+# Message broker for single host installations, an alternative to beanstalkd
+# selected with `transport: backend: unix` in the configuration. Applications
+# connect over a Unix domain socket and get the same work queue semantics as
+# with beanstalkd, but an event put on several tubes is only sent and stored
+# once. Messages are held in memory only.
+#
+# Refer to transport.py for the protocol.
+#
+
+import os
+import sys
+import json
+import socket
+import SocketServer
+import config
+import transport
+
+# Unbuffered Logging
+sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.broker = self.server.broker
+        self.waiter = transport.Waiter()
+
+    def handle(self):
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                return
+            if not line:
+                return
+
+            try:
+                response = self.dispatch(json.loads(line))
+                response['ok'] = True
+            except transport.JobLost as err:
+                response = {'ok': False, 'error': str(err)}
+            except (ValueError, KeyError, TypeError) as err:
+                response = {'ok': False, 'error': 'bad request: ' + str(err)}
+
+            try:
+                self.wfile.write(json.dumps(response) + '\n')
+                self.wfile.flush()
+            except socket.error:
+                return
+
+    def dispatch(self, request):
+        op = request['op']
+
+        if op == 'put':
+            body = request['body'].encode('utf-8')
+            self.broker.put(request['tubes'], body, request['pri'], request['delay'], request['ttr'])
+            return {}
+        if op == 'reserve':
+            entry = self.broker.reserve(request['tubes'], request['timeout'], self.waiter, self)
+            if entry:
+                return {'job': {'id': entry.jid, 'body': entry.body}}
+            return {'job': None}
+        if op == 'delete':
+            self.broker.delete(request['id'], self)
+        elif op == 'release':
+            self.broker.release(request['id'], self, request['pri'], request['delay'])
+        elif op == 'bury':
+            self.broker.bury(request['id'], self, request['pri'])
+        elif op == 'touch':
+            self.broker.touch(request['id'], self)
+        elif op == 'stats':
+            return {'stats': self.broker.stats(request['id'])}
+        else:
+            raise ValueError('unknown op ' + op)
+        return {}
+
+    def finish(self):
+        self.broker.disconnect(self)
+        self.waiter.close()
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path):
+    # Remove a stale socket left behind by a previous run.
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = Server(path, Handler)
+    server.broker = transport.Broker()
+    return server
+
+
+
+if __name__ == '__main__':
+        try:
+            settings = config.load()
+            path = (settings.get('transport') or {}).get('socket', transport.DEFAULT_SOCKET)
+
+            server = serve(path)
+            print 'system: broker listening on ' + path
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            print 'system: User Terminated'
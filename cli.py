@@ -3,28 +3,33 @@
 # Minimal CLI for interacting with applications via issues commands to/from
 # the beanstalk queues. Generally intended for debugging purposes.
 #
+# With --tail it instead follows envisalinkd's live event feed, which doesn't
+# take events off any queue, so any number of people can watch alongside the
+# running alert sinks. Recent history and filters are optional, eg:
+#
+#   ./cli.py --tail --history 20 --type alarm,fault --zone 005
+#
+# With --state it prints the panel's current state from envisalinkd's state
+# map (see statemap.py) and exits.
+#
 
 import socket
 import sys
-import time
-import datetime
-import string
-import re
-import signal
+import json
 import select
-import threading
-import yaml         # requires pyyaml third party package
-import beanstalkc   # requires beanstalkc third party package
+import argparse
+import config
+import statemap
+import tail
+import transport
 
 class HowAlarmingCLI:
     def __init__(self):
         # Load configuration from YAML file and assign configuration values.
         try:
-            self.config         = yaml.load(open('config.yaml', 'r'))
+            self.config         = config.load()
 
-            # Beanstalkd Message Queue settings
-            self.beanstalk_host             = self.config['beanstalkd']['host']
-            self.beanstalk_port             = int(self.config['beanstalkd']['port'])
+            # Message Queue settings
             self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
             self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
 
@@ -38,24 +43,33 @@ class HowAlarmingCLI:
             print 'Fatal: Could not open configuration file'
             raise
 
+        except config.ConfigError as err:
+            print 'Fatal: Invalid configuration, ' + str(err)
+            raise
+
         except (KeyError, AttributeError) as err:
             print 'Fatal: Unable to find required configuration in config.yaml'
             raise
 
 
     def beanstalk_connect(self):
+        # The in-process broker lives inside envisalinkd, we can't reach it.
+        if transport.backend(self.config) == 'inprocess':
+            print 'Fatal: The inprocess transport can only be used by envisalinkd and the dispatcher'
+            raise BaseException
+
         try:
-            self.beanstalk = beanstalkc.Connection(host=self.beanstalk_host, port=self.beanstalk_port)
-            print 'system: Beanstalkd connected on ' + str(self.beanstalk_host) + ' on port ' + str(self.beanstalk_port)
-        except socket.error, (value,message):
-            print "Fatal: Unable to connect to beanstalkd"
+            self.beanstalk = transport.connect(self.config)
+            self.beanstalk.watch(['cli'])
+            print 'system: connected to ' + transport.describe(self.config)
+        except transport.TransportError:
+            print "Fatal: Unable to connect to " + transport.describe(self.config)
             raise
 
 
     def beanstalk_poll(self):
         # Poll for any commands in the event tube for CLI (aptly named "cli")
 
-        self.beanstalk.watch('cli')
         job = self.beanstalk.reserve(timeout=1) # Mostly non-blocking Beanstalk poll
 
         if job:
@@ -67,10 +81,7 @@ class HowAlarmingCLI:
 
     def beanstalk_push(self, message):
         # Send outputs to all defined command tubes (queues in beanstalk speak).
-        for tube in self.beanstalk_tubes_commands:
-            #print 'system: Pushing message \"'+ str(message) +'\" to ' + str(tube) + '.'
-            self.beanstalk.use(tube)
-            self.beanstalk.put(message)
+        self.beanstalk.put(self.beanstalk_tubes_commands, message)
         return
 
     def keyboard_poll(self):
@@ -89,7 +100,77 @@ class HowAlarmingCLI:
         return
 
 
+def tail_follow(options):
+    # Follow the live feed until interrupted or envisalinkd goes away.
+    try:
+        settings = config.load()
+        path = (settings.get('envisalinkd') or {}).get('tail_socket', tail.DEFAULT_SOCKET)
+    except IOError:
+        print 'Fatal: Could not open configuration file'
+        raise
+    except config.ConfigError as err:
+        print 'Fatal: Invalid configuration, ' + str(err)
+        raise
+
+    try:
+        for line in tail.follow(path, options.history, split(options.type), split(options.code), split(options.zone)):
+            print line
+            sys.stdout.flush()
+    except socket.error, err:
+        print 'Fatal: Unable to follow the event feed at ' + path + ', is envisalinkd running? (' + str(err) + ')'
+        raise
+    print 'system: event feed closed'
+
+
+def state_show():
+    # Print the panel state envisalinkd has published to it's state map.
+    try:
+        settings = config.load()
+        path = (settings.get('envisalinkd') or {}).get('state_map')
+    except IOError:
+        print 'Fatal: Could not open configuration file'
+        raise
+    except config.ConfigError as err:
+        print 'Fatal: Invalid configuration, ' + str(err)
+        raise
+
+    if not path:
+        print 'Fatal: Config must set state_map under envisalinkd to read the state'
+        raise BaseException
+
+    try:
+        print json.dumps(statemap.Reader(path).read(), indent=2, sort_keys=True)
+    except (IOError, ValueError) as err:
+        print 'Fatal: Unable to read the state map at ' + path + ', is envisalinkd running? (' + str(err) + ')'
+        raise
+
+
+def split(values):
+    # Filters may be repeated and/or comma separated.
+    return [value for option in values or [] for value in option.split(',') if value]
+
+
 if __name__ == '__main__':
+        parser = argparse.ArgumentParser(description='Send commands to and watch events from HowAlarming')
+        parser.add_argument('--tail', action='store_true', help='follow the live event feed instead of the cli queue')
+        parser.add_argument('--state', action='store_true', help='show the current panel state and exit')
+        parser.add_argument('--history', type=int, default=0, metavar='N', help='start with the last N matching events')
+        parser.add_argument('--type', action='append', help='only show events of these types, eg alarm,fault')
+        parser.add_argument('--code', action='append', help='only show events with these codes, eg 601,621')
+        parser.add_argument('--zone', action='append', help='only show events for these zones, eg 005')
+        options = parser.parse_args()
+
+        if options.state:
+            state_show()
+            sys.exit(0)
+
+        if options.tail:
+            try:
+                tail_follow(options)
+            except KeyboardInterrupt:
+                print 'system: User Terminated'
+            sys.exit(0)
+
         try:
             c = HowAlarmingCLI()
             c.beanstalk_connect()
@@ -103,3 +184,5 @@ if __name__ == '__main__':
             print 'system: User Terminated'
         except socket.error, err:
             print 'system: socket error ' + str(err[0])
+        except transport.TransportError, err:
+            print 'system: transport error ' + str(err)
@@ -0,0 +1,406 @@
+#! /usr/bin/env python
+#
+# Shared configuration loading for all the HowAlarming applications.
+#
+# The whole YAML file is validated against SCHEMA when it's loaded, so a typo
+# or missing setting is reported up front with the path to the offending key,
+# rather than as a KeyError halfway through handling an alarm. Values are also
+# normalised (eg zone ids padded to 3 digits) so applications can use them
+# as-is.
+#
+# Parsing YAML is slow on small hosts like a Raspberry Pi, so the validated
+# configuration is cached in a pickle next to the YAML file, keyed by the
+# file's mtime and size. Subsequent starts load the cache and skip YAML
+# entirely (including importing it) unless the file has changed.
+#
+# Daemons can have the configuration re-read on SIGHUP. The signal only flags
+# that a reload is wanted, the daemon applies it from it's main loop by calling
+# poll(). The new file is validated in full before it replaces the running
+# configuration, so a bad edit leaves the daemon running with it's previous
+# settings.
+#
+
+import os
+import signal
+import cPickle as pickle
+
+
+# Bump whenever the compiled form changes so stale caches are discarded.
+CACHE_VERSION = 20
+
+
+class ConfigError(Exception):
+    pass
+
+
+KINDS = {str: 'string', int: 'whole number', float: 'number', bool: 'boolean'}
+
+
+class Value:
+    # A single scalar setting. Strings accept any scalar since YAML turns
+    # unquoted numbers (passwords, phone numbers) into ints.
+
+    def __init__(self, kind, required=True):
+        self.kind = kind
+        self.required = required
+
+    def check(self, value, path):
+        if self.kind is str:
+            if isinstance(value, basestring):
+                return value
+            if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                return str(value)
+        elif self.kind is bool:
+            if isinstance(value, bool):
+                return value
+        elif self.kind in (int, float):
+            try:
+                if not isinstance(value, bool):
+                    return self.kind(value)
+            except (TypeError, ValueError):
+                pass
+        raise ConfigError(path + ' must be a ' + KINDS[self.kind])
+
+
+class PaddedId(Value):
+    # Because the zone ids and event codes are 3 digit long ints, if the user
+    # hasn't quoted them in the YAML, they get convered to ints and then
+    # break. Hence we convert them to strings and pad with zeros to support
+    # either int or string input.
+
+    def __init__(self):
+        Value.__init__(self, str)
+
+    def check(self, value, path):
+        return Value.check(self, value, path).zfill(3)
+
+
+class Choice(Value):
+
+    def __init__(self, choices, required=True):
+        Value.__init__(self, str, required)
+        self.choices = choices
+
+    def check(self, value, path):
+        if value not in self.choices:
+            raise ConfigError(path + ' must be one of ' + ', '.join(self.choices))
+        return value
+
+
+class TimeRange(Value):
+    # Daily time window as 'HH:MM-HH:MM', compiled to minutes past midnight.
+
+    def __init__(self, required=True):
+        Value.__init__(self, str, required)
+
+    def check(self, value, path):
+        try:
+            start, end = [hhmm.split(':') for hhmm in Value.check(self, value, path).split('-')]
+            start, end = int(start[0]) * 60 + int(start[1]), int(end[0]) * 60 + int(end[1])
+        except ValueError:
+            raise ConfigError(path + ' must be a time range like 22:00-06:00')
+        if not (0 <= start < 1440 and 0 <= end <= 1440):
+            raise ConfigError(path + ' must be a time range like 22:00-06:00')
+        return (start, end)
+
+
+class List:
+
+    def __init__(self, item, required=True):
+        self.item = item
+        self.required = required
+
+    def check(self, value, path):
+        if not isinstance(value, list):
+            raise ConfigError(path + ' must be a list')
+        return [self.item.check(v, path + '[' + str(i) + ']') for i, v in enumerate(value)]
+
+
+class Mapping:
+    # Free-form dictionary, eg zone id to zone name.
+
+    def __init__(self, key, value, required=True):
+        self.key = key
+        self.value = value
+        self.required = required
+
+    def check(self, value, path):
+        if not isinstance(value, dict):
+            raise ConfigError(path + ' must be a mapping')
+        return dict((self.key.check(k, path), self.value.check(v, path + '.' + str(k))) for k, v in value.items())
+
+
+class Section:
+    # Dictionary with a fixed set of known keys. Unknown keys are rejected so
+    # that typos don't silently fall back to defaults.
+
+    def __init__(self, required=True, **fields):
+        self.required = required
+        self.fields = fields
+
+    def check(self, value, path):
+        prefix = path + '.' if path else ''
+
+        if not isinstance(value, dict):
+            raise ConfigError((path or 'configuration') + ' must be a mapping')
+
+        for key in value:
+            if key not in self.fields:
+                raise ConfigError('unknown setting ' + prefix + str(key))
+
+        result = {}
+        for key, field in self.fields.items():
+            if value.get(key) is None:
+                if field.required:
+                    raise ConfigError('missing required setting ' + prefix + key)
+                continue
+            result[key] = field.check(value[key], prefix + key)
+        return result
+
+
+CONSUMER = Section(False,
+    workers         = Value(int, False),
+    retry_delay     = Value(int, False),
+    max_attempts    = Value(int, False),
+    order_wait      = Value(float, False),
+    spool_dir       = Value(str, False),
+    spool_max_bytes = Value(int, False),
+    metrics_port    = Value(int, False),
+    )
+
+BREAKER = Section(False,
+    failures        = Value(int, False),
+    reset           = Value(float, False),
+    )
+
+RATE_LIMIT = Section(False,
+    rate                = Value(float, False),
+    burst               = Value(int, False),
+    destination_rate    = Value(float, False),
+    destination_burst   = Value(int, False),
+    bypass_codes        = List(PaddedId(), False),
+    bypass_types        = List(Value(str), False),
+    )
+
+TUBE_POLICY = Section(False,
+    max_depth       = Value(int, False),
+    max_age         = Value(int, False),
+    overflow        = Choice(('drop-oldest', 'drop-info-first'), False),
+    )
+
+RULE = Section(
+    name            = Value(str, False),
+    codes           = List(PaddedId(), False),
+    types           = List(Value(str), False),
+    zones           = List(PaddedId(), False),
+    between         = TimeRange(False),
+    sinks           = List(Value(str)),
+    )
+
+SCHEMA = Section(
+    beanstalkd = Section(
+        host            = Value(str),
+        port            = Value(int),
+        tubes           = Section(
+            commands        = List(Value(str)),
+            events          = List(Value(str)),
+            ),
+        ),
+    transport = Section(False,
+        backend         = Choice(('beanstalk', 'inprocess', 'unix'), False),
+        socket          = Value(str, False),
+        ),
+    rules = List(RULE, False),
+    priorities = Section(False,
+        default         = Value(int, False),
+        types           = Mapping(Value(str), Value(int), False),
+        codes           = Mapping(PaddedId(), Value(int), False),
+        ),
+    tubewatch = Section(False,
+        interval        = Value(int, False),
+        scan_limit      = Value(int, False),
+        metrics_port    = Value(int, False),
+        default         = TUBE_POLICY,
+        tubes           = Mapping(Value(str), TUBE_POLICY, False),
+        ),
+    consumer = CONSUMER,
+    trace = Section(False,
+        enabled         = Value(bool, False),
+        log             = Value(str, False),
+        ),
+    dispatcher = Section(False,
+        sinks           = List(Value(str)),
+        consumer        = CONSUMER,
+        ),
+    envisalinkd = Section(False,
+        host            = Value(str),
+        port            = Value(int),
+        password        = Value(str),
+        code_master     = Value(str),
+        code_installer  = Value(str),
+        zones           = Mapping(PaddedId(), Value(str)),
+        tail_socket     = Value(str, False),
+        tail_history    = Value(int, False),
+        query_port      = Value(int, False),
+        state_map       = Value(str, False),
+        zone_stats      = Value(str, False),
+        zone_stats_interval = Value(int, False),
+        state_file      = Value(str, False),
+        status_frames   = Value(bool, False),
+        ),
+    alert_email = Section(False,
+        smtp_host       = Value(str),
+        smtp_port       = Value(int),
+        addr_from       = Value(str),
+        addr_to         = Value(str),
+        triggers        = List(Value(str)),
+        rate_limit      = RATE_LIMIT,
+        consumer        = CONSUMER,
+        ),
+    alert_gcm = Section(False,
+        service_account = Value(str, False),
+        project_id      = Value(str, False),
+        api_key         = Value(str, False),
+        gateway         = Choice(('python', 'java'), False),
+        devices         = List(Value(str), False),
+        topic           = Value(str, False),
+        url             = Value(str, False),
+        triggers        = List(Value(str), False),
+        sender_id       = Value(str, False),
+        rate_limit      = RATE_LIMIT,
+        consumer        = CONSUMER,
+        ),
+    alert_plivo = Section(False,
+        auth_id         = Value(str),
+        auth_token      = Value(str),
+        call_from       = Value(str),
+        call_to         = List(Value(str)),
+        triggers        = List(Value(str)),
+        answer_url      = Value(str, False),
+        answer_port     = Value(int, False),
+        answer_bind     = Value(str, False),
+        api_url         = Value(str, False),
+        breaker         = BREAKER,
+        rate_limit      = RATE_LIMIT,
+        consumer        = CONSUMER,
+        ),
+    alert_url = Section(False,
+        urls            = List(Value(str)),
+        triggers        = List(Value(str)),
+        method          = Choice(('get', 'post'), False),
+        template        = Value(str, False),
+        batch           = Section(False,
+            max_size        = Value(int, False),
+            max_latency     = Value(float, False),
+            ),
+        breaker         = BREAKER,
+        rate_limit      = RATE_LIMIT,
+        consumer        = CONSUMER,
+        ),
+    )
+
+
+def locate():
+    # Explicit path from the environment, otherwise config.yaml in the current
+    # directory as always, falling back to the one next to the applications.
+    if os.environ.get('HOWALARMING_CONFIG'):
+        return os.environ['HOWALARMING_CONFIG']
+    if os.path.exists('config.yaml'):
+        return 'config.yaml'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')
+
+
+def cache_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.' + name + '.cache')
+
+
+def read(path):
+    # Returns the validated configuration, from the cache if it's current.
+    try:
+        stat = os.stat(path)
+    except OSError as err:
+        raise IOError(err.errno, err.strerror, path)
+
+    key = (CACHE_VERSION, stat.st_mtime, stat.st_size)
+    cache = cache_path(path)
+
+    try:
+        with open(cache, 'rb') as f:
+            cached_key, data = pickle.load(f)
+        if cached_key == key:
+            return data
+    except Exception:
+        pass
+
+    import yaml     # requires pyyaml third party package
+
+    try:
+        data = SCHEMA.check(yaml.safe_load(open(path, 'r')), '')
+    except yaml.YAMLError as err:
+        raise ConfigError('unable to parse ' + path + ': ' + str(err))
+
+    # Write to a temporary file and rename so concurrently starting
+    # applications never see a partial cache. Not being able to write the
+    # cache (eg read-only /etc) just means we parse the YAML every time.
+    try:
+        temp = cache + '.' + str(os.getpid())
+        with open(temp, 'wb') as f:
+            pickle.dump((key, data), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, cache)
+    except (IOError, OSError):
+        pass
+
+    return data
+
+
+class Config:
+
+    def __init__(self, path):
+        self.path = path
+        self.data = read(path)
+        self.listeners = []
+        self.pending = False
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def on_reload(self, callback):
+        # Callbacks are given the previous configuration data once the new
+        # configuration has been swapped in.
+        self.listeners.append(callback)
+
+    def install_reload_handler(self):
+        signal.signal(signal.SIGHUP, self.request_reload)
+
+    def request_reload(self, signum=None, frame=None):
+        self.pending = True
+
+    def poll(self):
+        # Apply a requested reload. Returns True if the configuration changed,
+        # raises ConfigError (leaving the current configuration in place) if
+        # the new file is invalid.
+        if not self.pending:
+            return False
+        self.pending = False
+
+        try:
+            data = read(self.path)
+        except IOError as err:
+            raise ConfigError('unable to read ' + self.path + ': ' + str(err))
+
+        previous = self.data
+        self.data = data
+        for callback in self.listeners:
+            callback(previous)
+        return True
+
+
+def load(path=None):
+    return Config(path or locate())
@@ -0,0 +1,609 @@
+#! /usr/bin/env python
+#
+# Shared runtime for the alarm consumer applications (alert_email, alert_url,
+# alert_plivo and the dispatcher). Takes care of loading the configuration,
+# connecting to the transport and reserving jobs from the application's tube,
+# leaving each application to provide a small Alerter class that actually
+# delivers the alert.
+#
+# A consumer can host several alerters (see dispatcher.py), in which case each
+# event is decoded once and handed to every alerter it's routed to (by the
+# `rules` section, see rules.py, or else the alerter's own triggers). If
+# only some of them fail, a new job is queued for just the failed alerters so
+# the others don't get sent the same alert twice. Likewise an alerter with
+# several destinations (URLs, phone numbers) raising a DeliveryError that
+# names the destinations that failed is only retried for those.
+#
+# Jobs are reserved by a pool of worker threads, each with it's own transport
+# connection (beanstalkc isn't thread safe). A job is only deleted once it has
+# been delivered - if the alerter raises, the job is released back onto the
+# tube with a delay and retried until it has been attempted max_attempts times,
+# at which point it's buried so it can be inspected and kicked once the fault
+# is resolved.
+#
+# An alerter raising Rejected has been refused outright (eg bad credentials),
+# the event is logged and dropped rather than retried.
+#
+# Each alerter has a ratelimit.Limiter (from it's `rate_limit` settings), which
+# is checked on the first delivery attempt of each event. Suppressed events
+# are acknowledged and counted, the next event to get through has the count
+# added to it's message. Retries (and spooled events) are never suppressed,
+# alerters limiting each destination skip that too by providing a `retry`
+# method.
+#
+# Long deliveries (eg waiting for a phone call to complete) are kept alive by
+# touching the job every half TTR so the queue doesn't hand it to another
+# worker. SIGTERM (or ^C) stops reserving new jobs and waits for the in-flight
+# deliveries to finish before exiting. SIGHUP reloads the configuration,
+# picking up changed rules, triggers and destinations without a restart.
+#
+# Events traced by envisalinkd (see tracing.py) have their trace block taken
+# off before delivery. With tracing enabled here too, it's stamped when the
+# job is reserved and once each alerter has delivered it, then logged.
+#
+# With more than one worker and `order_wait` set, events of the same zone or
+# partition are delivered in the order envisalinkd published them (see
+# ordering.py), waiting up to `order_wait` seconds for an earlier event still
+# being reserved. Off by default, it holds a zone's events back one at a time,
+# so a batching alert_url can't collect a zone's burst into one request.
+# Events missing from the tube are logged as lost either way.
+#
+# With a `spool_dir` set, events an alerter fails to deliver are written to
+# that alerter's spool on disk (see spool.py) and the job deleted, rather than
+# retried through the queue. A retrier thread per alerter delivers the spool
+# oldest first, backing off from retry_delay while the alerter keeps failing,
+# whilst new events are still delivered straight away.
+#
+
+import startup
+import os
+import sys
+import json
+import signal
+import threading
+import config
+import rules
+import breaker
+import ordering
+import ratelimit
+import spool
+import tracing
+import transport
+
+
+# Runtime defaults, overridden by the `consumer` section of the configuration
+# and then by a `consumer` block inside the application's own section.
+DEFAULTS = {
+    'workers':      1,      # jobs delivered concurrently
+    'retry_delay':  30,     # seconds before retrying, multiplied by attempt
+    'max_attempts': 5,      # deliveries attempted before burying the job
+    'order_wait':   0,      # seconds to wait for an earlier event of the same zone, 0 to not keep order
+    'spool_dir':    None,   # spool failed deliveries here, rather than retrying through the queue
+    'spool_max_bytes': spool.DEFAULT_MAX_BYTES,
+    'metrics_port': None,   # serve the sinks' circuit breaker metrics on 127.0.0.1
+    }
+
+# Longest wait between attempts to deliver a spool.
+SPOOL_BACKOFF_MAX = 300
+
+printMutex = threading.Lock()
+
+
+def log(msg):
+    # Workers log concurrently, so serialise output to keep lines intact.
+    printMutex.acquire()
+    try:
+        print msg
+    finally:
+        printMutex.release()
+
+
+class DeliveryError(Exception):
+    # Raised by alerters when an alert could not be delivered and should be
+    # retried later. destinations lists those that failed, if the others
+    # were delivered to and shouldn't be sent it again.
+
+    def __init__(self, message, destinations=None):
+        Exception.__init__(self, message)
+        self.destinations = destinations
+
+
+class Rejected(Exception):
+    # Raised by alerters when an alert was refused outright (eg bad
+    # credentials), so retrying can't help. The event is logged and dropped.
+    pass
+
+
+def retry(alerter, alarm_event, body, destinations=None):
+    # Deliver an event again, to just destinations if the alerter said which
+    # failed. Alerters with several destinations have a retry method taking
+    # them, which also doesn't limit each destination (see ratelimit.py), the
+    # event was admitted on it's first attempt.
+    if hasattr(alerter, 'retry'):
+        alerter.retry(alarm_event, body, destinations)
+    else:
+        alerter.handle(alarm_event, body)
+
+
+class Keepalive(threading.Thread):
+    # Touches a reserved job every interval seconds until stopped, so that
+    # slow deliveries don't exceed the job's TTR and get handed to another
+    # worker mid-delivery.
+
+    def __init__(self, job, interval):
+        threading.Thread.__init__(self)
+        self.daemon   = True
+        self.job      = job
+        self.interval = interval
+        self.done     = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            try:
+                self.job.touch()
+            except (transport.TransportError, transport.JobLost):
+                return
+
+    def stop(self):
+        # The worker thread owns the connection, so we must have finished
+        # touching before it goes on to delete/release the job.
+        self.done.set()
+        self.join()
+
+
+class Consumer:
+
+    def __init__(self, name, alerter_class=None, settings=None):
+        self.name = name
+        self.alerter_class = alerter_class
+
+        # Load configuration from YAML file and assign configuration values,
+        # unless we're being hosted by an application that already has.
+        try:
+            self.config         = settings or config.load()
+            startup.phase('config')
+
+            # Message Queue settings
+            self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
+            self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
+
+            # Make sure the queue we listen to exists
+            if name not in self.beanstalk_tubes_events:
+                log("Fatal: Config must define the " + name + " event queue for this application.")
+                raise BaseException
+
+            # Runtime settings
+            self.load_settings()
+
+            # Application specific settings are read by the alerters themselves
+            alerters            = self.load_alerters()
+            self.prepare(alerters)
+            self.routing        = (alerters, self.load_rules(alerters))
+            startup.phase('alerters')
+
+        except IOError:
+            log('Fatal: Could not open configuration file')
+            raise
+
+        except config.ConfigError as err:
+            log('Fatal: Invalid configuration, ' + str(err))
+            raise
+
+        except (KeyError, AttributeError) as err:
+            log('Fatal: Unable to find required configuration in config.yaml')
+            raise
+
+        # Changes to tracing apply on restart.
+        try:
+            self.tracer = tracing.recorder(self.config)
+        except IOError as err:
+            log('Fatal: Could not open trace log, ' + str(err))
+            raise
+
+        self.stopping = threading.Event()
+        self.failed = False
+        self.terminated = False
+        self.threads = []
+        self.spools = {}
+        self.spools_lock = threading.Lock()
+
+        # Order only needs keeping with workers delivering side by side,
+        # gaps are always looked for.
+        self.gaps = ordering.Gaps(log)
+        self.sequencer = None
+        if self.workers > 1 and self.order_wait > 0:
+            self.sequencer = ordering.Sequencer(self.order_wait, log)
+
+        self.config.on_reload(self.reload)
+
+
+    def load_settings(self):
+        settings = dict(DEFAULTS)
+        settings.update(self.config.get('consumer') or {})
+        settings.update((self.config.get(self.name) or {}).get('consumer') or {})
+
+        self.workers        = int(settings['workers'])
+        self.retry_delay    = int(settings['retry_delay'])
+        self.max_attempts   = int(settings['max_attempts'])
+        self.order_wait     = float(settings['order_wait'])
+        self.spool_dir      = settings['spool_dir']
+        self.spool_max_bytes = int(settings['spool_max_bytes'])
+        self.metrics_port   = settings['metrics_port']
+
+
+    def load_alerters(self):
+        # List of (name, alerter) pairs each event is handed to. A standalone
+        # application just has it's own.
+        return [(self.name, self.alerter_class(self.config[self.name]))]
+
+
+    def prepare(self, alerters):
+        # Tell the alerters that care how many events are delivered at once
+        # (eg to batch them).
+        for name, alerter in alerters:
+            if hasattr(alerter, 'concurrency'):
+                alerter.concurrency(self.workers)
+
+
+    def load_rules(self, alerters):
+        # Routing from the `rules` section, falling back to each alerter's own
+        # triggers for those no rule names.
+        return rules.Rules(self.config.get('rules'), dict((name, alerter.triggers) for name, alerter in alerters))
+
+
+    def reload(self, previous):
+        # Swap in alerters and rules built from the new configuration, together
+        # so a worker never routes with one and delivers with the other.
+        # Workers pick them up from their next job, in-flight deliveries
+        # finish with the old.
+        workers = self.workers
+        try:
+            alerters = self.load_alerters()
+            self.prepare(alerters)
+            routes = self.load_rules(alerters)
+            self.load_settings()
+        except (KeyError, AttributeError, ImportError, config.ConfigError) as err:
+            log('Warning: Unable to apply reloaded configuration, keeping current settings: ' + str(err))
+            return
+
+        current = dict(self.routing[0])
+        for name, alerter in alerters:
+            if name in current:
+                alerter.limiter.inherit(current[name].limiter)
+
+        self.routing = (alerters, routes)
+        log('system: configuration reloaded')
+
+        if self.workers != workers:
+            log('system: worker count changes apply on restart')
+            self.workers = workers
+
+
+    def connect(self):
+        try:
+            queue = transport.connect(self.config)
+            queue.watch([self.name])
+            return queue
+        except transport.TransportError as err:
+            log("Fatal: Unable to connect to " + transport.describe(self.config) + ": " + str(err))
+            raise
+
+
+    def worker(self):
+        try:
+            queue = self.connect()
+        except transport.TransportError:
+            self.fail()
+            return
+
+        try:
+            while not self.stopping.is_set():
+                # Short timeout so we notice when asked to stop.
+                job = queue.reserve(timeout=1)
+                if job:
+                    reserved = tracing.clock() if self.tracer else None
+                    try:
+                        self.process(queue, job, reserved)
+                    except transport.JobLost as err:
+                        log('Warning: lost job ' + str(job.jid) + ', it will be delivered again: ' + str(err))
+        except transport.TransportError as err:
+            log('system: transport error ' + str(err))
+            self.fail()
+        finally:
+            queue.close()
+
+
+    def process(self, queue, job, reserved=None):
+        # Event recieved, is it on the list of types we care about?
+        try:
+            alarm_event = json.loads(job.body)
+            event_type = alarm_event['type']
+        except (ValueError, KeyError, TypeError):
+            log("Warning: Unable to process message, invalid JSON, burying: " + job.body)
+            job.bury()
+            return
+
+        stats = job.stats()
+        attempt = stats['releases'] + 1
+        body = job.body
+        if attempt == 1:
+            self.gaps.arrived(alarm_event)
+
+        alerters, routes = self.routing
+
+        # Jobs we queued for redelivery to a subset of alerters carry the
+        # list of alerters outstanding, the attempts made so far and the
+        # destinations outstanding of alerters that said.
+        redeliver = alarm_event.pop('redeliver', None)
+        if redeliver:
+            attempt += redeliver['attempt']
+            body = json.dumps(alarm_event)
+
+        # The trace block isn't for the alerters.
+        trace = alarm_event.pop('trace', None)
+        if trace is not None:
+            body = json.dumps(alarm_event)
+            if reserved is not None:
+                trace['reserve'] = reserved
+
+        routed = routes.route(alarm_event)
+        targets = []
+        for name, alerter in alerters:
+            if redeliver and name not in redeliver['sinks']:
+                continue
+            if name in routed:
+                targets.append((name, alerter))
+
+        if not targets:
+            log('Non-alerting event, ignoring (type: '+ event_type +')')
+            job.delete()
+            return
+
+        keepalive = Keepalive(job, max(1, stats['ttr'] / 2))
+        keepalive.start()
+        ticket = None
+        try:
+            if self.sequencer and attempt == 1:
+                ticket = self.sequencer.begin(alarm_event)
+            failed, destinations = self.deliver(targets, alarm_event, body, attempt, trace, (redeliver or {}).get('destinations'))
+        finally:
+            if ticket:
+                self.sequencer.end(ticket)
+            keepalive.stop()
+
+        if failed and self.spool_dir:
+            failed = self.store(failed, alarm_event, body, stats['pri'], destinations)
+            destinations = dict((name, destinations[name]) for name in failed if name in destinations)
+
+        if not failed:
+            job.delete()
+        elif attempt >= self.max_attempts:
+            log('Warning: giving up on delivery to ' + ', '.join(failed) + ', burying job ' + str(job.jid))
+            job.bury(priority=stats['pri'])
+        elif len(failed) == len(targets) and not destinations:
+            job.release(priority=stats['pri'], delay=self.retry_delay * attempt)
+        else:
+            alarm_event['redeliver'] = {'sinks': failed, 'attempt': attempt}
+            if destinations:
+                alarm_event['redeliver']['destinations'] = destinations
+            queue.put([self.name], json.dumps(alarm_event), priority=stats['pri'], delay=self.retry_delay * attempt, ttr=stats['ttr'])
+            job.delete()
+
+
+    def deliver(self, targets, alarm_event, body, attempt, trace=None, outstanding=None):
+        # Hand the event to each alerter (retrying just their outstanding
+        # destinations, if known), returning the names of those that failed
+        # and the destinations that failed of those that said. Alerters run
+        # side by side so a slow one (eg a phone call) doesn't hold up the
+        # rest.
+        outstanding = outstanding or {}
+        failed = []
+        destinations = {}
+
+        def handle(name, alerter):
+            # Retries were already admitted by the limiter first time round.
+            suppressed = 0
+            if attempt == 1:
+                suppressed = alerter.limiter.admit(alarm_event)
+                if suppressed is None:
+                    log('system: ' + name + ' rate limited, suppressing ' + alarm_event['type'] + ' event')
+                    return
+
+            try:
+                if suppressed:
+                    event = ratelimit.annotate(alarm_event, suppressed)
+                    alerter.handle(event, json.dumps(event))
+                elif attempt > 1:
+                    retry(alerter, alarm_event, body, outstanding.get(name))
+                else:
+                    alerter.handle(alarm_event, body)
+                alerter.limiter.reported(suppressed)
+                if trace is not None and self.tracer:
+                    self.tracer.record(trace, name)
+            except Rejected as err:
+                log('Warning: ' + name + ' rejected ' + alarm_event['type'] + ' event, dropping it: ' + str(err))
+            except Exception as err:
+                log('Warning: ' + name + ' delivery attempt ' + str(attempt) + ' of ' + str(self.max_attempts) + ' failed: ' + str(err))
+                failed.append(name)
+                if isinstance(err, DeliveryError) and err.destinations:
+                    destinations[name] = err.destinations
+
+        if len(targets) == 1:
+            handle(*targets[0])
+        else:
+            threads = [threading.Thread(target=handle, args=target) for target in targets]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return failed, destinations
+
+
+    def spool(self, name):
+        # The named alerter's spool, opened (and it's retrier started) on
+        # first use.
+        self.spools_lock.acquire()
+        try:
+            if name not in self.spools:
+                self.spools[name] = spool.Spool(os.path.join(self.spool_dir, name + '.spool'), self.spool_max_bytes)
+                thread = threading.Thread(target=self.retrier, args=(name, self.spools[name]))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            return self.spools[name]
+        finally:
+            self.spools_lock.release()
+
+
+    def store(self, failed, alarm_event, body, priority, destinations=None):
+        # Spool the event for each alerter that failed (with the destinations
+        # that failed, if it said), returning those it couldn't be spooled
+        # for, which are left to the queue to retry.
+        destinations = destinations or {}
+        spooled = []
+        remaining = []
+        for name in failed:
+            entry = body
+            if name in destinations:
+                entry = json.dumps(dict(alarm_event, redeliver={'destinations': destinations[name]}))
+            try:
+                for evicted in self.spool(name).add(entry, priority):
+                    log('Warning: ' + name + ' spool full, dropping ' + evicted)
+            except (IOError, OSError) as err:
+                log('Warning: Unable to spool ' + alarm_event['type'] + ' event for ' + name + ', retrying through the queue: ' + str(err))
+                remaining.append(name)
+                continue
+            spooled.append(name)
+        if spooled:
+            log('system: spooled ' + alarm_event['type'] + ' event for ' + ', '.join(spooled))
+        return remaining
+
+
+    def retrier(self, name, events):
+        # Deliver the alerter's spool in order, waiting longer after each
+        # failure until it's delivered again.
+        backoff = self.retry_delay
+        while not self.stopping.is_set():
+            entry = events.oldest(timeout=1)
+            if entry is None:
+                continue
+            jid, body = entry
+            alarm_event = json.loads(body)
+            redeliver = alarm_event.pop('redeliver', None)
+            if redeliver:
+                body = json.dumps(alarm_event)
+
+            # Whichever alerter has the name now, it may have been reloaded.
+            alerter = dict(self.routing[0]).get(name)
+            try:
+                if alerter is None:
+                    raise DeliveryError('no longer configured')
+                retry(alerter, alarm_event, body, (redeliver or {}).get('destinations'))
+            except Rejected as err:
+                log('Warning: ' + name + ' rejected spooled ' + alarm_event['type'] + ' event, dropping it: ' + str(err))
+            except Exception as err:
+                if isinstance(err, DeliveryError) and err.destinations:
+                    # Only those still failing are tried next time.
+                    try:
+                        events.replace(jid, json.dumps(dict(alarm_event, redeliver={'destinations': err.destinations})))
+                    except (IOError, OSError) as spool_err:
+                        log('Warning: Unable to update ' + name + ' spool, retrying every destination: ' + str(spool_err))
+                log('Warning: ' + name + ' spool delivery failed, ' + str(len(events)) + ' events waiting, next attempt in ' + str(backoff) + 's: ' + str(err))
+                self.stopping.wait(backoff)
+                backoff = min(backoff * 2, SPOOL_BACKOFF_MAX)
+                continue
+
+            events.done(jid)
+            backoff = self.retry_delay
+            if not len(events):
+                log('system: ' + name + ' spool delivered')
+
+
+    def fail(self):
+        # A worker lost the queue, take the whole application down and let
+        # init respawn us, same as any other socket error.
+        self.failed = True
+        self.stopping.set()
+
+
+    def terminate(self, signum, frame):
+        # Logged once the main loop notices, the signal can arrive whilst
+        # the main thread is inside log holding printMutex.
+        self.terminated = True
+        self.stopping.set()
+
+
+    def start(self):
+        # Start the workers without blocking, for hosting inside another
+        # application's process.
+        if self.spool_dir:
+            try:
+                if not os.path.isdir(self.spool_dir):
+                    os.makedirs(self.spool_dir)
+                # Pick up events spooled before a restart.
+                for name, alerter in self.routing[0]:
+                    if os.path.exists(os.path.join(self.spool_dir, name + '.spool')):
+                        self.spool(name)
+            except (IOError, OSError) as err:
+                log('Fatal: Unable to open spool in ' + self.spool_dir + ', ' + str(err))
+                raise
+
+        if self.metrics_port:
+            breaker.registry.serve(self.metrics_port)
+            log('system: metrics available on http://127.0.0.1:' + str(self.metrics_port) + '/metrics')
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def run(self, ready_message):
+        signal.signal(signal.SIGTERM, self.terminate)
+        self.config.install_reload_handler()
+
+        if startup.enabled:
+            try:
+                self.connect().close()
+            except transport.TransportError:
+                pass
+            startup.phase('queue connect')
+            startup.finish()
+
+        self.start()
+        log(ready_message)
+
+        # Wait with a timeout, otherwise signals don't get delivered to the
+        # main thread under Python 2.
+        try:
+            while not self.stopping.is_set():
+                self.stopping.wait(1)
+
+                try:
+                    self.config.poll()
+                except config.ConfigError as err:
+                    log('Warning: Unable to reload configuration, keeping current settings: ' + str(err))
+
+        except KeyboardInterrupt:
+            log('system: User Terminated, finishing in-flight alerts')
+            self.stopping.set()
+
+        if self.terminated:
+            log('system: SIGTERM received, finishing in-flight alerts')
+
+        for thread in self.threads:
+            thread.join()
+
+        if self.failed:
+            sys.exit(1)
+
+
+def run(name, alerter_class, ready_message):
+    startup.phase('imports')
+
+    # Unbuffered Logging
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+    Consumer(name, alerter_class).run(ready_message)
@@ -0,0 +1,62 @@
+#! /usr/bin/env python
+#
+# Hosts several of the alert applications inside a single process. Rather than
+# running alert_email, alert_url, alert_plivo etc each with their own Python
+# interpreter, beanstalkd connection and event tube, the dispatcher reserves
+# events from the single `dispatcher` tube, decodes each one once and hands it
+# to every configured alert sink whose triggers match.
+#
+# Sinks are loaded as plugins from the modules named in the config, and only
+# the ones listed are imported - so the libraries for a sink you don't use are
+# never loaded. Each sink reads it's settings from it's usual config section.
+#
+# With the `inprocess` transport, envisalinkd hosts the dispatcher itself and
+# events are handed straight from the alarm to the sinks without leaving the
+# process - there's no need to run dispatcher.py separately.
+#
+# Only run a sink in one place - if a sink is listed here, don't also run it
+# standalone or list it's tube in the beanstalkd events config, otherwise you
+# will receive each alert twice.
+#
+
+import startup     # must be first, times the imports that follow
+import os
+import sys
+import importlib
+import consumer
+
+
+class Dispatcher(consumer.Consumer):
+
+    def __init__(self, settings=None):
+        consumer.Consumer.__init__(self, 'dispatcher', settings=settings)
+
+
+    def load_alerters(self):
+        alerters = []
+
+        for sink in self.config['dispatcher']['sinks']:
+            try:
+                module = importlib.import_module(sink)
+            except ImportError as err:
+                consumer.log('Fatal: Unable to load sink ' + str(sink) + ': ' + str(err))
+                raise
+
+            if not hasattr(module, 'Alerter'):
+                consumer.log('Fatal: ' + str(sink) + ' can not be hosted by the dispatcher, run it standalone instead.')
+                raise BaseException
+
+            alerters.append((sink, module.Alerter(self.config[sink])))
+
+        return alerters
+
+
+
+if __name__ == '__main__':
+    startup.phase('imports')
+
+    # Unbuffered Logging
+    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+    d = Dispatcher()
+    d.run('system: dispatching alerts to ' + ', '.join(name for name, alerter in d.routing[0]))
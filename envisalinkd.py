@@ -6,56 +6,201 @@
 # exchange commands and alerts to/from the configured beanstalk tubes to be
 # used by other applications.
 #
+# Every event is also published to a live feed on a Unix domain socket (see
+# tail.py), for any number of `cli.py --tail` viewers.
+#
+# The state of the zones, partitions and keypad is kept up to date from the
+# events, and with `query_port` set can be read over HTTP along with recent
+# events (see query.py), or with `state_map` set read straight from a memory
+# mapped file by local tools (see statemap.py).
+#
+# Frames that only repeat the panel's last known state, as when it answers a
+# status request, aren't published. That state is saved as it changes and
+# loaded at startup (see panelstate.py).
+#
+# The panel's answer to a status request (001) is collected and published as
+# one `snapshot` event holding every zone and partition, rather than an event
+# per frame, unless `status_frames` is set. Changes of the types sinks alert
+# on are published on their own too.
+#
+# Zone open/close activity is summarised by zonestats.py, seeded from the
+# panel's zone timer dump and saved periodically.
+#
+# With the `trace` section enabled, events carry a trace block stamped as
+# their frame is received, decoded and published (see tracing.py).
+#
+# Every event carries sequence numbers, overall, for it's zone or partition
+# and for each tube it's put on, so consumers can keep a zone's events in
+# order across workers and spot lost events (see ordering.py).
+#
+# Events are published from a thread of it's own, with it's own connection to
+# the queue, fed by a bounded queue that never blocks. Neither the main loop
+# nor the poll timer thread waits on the queue, so a slow beanstalkd can't
+# hold up writes to the alarm, and the connection is never shared between
+# threads.
+#
+# The tubes live on beanstalkd by default, see transport.py for the
+# alternatives. With the `inprocess` transport the dispatcher is hosted in
+# this process, so events reach the alert sinks without leaving it.
+#
 # Based on source code by dumbo25 at https://github.com/dumbo25/ev3_cmd
 #
 
+import startup     # must be first, times the imports that follow
 import os
+import mmap
 import socket
 import sys
 import time
 import datetime
 import string
-import re
-import signal
-import select
 import threading
 import json
-import yaml         # requires pyyaml third party package
-import beanstalkc   # requires beanstalkc third party package
+import collections
+import config
+import panelstate
+import priority
+import query
+import rules
+import statemap
+import tail
+import tracing
+import transport
+import zonestats
 
 # Unbuffered Logging
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
+
+# Responses whose message is fixed by their code, or by the zone and/or
+# partition they carry. These are expanded into lookup tables for every
+# configured zone and partition when the configuration is loaded, so decoding
+# a frame is a dictionary lookup rather than assembling the message each time.
+FIXED = {
+    '501': ('fault',    'command error, bad checksum'),
+    '560': ('info',     'ring detected'),
+    '615': ('info',     'received [615]: zone timer dump'),
+    '620': ('alarm',    'duress alarm'),
+    '621': ('alarm',    'fire key alarm detected'),
+    '622': ('recovery', 'fire key alarm restored'),
+    '623': ('alarm',    'auxillary key alarm detected'),
+    '624': ('recovery', 'auxillary key alarm restored'),
+    '625': ('alarm',    'panic key detected'),
+    '626': ('recovery', 'panic key restored'),
+    '631': ('alarm',    'smoke/aux alarm detected'),
+    '632': ('recovery', 'smoke/aux alarm restored'),
+    '680': ('alarm',    'system in installer\'s mode'),
+    '800': ('fault',    'closet panel battery trouble'),
+    '801': ('fault',    'closet panel battery restore'),
+    '802': ('fault',    'closet panel AC trouble'),
+    '803': ('fault',    'closet panel AC retored'),
+    '806': ('fault',    'bell trouble'),
+    '807': ('fault',    'bell restored'),
+    '814': ('fault',    'closet panel failed to communicate with monitoring'),
+    '816': ('fault',    'buffer near full'),
+    '829': ('alarm',    'general system tamper'),
+    '830': ('recovery', 'general system tamper cleared'),
+    '842': ('alarm',    'fire trouble alarm'),
+    '843': ('recovery', 'fire trouble alarm cleared'),
+    '912': ('response', 'command output pressed'),
+    '921': ('response', 'master code required'),
+    '922': ('response', 'installer\'s code required'),
+    }
+
+# Partition digit followed by zone
+PARTITION_ZONE = {
+    '601': ('alarm',    'alarm. partition = %(partition)s zone = %(zone)s'),
+    '602': ('recovery', 'alarm cleared. partition = %(partition)s zone = %(zone)s'),
+    '603': ('alarm',    'tamper. partition = %(partition)s zone = %(zone)s'),
+    '604': ('recovery', 'tamper cleared. partition = %(partition)s zone = %(zone)s'),
+    }
+
+ZONE = {
+    '605': ('alarm',    'zone %(zone)s fault'),
+    '606': ('recovery', 'zone %(zone)s fault cleared'),
+    '609': ('info',     'zone %(zone)s open'),
+    '610': ('info',     'zone %(zone)s closed'),
+    }
+
+PARTITION = {
+    '650': ('info',     'partition %(partition)s ready'),
+    '651': ('info',     'partition %(partition)s not ready'),
+    '653': ('info',     'partition %(partition)s forcing alarm enabled'),
+    '654': ('alarm',    'partition %(partition)s in alarm'),
+    '655': ('disarmed', 'partition %(partition)s disarmed'),
+    '656': ('armed',    'partition %(partition)s exit delay'),
+    '657': ('info',     'partition %(partition)s entry delay'),
+    '658': ('alarm',    'partition %(partition)s keypad lockout'),
+    '659': ('fault',    'partition %(partition)s failed to arm'),
+    '660': ('info',     'partition %(partition)s PGM output'),
+    '663': ('info',     'partition %(partition)s chime enabled'),
+    '664': ('info',     'partition %(partition)s chime disabled'),
+    '670': ('alarm',    'partition %(partition)s invalid access code'),
+    '671': ('fault',    'partition %(partition)s function not available'),
+    '672': ('fault',    'partition %(partition)s failure to arm'),
+    '673': ('fault',    'partition %(partition)s is busy'),
+    '674': ('info',     'partition %(partition)s is arming'),
+    '700': ('info',     'partition = %(partition)sarmed by user'),
+    '701': ('info',     'partition %(partition)s armed by method'),
+    '702': ('info',     'partition %(partition)s armed but zone(s) bypassed'),
+    '750': ('info',     'partition %(partition)s disarmed by user'),
+    '751': ('info',     'partition %(partition)s partition disarmed by method'),
+    '840': ('fault',    'partition %(partition)s trouble LED on'),
+    '841': ('info',     'partition %(partition)s trouble LED off'),
+    }
+
+# Partition digit followed by the arming mode
+PARTITION_MODE = {
+    '652': ('armed',    'partition %(partition)s armed, mode = %(mode)s'),
+    }
+
+# Seconds to wait for a status report to start, and for it to go quiet before
+# it's published as a snapshot.
+SNAPSHOT_WAIT = 5.0
+SNAPSHOT_QUIET = 1.0
+
+# Types the sinks alert on, published even whilst a status report is being
+# collected into a snapshot, which no sink's triggers match.
+SNAPSHOT_ALERTING = ('alarm', 'fault', 'recovery', 'armed', 'disarmed')
+
+# Events waiting for the publisher thread before some are dropped, info
+# events first. Alarm, fault and recovery events are never dropped, they're
+# let in over the limit when there's nothing less important to make room.
+PUBLISH_BACKLOG = 10000
+PUBLISH_KEEP = ('alarm', 'fault', 'recovery')
+
+# Two hex digit bitmasks, lowest bit first
+LEDS = ('ready ', 'armed ', 'memory ', 'bypass ', 'trouble ', 'program ', 'fire ', 'backlight ')
+TROUBLES = ('service required | ', 'AC power lost | ', 'telephone line fault (ignore) | ', 'failure to communicate | ',
+            'sensor/zone fault | ', 'sensor zone tamper | ', 'low battery ', '')
+
+BITMASK = {
+    '510': ('info',     'lit keypad LEDs = ', LEDS),
+    '511': ('info',     'flashing keypad LEDs = ', LEDS),
+    '849': ('fault',    'verbose trouble status = ', TROUBLES),
+    }
+
 class Envisalink:
     def __init__(self):
         # Load configuration from YAML file and assign configuration values.
         try:
-            self.config         = yaml.load(open('config.yaml', 'r'))
+            self.config         = config.load()
 
             # General Envislink/Alarm Settings
             self.host           = self.config['envisalinkd']['host']
-            self.port           = int(self.config['envisalinkd']['port'])
+            self.port           = self.config['envisalinkd']['port']
             self.password       = self.config['envisalinkd']['password']
-            self.code_master    = self.config['envisalinkd']['code_master']
-            self.code_installer = self.config['envisalinkd']['code_installer']
-            self.zones          = self.config['envisalinkd']['zones']
-
-            # Because the zone ids are 3 digit long ints, if the user hasn't
-            # quoted them in the YAML, they get convered to ints and then
-            # break. Hence we convert them to strings and pad with zeros to
-            # support either int or string input.
-            self.zones = {str(k).zfill(3):str(v) for k,v in self.zones.items()}
-
-            # Beanstalkd Message Queue settings
-            self.beanstalk_host             = self.config['beanstalkd']['host']
-            self.beanstalk_port             = int(self.config['beanstalkd']['port'])
-            self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
-            self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
+
+            self.loadConfig()
 
         except IOError:
             print 'Fatal: Could not open configuration file'
             raise
 
+        except config.ConfigError as err:
+            print 'Fatal: Invalid configuration, ' + str(err)
+            raise
+
         except (KeyError, AttributeError) as err:
             print 'Fatal: Unable to find required configuration in config.yaml'
             raise
@@ -66,11 +211,42 @@ class Envisalink:
         self.max_poll_retries = 3
         self.poll_retries = 0
         self.max_partitions = 1
-        self.max_zones = len(self.zones.keys())
         self.sleep = 0
+        self.received = None # When the last frame arrived, for tracing
+        self.snapshot_until = None # Status report collected until
         self.file_log = sys.stdout # Use STDOUT for all logging
         self.printMutex = threading.Lock()
         self.socketMutex = threading.Lock()
+        self.statemap = None
+
+        # Sequence numbers, start again with each run.
+        self.run = int(time.time() * 1000)
+        self.sequence = 0
+        self.tube_sequences = {}     # tube -> last number
+        self.stream_sequences = {}   # (tube, stream) -> last number
+
+        # Events waiting to be published. deque appends and pops are atomic,
+        # so any thread can add to it without taking a lock, only dropping
+        # events once it's full does.
+        self.outbox = collections.deque()
+        self.outbox_ready = threading.Event()
+        self.outbox_lock = threading.Lock()
+        self.outbox_dropped = 0
+        self.publisher = None
+        self.publisher_stopping = False
+        self.publisher_error = None
+
+        # Panel state and zone statistics from the last run.
+        self.state = query.State(LEDS)
+        self.panelstate = panelstate.PanelState(self.config['envisalinkd'].get('state_file', panelstate.DEFAULT_PATH))
+        if self.panelstate.load():
+            for event in self.panelstate.events():
+                self.state.apply(event)
+            self.printNormal('system: loaded panel state from ' + self.panelstate.path)
+        self.zonestats = zonestats.ZoneStats(self.config['envisalinkd'].get('zone_stats', zonestats.DEFAULT_PATH))
+        self.zonestats_saved = time.time()
+        if self.zonestats.load():
+            self.printNormal('system: loaded zone statistics from ' + self.zonestats.path)
 
         # Are modes always the same across alarms, or are they configurable? For now, treating as a fixed value.
         self.modes = {'0' : 'Away', '1' : 'Stay in house', '2' : 'Zero entry away', '3' : 'Zero entry stay in house'}
@@ -193,13 +369,163 @@ class Envisalink:
             '027' : 'API invalid characters'
             }
 
+        self.buildDecoders()
+
+
+    def loadConfig(self):
+        # Settings that can be changed whilst running, applied at startup and
+        # again whenever the configuration is reloaded.
+        self.code_master    = self.config['envisalinkd']['code_master']
+        self.code_installer = self.config['envisalinkd']['code_installer']
+        self.zones          = self.config['envisalinkd']['zones']
+        self.max_zones      = len(self.zones.keys())
+
+        self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
+        self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
+
+        if hasattr(self, 'beanstalk'):
+            self.beanstalk.watch(self.beanstalk_tubes_commands)
+
+        # Life-safety events get reserved ahead of any informational backlog
+        self.priorities = priority.Policy(self.config.get('priorities'))
+
+        # Events are only queued for the sinks the rules route them to, tubes
+        # not named by any rule (eg cli, dispatcher) get everything.
+        self.routes = rules.Rules(self.config.get('rules'))
+
+        self.status_frames = self.config['envisalinkd'].get('status_frames', False)
+
+        self.tracing = bool((self.config.get('trace') or {}).get('enabled'))
+
+    def buildDecoders(self):
+        # Lookup tables for decodeResponse, cmd -> (start, end, table) where
+        # table maps word[start:end] to (event type, message, zone).
+        # As reported by the panel, partition 0 included.
+        partitions = [str(partition) for partition in range(self.max_partitions + 1)]
+
+        # Only zones within the count configured are reported, and zone ids
+        # are interned so every event for a zone shares the one string.
+        zones = {}
+        for zone, name in self.zones.items():
+            if zone.isdigit() and int(zone) <= self.max_zones:
+                zones[intern(zone)] = name
+
+        decoders = {}
+        for cmd, (event_type, msg) in FIXED.items():
+            decoders[cmd] = (3, 3, {'': (event_type, msg, None)})
+
+        for cmd, (event_type, template) in ZONE.items():
+            decoders[cmd] = (3, 6, dict((zone, (event_type, template % {'zone': name}, zone)) for zone, name in zones.items()))
+
+        for cmd, (event_type, template) in PARTITION_ZONE.items():
+            decoders[cmd] = (3, 7, dict((partition + zone, (event_type, template % {'partition': partition, 'zone': name}, zone))
+                                        for partition in partitions for zone, name in zones.items()))
+
+        for cmd, (event_type, template) in PARTITION.items():
+            decoders[cmd] = (3, 4, dict((partition, (event_type, template % {'partition': partition}, None)) for partition in partitions))
+
+        for cmd, (event_type, template) in PARTITION_MODE.items():
+            decoders[cmd] = (3, 5, dict((partition + mode, (event_type, template % {'partition': partition, 'mode': name}, None))
+                                        for partition in partitions for mode, name in self.modes.items()))
+
+        for cmd, (event_type, prefix, bits) in BITMASK.items():
+            table = {}
+            for value in range(256):
+                decoded = (event_type, prefix + ''.join(bits[bit] for bit in range(8) if value & (1 << bit)), None)
+                table['%02X' % value] = table['%02x' % value] = decoded
+            decoders[cmd] = (3, 5, table)
+
+        self.decoders = decoders
+        self.zonestats.configured = frozenset(zones)
+        self.armed_leds = frozenset(key for value in range(256) if value & 0x02 for key in ('%02X' % value, '%02x' % value))
+
+    def reloadConfig(self, previous):
+        # Applied in place so the TPI session stays logged in.
+        self.loadConfig()
+        self.buildDecoders()
+        self.printNormal('system: configuration reloaded')
+
+        for section, keys in (('envisalinkd', ('host', 'port', 'password', 'tail_socket', 'tail_history', 'query_port', 'zone_stats', 'state_file')), ('beanstalkd', ('host', 'port')), ('transport', ('backend', 'socket'))):
+            for key in keys:
+                if (previous.get(section) or {}).get(key) != (self.config.get(section) or {}).get(key):
+                    self.printNormal('system: change to ' + section + '.' + key + ' applies on restart')
+
+    def savePanelState(self):
+        # Saved soon after every change, a no-op when there's none.
+        try:
+            self.panelstate.save()
+        except (IOError, OSError) as err:
+            self.printNormal('system: unable to save panel state to ' + self.panelstate.path + ': ' + str(err))
+
+    def saveZoneStats(self, force=False):
+        interval = self.config['envisalinkd'].get('zone_stats_interval', zonestats.DEFAULT_INTERVAL)
+        if not force and time.time() - self.zonestats_saved < interval:
+            return
+        self.zonestats_saved = time.time()
+        try:
+            self.zonestats.save()
+        except (IOError, OSError) as err:
+            self.printNormal('system: unable to save zone statistics to ' + self.zonestats.path + ': ' + str(err))
+
+    def checkConfig(self):
+        try:
+            self.config.poll()
+        except config.ConfigError as err:
+            self.printNormal('system: unable to reload configuration, keeping current settings: ' + str(err))
 
     def beanstalk_connect(self):
         try:
-            self.beanstalk = beanstalkc.Connection(host=self.beanstalk_host, port=self.beanstalk_port)
-            self.printNormal('system: Beanstalkd connected on ' + str(self.beanstalk_host) + ' on port ' + str(self.beanstalk_port))
-        except socket.error, (value,message):
-            self.printFatal(message)
+            self.beanstalk = transport.connect(self.config)
+            self.beanstalk.watch(self.beanstalk_tubes_commands)
+            self.printNormal('system: connected to ' + transport.describe(self.config))
+        except transport.TransportError as err:
+            self.printFatal(str(err))
+
+    def tail_start(self):
+        settings = self.config['envisalinkd']
+        self.feed = tail.Feed(settings.get('tail_socket', tail.DEFAULT_SOCKET), settings.get('tail_history', tail.DEFAULT_HISTORY))
+        try:
+            self.feed.start()
+            self.printNormal('system: live feed on ' + self.feed.path)
+        except socket.error, err:
+            self.printNormal('system: unable to start live feed on ' + self.feed.path + ': ' + str(err))
+
+    def query_start(self):
+        port = self.config['envisalinkd'].get('query_port')
+        if not port:
+            return
+        try:
+            query.serve(port, self.state, self.feed, lambda: self.status['system'], self.zonestats)
+            self.printNormal('system: query API on http://127.0.0.1:' + str(port) + '/')
+        except socket.error, err:
+            self.printNormal('system: unable to start query API on port ' + str(port) + ': ' + str(err))
+
+    def statemap_start(self):
+        path = self.config['envisalinkd'].get('state_map')
+        if not path:
+            return
+        try:
+            self.statemap = statemap.Publisher(path)
+            self.printNormal('system: publishing panel state to ' + path)
+        except (IOError, OSError, mmap.error) as err:
+            self.printNormal('system: unable to publish panel state to ' + path + ': ' + str(err))
+
+    def publishState(self):
+        # Called every time round, only copies the state once it's changed.
+        if self.statemap and self.statemap.published != (self.state.version, self.status['system']):
+            version, state = self.state.snapshot()
+            self.statemap.publish(version, state, self.status['system'])
+
+    def dispatcher_start(self):
+        # The in-process broker can only be reached from this process, so
+        # host the dispatcher here.
+        if transport.backend(self.config) != 'inprocess':
+            return
+
+        import dispatcher
+        self.dispatcher = dispatcher.Dispatcher(self.config)
+        self.dispatcher.start()
+        self.printNormal('system: dispatching alerts to ' + ', '.join(name for name, alerter in self.dispatcher.routing[0]))
 
 
     def beanstalk_poll(self):
@@ -208,8 +534,6 @@ class Envisalink:
         # the event tubes).
 
         for tube in self.beanstalk_tubes_commands:
-            self.beanstalk.watch(tube)
-
             job = self.beanstalk.reserve(timeout=0) # Non-blocking Beanstalk poll
 
             if job:
@@ -251,15 +575,131 @@ class Envisalink:
         return
 
     def beanstalk_push(self, message):
+        # Hand the message to the publisher thread, never blocks. Called from
+        # the main loop and the poll timer.
+        if len(self.outbox) >= PUBLISH_BACKLOG:
+            self.outbox_lock.acquire()
+            try:
+                victim = self.outboxVictim(message)
+                if victim is not None:
+                    self.outbox_dropped += 1
+                    if victim is message:
+                        return
+                    try:
+                        self.outbox.remove(victim)
+                    except ValueError:
+                        pass    # published meanwhile
+            finally:
+                self.outbox_lock.release()
+        self.outbox.append(message)
+        self.outbox_ready.set()
+
+    def outboxVictim(self, message):
+        # Must hold outbox_lock. The event to drop to make room for message
+        # in the full outbox: message itself, the oldest queued info event,
+        # or for an event that's never dropped the oldest of any other
+        # type. None if there's nothing that can go.
+        if message.get('type') == 'info':
+            return message
+        other = None
+        for queued in list(self.outbox):
+            if queued.get('type') == 'info':
+                return queued
+            if other is None and queued.get('type') not in PUBLISH_KEEP:
+                other = queued
+        if message.get('type') in PUBLISH_KEEP:
+            return other
+        return message
+
+    def publisher_start(self):
+        try:
+            self.publisher_queue = transport.connect(self.config)
+        except transport.TransportError as err:
+            self.printFatal(str(err))
+        self.publisher = threading.Thread(target=self.publisherRun)
+        self.publisher.daemon = True
+        self.publisher.start()
+
+    def publisherRun(self):
+        # Publishes whatever has been queued since it last looked, pipelined
+        # together. A queue error is passed to the main loop to exit on.
+        try:
+            while True:
+                self.outbox_ready.wait(1)
+                self.outbox_ready.clear()
+
+                while self.outbox:
+                    puts = []
+                    while self.outbox and len(puts) < transport.PIPELINE:
+                        puts.extend(self.publishMessage(self.outbox.popleft()))
+                    if puts:
+                        self.publisher_queue.put_many(puts)
+
+                self.outbox_lock.acquire()
+                try:
+                    dropped, self.outbox_dropped = self.outbox_dropped, 0
+                finally:
+                    self.outbox_lock.release()
+                if dropped:
+                    self.printNormal('system: queue too slow, ' + str(dropped) + ' less important events not published')
+                if self.publisher_stopping:
+                    return
+        except transport.TransportError as err:
+            self.publisher_error = err
+
+    def checkPublisher(self):
+        if self.publisher_error is not None:
+            raise self.publisher_error
+
+    def stopPublisher(self):
+        # Publish what's left, unless the publisher is what's stopping.
+        if self.publisher is None or self.publisher is threading.current_thread():
+            return
+        self.publisher_stopping = True
+        self.outbox_ready.set()
+        self.publisher.join(5)
+
+    def publishMessage(self, message):
+        # Returns the puts for message, on the publisher thread.
+        if 'trace' in message:
+            message['trace']['publish'] = tracing.clock()
+
+        self.sequence += 1
+        stream = self.sequenceStream(message)
+        sequence = {'run': self.run, 'event': self.sequence, 'stream': stream}
+        message['sequence'] = sequence
+
         # Encode in JSON format
         message_json = json.dumps(message)
+        message_priority = self.priorities.priority(message)
 
-        # Send outputs to all defined event tubes (queues in beanstalk speak).
-        for tube in self.beanstalk_tubes_events:
-            #self.printNormal('system: Pushing message \"'+ str(message_json) +'\"to ' + str(tube) + '.')
-            self.beanstalk.use(tube)
-            self.beanstalk.put(message_json)
-        return
+        self.feed.publish(message, message_json)
+
+        # Send outputs to all defined event tubes (queues in beanstalk speak),
+        # each copy numbered for it's tube.
+        tubes = self.beanstalk_tubes_events
+        if self.routes.sinks:
+            routed = self.routes.route(message)
+            tubes = [tube for tube in tubes if tube in routed or tube not in self.routes.sinks]
+        puts = []
+        for tube in tubes:
+            self.tube_sequences[tube] = self.tube_sequences.get(tube, 0) + 1
+            key = (tube, stream)
+            self.stream_sequences[key] = self.stream_sequences.get(key, 0) + 1
+            message['sequence'] = dict(sequence, tube=self.tube_sequences[tube], in_stream=self.stream_sequences[key])
+            puts.append(([tube], json.dumps(message), message_priority))
+        message['sequence'] = sequence
+        return puts
+
+    def sequenceStream(self, message):
+        # What the event is about, events about the same thing are kept in
+        # order.
+        if message.get('zone'):
+            return 'zone ' + message['zone']
+        code = message.get('code')
+        if isinstance(code, basestring) and (code in PARTITION or code in PARTITION_MODE):
+            return 'partition ' + message['raw'][3:4]
+        return 'system'
 
     def connect(self):
         try:
@@ -281,6 +721,9 @@ class Envisalink:
         self.socketMutex.acquire()
         try:
             cmd_bytes = str(command).zfill(3)
+            if cmd_bytes == '001':
+                # The status report that follows goes into a snapshot.
+                self.snapshot_until = time.time() + SNAPSHOT_WAIT
             cmd = []
             checksum = 0
             for byte in cmd_bytes:
@@ -312,6 +755,8 @@ class Envisalink:
             msg = ''
             while True:
                 rsp = self.socket.recv(4096)
+                if self.tracing:
+                    self.received = tracing.clock()
                 if len(rsp) == 0:
                     # try to re-establish connection
                     self.printNormal('Envisalink closed the connection. Try to reconnect')
@@ -342,9 +787,23 @@ class Envisalink:
         cmd = word[:3]
         msg = ''
         event_type = 'unknown'
+        zone = None
 
         if cmd == '':
             return
+        elif cmd in self.decoders:
+            # Everything fixed by the code, zone, partition or bitmask comes
+            # from the tables, unconfigured zones and partitions aren't in
+            # them so aren't reported.
+            start, end, table = self.decoders[cmd]
+            decoded = table.get(word[start:end])
+            if decoded is not None:
+                event_type, msg, zone = decoded
+
+            if cmd == '510':
+                self.status['system'] = 'armed' if word[3:5] in self.armed_leds else 'disarmed'
+            elif cmd == '849':
+                self.printNormal(msg)
         elif cmd == '500':
             data = word[3:6]
             if data != '':
@@ -359,9 +818,6 @@ class Envisalink:
             else:
                 event_type = 'response'
                 msg += "no ack command"
-        elif cmd == '501':
-            event_type = 'fault'
-            msg += 'command error, bad checksum'
         elif cmd == '502':
             event_type = 'fault'
             data = word[3:6]
@@ -382,367 +838,20 @@ class Envisalink:
                 # this is where login should go, but it is much less reliable
                 # and causes problems
                 # self.login()
-        elif cmd == '510':
-            event_type = 'info'
-            self.status['system'] = 'disarmed'
-            msg += 'lit keypad LEDs = '
-            b = int(word[3:5],16)
-
-            # Bit 0 - Ready LED lit
-            if b & 0x01 != 0:
-                msg += 'ready '
-            # Bit 1 - Armed LED lit
-            if b & 0x02 != 0:
-                msg += 'armed '
-                self.status['system'] = 'armed'
-            # Bit 2 - Memory LED lit
-            if b & 0x04 != 0:
-                msg += 'memory '
-            # Bit 3 - Bypass LED lit
-            if b & 0x08 != 0:
-                msg += 'bypass '
-            # Bit 4 - Trouble LED lit
-            if b & 0x10 != 0:
-                msg += 'trouble '
-            # Bit 5 - Program LED lit
-            if b & 0x20 != 0:
-                msg += 'program '
-            # Bit 6 - Fire LED lit
-            if b & 0x40 != 0:
-                msg += 'fire '
-            # Bit 7 - Backlight LED lit
-            if b & 0x80 != 0:
-                msg += 'backlight '
-
-        elif cmd == '511':
-            event_type = 'info'
-            msg += 'flashing keypad LEDs = '
-            b = int(word[3:5],16)
-
-            # Bit 0 - Ready LED lit
-            if b & 0x01 != 0:
-                msg += 'ready '
-            # Bit 1 - Armed LED lit
-            if b & 0x02 != 0:
-                msg += 'armed '
-            # Bit 2 - Memory LED lit
-            if b & 0x04 != 0:
-                msg += 'memory '
-            # Bit 3 - Bypass LED lit
-            if b & 0x08 != 0:
-                msg += 'bypass '
-            # Bit 4 - Trouble LED lit
-            if b & 0x10 != 0:
-                msg += 'trouble '
-            # Bit 5 - Program LED lit
-            if b & 0x20 != 0:
-                msg += 'program '
-            # Bit 6 - Fire LED lit
-            if b & 0x40 != 0:
-                msg += 'fire '
-            # Bit 7 - Backlight LED lit
-            if b & 0x80 != 0:
-                msg += 'backlight '
-
         elif cmd == '550':
             event_type = 'info'
             msg += 'time and date ' + word[3:5] + ":" + word[5:7] + " " + word[7:9] + "/" + word[9:11] + "/20" + word[11:13]
-        elif cmd == '560':
-            event_type = 'info'
-            msg += 'ring detected'
         elif cmd == '561':
             event_type = 'info'
             msg += 'indoor temperature = ' + word[3:7]
         elif cmd == '562':
             event_type = 'info'
             msg += 'outdoor temperature = ' + word[3:7]
-        elif cmd == '601':
-            zone = word[4:7]
-            partition = word[3:4]
-            if int(zone) <= self.max_zones:
-                if int(partition) <= self.max_partitions:
-                    msg += 'alarm. partition = ' + partition + ' zone = ' + self.zones[zone]
-                    event_type = 'alarm'
-        elif cmd == '602':
-            zone = word[4:7]
-            partition = word[3:4]
-            if int(zone) <= self.max_zones:
-                if int(partition) <= self.max_partitions:
-                    msg += 'alarm cleared. partition = ' + partition + ' zone = ' + self.zones[zone]
-                    event_type = 'recovery'
-        elif cmd == '603':
-            zone = word[4:7]
-            partition = word[3:4]
-            if int(zone) <= self.max_zones:
-                if int(partition) <= self.max_partitions:
-                    msg += 'tamper. partition = ' + partition + ' zone = ' + self.zones[zone]
-                    event_type = 'alarm'
-        elif cmd == '604':
-            zone = word[4:7]
-            partition = word[3:4]
-            if int(zone) <= self.max_zones:
-                if int(partition) <= self.max_partitions:
-                    msg += 'tamper cleared. partition = ' + partition + ' zone = ' + self.zones[zone]
-                    event_type = 'recovery'
-        elif cmd == '605':
-            zone = word[3:6]
-            if int(zone) <= self.max_zones:
-                msg += 'zone ' + self.zones[zone] + ' fault'
-                event_type = 'alarm'
-        elif cmd == '606':
-            zone = word[3:6]
-            if int(zone) <= self.max_zones:
-                msg += 'zone ' + self.zones[zone] + ' fault cleared'
-                event_type = 'recovery'
-        elif cmd == '609':
-            zone = word[3:6]
-            if int(zone) <= self.max_zones:
-                msg += 'zone ' + self.zones[zone] + ' open'
-                event_type = 'info'
-        elif cmd == '610':
-            zone = word[3:6]
-            if int(zone) <= self.max_zones:
-                msg += 'zone ' + self.zones[zone] + ' closed'
-                event_type = 'info'
-        elif cmd == '615':
-            # don't care about all the zone timers
-            msg += 'received [615]: zone timer dump'
-            event_type = 'info'
-        elif cmd == '620':
-            msg += 'duress alarm'
-            event_type = 'alarm'
-        elif cmd == '621':
-            msg += 'fire key alarm detected'
-            event_type = 'alarm'
-        elif cmd == '622':
-            msg += 'fire key alarm restored'
-            event_type = 'recovery'
-        elif cmd == '623':
-            msg += 'auxillary key alarm detected'
-            event_type = 'alarm'
-        elif cmd == '624':
-            msg += 'auxillary key alarm restored'
-            event_type = 'recovery'
-        elif cmd == '625':
-            msg += 'panic key detected'
-            event_type = 'alarm'
-        elif cmd == '626':
-            msg += 'panic key restored'
-            event_type = 'recovery'
-        elif cmd == '631':
-            msg += 'smoke/aux alarm detected'
-            event_type = 'alarm'
-        elif cmd == '632':
-            msg += 'smoke/aux alarm restored'
-            event_type = 'recovery'
-        elif cmd == '650':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' ready'
-                event_type = 'info'
-        elif cmd == '651':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' not ready'
-                event_type = 'info'
-        elif cmd == '652':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' armed, mode = ' + self.modes[word[4:5]]
-                event_type = 'armed'
-        elif cmd == '653':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' forcing alarm enabled'
-                event_type = 'info'
-        elif cmd == '654':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' in alarm'
-                event_type = 'alarm'
-        elif cmd == '655':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' disarmed'
-                event_type = 'disarmed'
-        elif cmd == '656':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' exit delay'
-                event_type = 'armed'
-        elif cmd == '657':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' entry delay'
-                event_type = 'info'
-        elif cmd == '658':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' keypad lockout'
-                event_type = 'alarm'
-        elif cmd == '659':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' failed to arm'
-                event_type = 'fault'
-        elif cmd == '660':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' PGM output'
-                event_type = 'info'
-        elif cmd == '663':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' chime enabled'
-                event_type = 'info'
-        elif cmd == '664':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' chime disabled'
-                event_type = 'info'
-        elif cmd == '670':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' invalid access code'
-                event_type = 'alarm'
-        elif cmd == '671':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' function not available'
-                event_type = 'fault'
-        elif cmd == '672':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' failure to arm'
-                event_type = 'fault'
-        elif cmd == '673':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' is busy'
-                event_type = 'fault'
-        elif cmd == '674':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' is arming'
-                event_type = 'info'
-        elif cmd == '680':
-            msg += 'system in installer\'s mode'
-            event_type = 'alarm'
-        elif cmd == '700':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition = ' + partition + 'armed by user'
-                event_type = 'info'
-        elif cmd == '701':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' armed by method'
-                event_type = 'info'
-        elif cmd == '702':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' armed but zone(s) bypassed'
-                event_type = 'info'
-        elif cmd == '750':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' disarmed by user'
-                event_type = 'info'
-        elif cmd == '751':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' partition disarmed by method'
-                event_type = 'info'
-        elif cmd == '800':
-            msg += 'closet panel battery trouble'
-            event_type = 'fault'
-        elif cmd == '801':
-            msg += 'closet panel battery restore'
-            event_type = 'fault'
-        elif cmd == '802':
-            msg += 'closet panel AC trouble'
-            event_type = 'fault'
-        elif cmd == '803':
-            msg += 'closet panel AC retored'
-            event_type = 'fault'
-        elif cmd == '806':
-            msg += 'bell trouble'
-            event_type = 'fault'
-        elif cmd == '807':
-            msg += 'bell restored'
-            event_type = 'fault'
-        elif cmd == '814':
-            msg += 'closet panel failed to communicate with monitoring'
-            event_type = 'fault'
-        elif cmd == '816':
-            msg += 'buffer near full'
-            event_type = 'fault'
-        elif cmd == '829':
-            msg += 'general system tamper'
-            event_type = 'alarm'
-        elif cmd == '830':
-            msg += 'general system tamper cleared'
-            event_type = 'recovery'
-        elif cmd == '840':
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' trouble LED on'
-                event_type = 'fault'
-        elif cmd == '841':
-            event_type = 'info'
-            partition = word[3:4]
-            if int(partition) <= self.max_partitions:
-                msg += 'partition ' + partition + ' trouble LED off'
-                event_type = 'info'
-        elif cmd == '842':
-            event_type = 'alarm'
-            msg += 'fire trouble alarm'
-        elif cmd == '843':
-            event_type = 'recovery'
-            msg += 'fire trouble alarm cleared'
-        elif cmd == '849':
-            event_type = 'fault'
-            msg += 'verbose trouble status = '
-            b = int(word[3:5],16)
-
-            # Bit 0 - Service required
-            if b & 0x01 != 0:
-                msg += 'service required | '
-            # Bit 1 - AC power lost
-            if b & 0x02 != 0:
-                msg += 'AC power lost | '
-            # Bit 2 - telephone line fault
-            if b & 0x04 != 0:
-                msg += 'telephone line fault (ignore) | '
-            # Bit 3 - failure to communicate
-            if b & 0x08 != 0:
-                msg += 'failure to communicate | '
-            # Bit 4 - sensor/zone fault
-            if b & 0x10 != 0:
-                msg += 'sensor/zone fault | '
-            # Bit 5 - sensor/zone tamper
-            if b & 0x20 != 0:
-                msg += 'sensor zone tamper | '
-            # Bit 6 - low battery
-            if b & 0x40 != 0:
-                msg += 'low battery '
-
-            self.printNormal(msg)
         elif cmd == '900':
             msg += 'code required'
             event_type = 'response'
             # the master code should be a variable and in a config file
             self.sendCommand('200', 'code send', self.code_master)
-        elif cmd == '912':
-            # don't care about data
-            event_type = 'response'
-            msg += 'command output pressed'
-        elif cmd == '921':
-            event_type = 'response'
-            msg += 'master code required'
-        elif cmd == '922':
-            event_type = 'response'
-            msg += 'installer\'s code required'
         else:
             if len(msg) > 20:
                 msg += "received[too long]: unhandled response"
@@ -756,13 +865,52 @@ class Envisalink:
         # by status queries.
         if msg:
             # Assembled completed response
-            self.printNormal('received ['+ event_type +'][' + word + ']: ' + msg)
-
             response = {'type': event_type, 'raw': word, 'code': cmd, 'message': msg, 'timestamp': int(time.time())}
-            self.beanstalk_push(response)
+            if zone:
+                response['zone'] = zone
+
+            # Frames repeating the state we already have (eg answering a
+            # status request) aren't published again, and those answering
+            # a status request are collected into a snapshot.
+            changed = self.panelstate.changed(response)
+            if changed:
+                self.state.apply(response)
+                self.zonestats.apply(response)
+
+            if not changed:
+                self.printNormal('received ['+ event_type +'][' + word + ']: ' + msg + ' (unchanged)')
+            elif self.inSnapshot(response):
+                self.printNormal('received ['+ event_type +'][' + word + ']: ' + msg + ' (in snapshot)')
+            else:
+                self.printNormal('received ['+ event_type +'][' + word + ']: ' + msg)
+                if self.tracing:
+                    response['trace'] = tracing.start(self.received)
+                self.beanstalk_push(response)
 
         return
 
+    def inSnapshot(self, event):
+        # Whilst a status report is coming in, each state frame extends the
+        # wait for it to finish. Unless status_frames is set they're only
+        # published in the snapshot, apart from changes the sinks alert on
+        # (only changed frames get this far).
+        if self.snapshot_until is None or panelstate.slot(event) is None:
+            return False
+        self.snapshot_until = time.time() + SNAPSHOT_QUIET
+        return not self.status_frames and event['type'] not in SNAPSHOT_ALERTING
+
+    def snapshotPoll(self):
+        # Publish the snapshot once the status report has gone quiet.
+        if self.snapshot_until is None or time.time() < self.snapshot_until:
+            return
+        self.snapshot_until = None
+
+        version, state = self.state.snapshot()
+        message = 'status snapshot, ' + str(len(state['zones'])) + ' zones, ' + str(len(state['partitions'])) + ' partitions'
+        self.printNormal('system: ' + message)
+        self.beanstalk_push({'type': 'snapshot', 'code': '001', 'raw': '001', 'message': message, 'timestamp': int(time.time()),
+                             'zones': state['zones'], 'partitions': state['partitions'], 'keypad': state['keypad']})
+
     def timeStamp(self):
         t = time.time()
         s = datetime.datetime.fromtimestamp(t).strftime('%Y/%m/%d %H:%M:%S - ')
@@ -796,12 +944,19 @@ class Envisalink:
         self.status_zones = {'001' : 'unknown', '002' : 'unknown', '003' : 'unknown', '004' : 'unknown', '005' : 'unknown', '006' : 'unknown'}
 
     def exitData(self):
+        self.stopPublisher()
+        self.savePanelState()
+        self.saveZoneStats(force=True)
         self.resetData()
 
     def getStatus(self):
         self.sendCommand(001, 'get status')
         return True
 
+    def getZoneTimers(self):
+        self.sendCommand('008', 'dump zone timers')
+        return True
+
     def poll(self):
         if self.poll_ack == True:
             self.poll_ack = False
@@ -833,15 +988,28 @@ class Envisalink:
 
 if __name__ == '__main__':
         try:
+            startup.phase('imports')
             e = Envisalink()
+            e.config.on_reload(e.reloadConfig)
+            e.config.install_reload_handler()
+            startup.phase('config')
             e.printNormal('system: start envisalinkd')
             e.resetData()
             e.connect()
+            startup.phase('alarm connect')
             e.beanstalk_connect()
+            e.tail_start()
+            e.query_start()
+            e.statemap_start()
+            e.dispatcher_start()
+            e.publisher_start()
+            startup.phase('queue connect')
+            startup.finish()
             e.login()
 
             # get status of security system
             e.getStatus()
+            e.getZoneTimers()
 
             e.poll()
 
@@ -850,6 +1018,12 @@ if __name__ == '__main__':
             login_wait = 0
             e.sleep = 0
             while(True):
+                e.checkConfig()
+                e.checkPublisher()
+                e.snapshotPoll()
+                e.publishState()
+                e.savePanelState()
+                e.saveZoneStats()
                 e.beanstalk_poll()
                 rsp = e.receiveResponse()
                 if rsp == 'c':
@@ -861,6 +1035,7 @@ if __name__ == '__main__':
                     e.sleep = 0
                     e.connect()
                     e.login()
+                    e.getZoneTimers()
                 elif rsp == '':
                     e.sleep += 1
                     if e.sleep == 10:
@@ -881,3 +1056,5 @@ if __name__ == '__main__':
             e.printFatal('system: User terminated execution')
         except socket.error, err:
             e.printFatal('socket error ' + str(err[0]))
+        except transport.TransportError, err:
+            e.printFatal('transport error ' + str(err))
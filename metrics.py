@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+#
+# Minimal metrics registry for the daemons, exposing gauges and counters in the
+# Prometheus text format over HTTP on a loopback port so they can be scraped
+# or just checked with curl.
+#
+
+import threading
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.descriptions = {}
+
+    def describe(self, name, kind, text):
+        # kind is 'gauge' or 'counter'
+        self.descriptions[name] = (kind, text)
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.values[key] = value
+        finally:
+            self.lock.release()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render(self):
+        self.lock.acquire()
+        try:
+            values = sorted(self.values.items())
+        finally:
+            self.lock.release()
+
+        lines = []
+        described = set()
+        for (name, labels), value in values:
+            if name not in described and name in self.descriptions:
+                kind, text = self.descriptions[name]
+                lines.append('# HELP ' + name + ' ' + text)
+                lines.append('# TYPE ' + name + ' ' + kind)
+                described.add(name)
+
+            if labels:
+                name += '{' + ','.join(key + '="' + str(label) + '"' for key, label in labels) + '}'
+            lines.append(name + ' ' + repr(value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        # Serve /metrics from a background thread. The server is only
+        # imported when metrics are served, keeping startup fast when not.
+        import BaseHTTPServer
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+#
+# Sequence numbers on events, and keeping deliveries in order when a consumer
+# has several workers.
+#
+# envisalinkd stamps every event it publishes with a `sequence` block:
+#
+#   {"run": 1792427490123, "event": 1234, "stream": "zone 005", "tube": 88, "in_stream": 17}
+#
+# `run` identifies the envisalinkd process (numbers start again when it does),
+# `event` counts every event published and `stream` is what the event is about
+# - a zone, a partition, or the system as a whole. `tube` counts the events
+# put on the tube the copy was taken from, and `in_stream` the events of the
+# stream put on that tube, so a consumer can tell exactly which events it
+# should have had.
+#
+# With parallel workers, a zone's recovery could be delivered before it's
+# alarm. A Sequencer holds an event back until the events before it in the
+# same stream have been delivered (or failed), so order is kept within a zone
+# or partition while other zones are delivered alongside. An earlier event the
+# consumer hasn't reserved yet is waited for for up to `order_wait` seconds -
+# it's usually just being reserved by another worker - before giving up on it,
+# and one that turns up after that is delivered straight away with a warning.
+# Retried jobs aren't sequenced at all, their turn has passed.
+#
+# Every consumer keeps a Gaps, whether or not it keeps order: tube numbers
+# missing for longer than GAP_WAIT seconds, once later events have arrived,
+# are logged as lost (eg dropped by tubewatch's overflow policy or deleted by
+# hand).
+#
+
+import time
+import threading
+
+
+# Seconds a missing tube number must stay missing before it's logged as lost,
+# long enough for anything merely delayed behind higher priority events.
+GAP_WAIT = 300
+
+# Stream numbers this far ahead aren't waited for, a gap that size is lost
+# events rather than an event being reserved.
+MAX_AHEAD = 100
+
+# Seconds the first events seen of a stream wait for the stream's earlier
+# events, which have usually been delivered before the consumer started but
+# may just be being reserved by another worker.
+FRESH_WAIT = 0.25
+
+
+class Stream:
+
+    def __init__(self, floor, first):
+        self.floor = floor      # every number up to here is done
+        self.first = first      # first number seen
+        self.done = set()       # and these beyond it
+        self.waiting = set()    # arrived, waiting for their turn
+        self.started = set()
+
+    def finish(self, number):
+        self.started.discard(number)
+        if number > self.floor:
+            self.done.add(number)
+        while self.floor + 1 in self.done:
+            self.floor += 1
+            self.done.remove(self.floor)
+
+
+class Gaps:
+    # The tube numbers of the events a consumer has received, logging any
+    # missing for too long.
+
+    def __init__(self, log, gap_wait=GAP_WAIT):
+        self.log = log
+        self.gap_wait = gap_wait
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, run):
+        # Must hold lock.
+        self.run = run
+        self.received = None    # every tube number up to here has arrived
+        self.ahead = {}         # tube numbers beyond it -> when they arrived
+
+    def arrived(self, event):
+        block = event.get('sequence')
+        if not isinstance(block, dict) or 'tube' not in block:
+            return
+
+        self.lock.acquire()
+        try:
+            if block.get('run') != self.run:
+                self.reset(block.get('run'))
+
+            number = block['tube']
+            if self.received is None:
+                self.received = number - 1
+            if number <= self.received:
+                return
+            self.ahead.setdefault(number, time.time())
+            self.advance()
+
+            now = time.time()
+            while self.ahead and now - min(self.ahead.values()) > self.gap_wait:
+                following = min(self.ahead)
+                self.log('Warning: ' + str(following - self.received - 1) + ' event(s) missing from the tube before event ' + str(following) + ', lost')
+                self.received = following - 1
+                self.advance()
+        finally:
+            self.lock.release()
+
+    def advance(self):
+        # Must hold lock.
+        while self.received + 1 in self.ahead:
+            self.received += 1
+            del self.ahead[self.received]
+
+
+class Sequencer:
+
+    def __init__(self, wait, log):
+        self.wait = wait
+        self.log = log
+        self.cond = threading.Condition()
+        self.reset(None)
+
+    def reset(self, run):
+        # Must hold cond.
+        self.run = run
+        self.streams = {}
+
+    def begin(self, event):
+        # Blocks until it's event's turn, returning a ticket to pass to end
+        # once delivered. None if the event isn't ordered. Only for an
+        # event's first delivery attempt, retries aren't held back.
+        block = event.get('sequence')
+        if not isinstance(block, dict) or 'in_stream' not in block:
+            return None
+
+        self.cond.acquire()
+        try:
+            if block.get('run') != self.run:
+                self.reset(block.get('run'))
+
+            name, number = block.get('stream'), block['in_stream']
+            stream = self.streams.get(name)
+            if stream is None:
+                # Started part way through the stream, the events before this
+                # were either delivered before we started or are being
+                # reserved by another worker right now.
+                stream = self.streams[name] = Stream(max(0, number - MAX_AHEAD), number)
+            if number in stream.waiting or number in stream.started or number in stream.done:
+                return None     # a duplicate, eg handed out again once it's TTR ran out
+            if number <= stream.floor:
+                self.log('Warning: ' + name + ' event ' + str(number) + ' arrived after later events, delivered out of order')
+                return None
+            if number - stream.floor > MAX_AHEAD:
+                stream.floor = number - 1
+                stream.done = set()
+
+            now = time.time()
+            deadline = now + self.wait
+            brief = now + min(self.wait, FRESH_WAIT)
+            stream.waiting.add(number)
+            try:
+                while True:
+                    pending = [earlier for earlier in range(stream.floor + 1, number) if earlier not in stream.done]
+                    if not pending:
+                        break
+                    # Those already arrived or in flight are waited on however
+                    # long they take, they're bound to finish.
+                    unseen = [earlier for earlier in pending if earlier not in stream.started and earlier not in stream.waiting]
+                    before = [earlier for earlier in unseen if earlier < stream.first]
+                    after = [earlier for earlier in unseen if earlier >= stream.first]
+                    now = time.time()
+
+                    if before and now >= brief:
+                        # Most likely delivered before we started.
+                        for earlier in before:
+                            stream.finish(earlier)
+                        self.cond.notify_all()
+                        continue
+                    if after and now >= deadline:
+                        self.log('Warning: ' + name + ' event ' + str(number) + ' delivered without ' + str(len(after)) + ' earlier event(s), still queued or lost')
+                        for earlier in after:
+                            stream.finish(earlier)
+                        self.cond.notify_all()
+                        continue
+
+                    waits = ([brief] if before else []) + ([deadline] if after else [])
+                    self.cond.wait(min(waits) - now if waits else 1)
+            finally:
+                stream.waiting.discard(number)
+
+            stream.started.add(number)
+            return (self.run, name, number)
+        finally:
+            self.cond.release()
+
+    def end(self, ticket):
+        if ticket is None:
+            return
+        run, name, number = ticket
+        self.cond.acquire()
+        try:
+            if run == self.run and name in self.streams:
+                self.streams[name].finish(number)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
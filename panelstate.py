@@ -0,0 +1,110 @@
+#! /usr/bin/env python
+#
+# Last known state of the panel, for envisalinkd to only publish frames that
+# change it. Every status request (on start, reconnect or `status` command)
+# has the panel report every zone, partition and LED again, and without this
+# each of those would go to every sink as if it were new.
+#
+# Each frame describing state is filed under the piece of state it describes
+# (a zone's open/closed, a partition's arming state, the keypad LEDs...) and
+# is only published when it differs from the last frame filed there. Alarms
+# are always published, so stale state can never hide one.
+#
+# The state is saved to `state_file` under `envisalinkd` (by default
+# .panelstate.json in the working directory) soon after it changes, and
+# loaded at startup, so a restart against an unchanged panel publishes next
+# to nothing.
+#
+
+import os
+import json
+import threading
+import query
+
+
+DEFAULT_PATH = '.panelstate.json'
+
+
+def slot(event):
+    # The piece of state event describes, None if it's not about state.
+    code = event.get('code')
+    if not isinstance(code, basestring):
+        return None
+    if code in query.ZONE_STATES:
+        return query.ZONE_STATES[code][0] + ' ' + event.get('raw', '')[3:]
+    if code in query.PARTITION_READY:
+        return 'ready ' + event.get('raw', '')[3:4]
+    if code in query.PARTITION_STATES:
+        return 'partition ' + event.get('raw', '')[3:4]
+    if code in query.LED_STATES or code == '849':
+        return code
+    return None
+
+
+class PanelState:
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.frames = {}    # slot -> last event filed there
+        self.dirty = False
+
+    def changed(self, event):
+        # Files event, returning whether it should be published.
+        key = slot(event)
+        if key is None:
+            return True
+
+        self.lock.acquire()
+        try:
+            last = self.frames.get(key)
+            if last is not None and last.get('raw') == event.get('raw') and event.get('type') != 'alarm':
+                return False
+            self.frames[key] = dict((field, event[field]) for field in ('type', 'code', 'raw', 'message', 'zone', 'timestamp') if field in event)
+            self.dirty = True
+            return True
+        finally:
+            self.lock.release()
+
+    def events(self):
+        # The last event of each piece of state.
+        self.lock.acquire()
+        try:
+            return sorted(self.frames.values(), key=lambda event: event.get('timestamp'))
+        finally:
+            self.lock.release()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.lock.acquire()
+        try:
+            self.frames = dict((str(key), dict((str(field), value) for field, value in event.items()))
+                               for key, event in saved.get('frames', {}).items())
+        finally:
+            self.lock.release()
+        return True
+
+    def save(self):
+        # Written to a temporary file and renamed, so a crash mid-save never
+        # leaves a partial file.
+        self.lock.acquire()
+        try:
+            if not self.dirty:
+                return
+            data = json.dumps({'frames': self.frames})
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+        temp = self.path + '.' + str(os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                f.write(data)
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            self.dirty = True
+            raise
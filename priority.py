@@ -0,0 +1,46 @@
+#! /usr/bin/env python
+#
+# Maps alarm events to beanstalkd job priorities, so that life-safety events
+# overtake any backlog of informational events in the tubes. beanstalkd always
+# reserves the ready job with the lowest priority value first, across all the
+# tubes a consumer watches, so a fire alarm queued behind a status dump of
+# hundreds of info events is still the next job any consumer receives.
+#
+# The policy is configurable via the `priorities` config section. Specific
+# event codes take precedence over event types, and anything unmatched gets
+# the default priority.
+#
+
+# Lower values are reserved first (beanstalkd accepts 0 to 2**32-1).
+DEFAULT_TYPES = {
+    'alarm':        0,
+    'fault':        100,
+    'recovery':     200,
+    'armed':        500,
+    'disarmed':     500,
+    'response':     1000,
+    'command':      1000,
+    'info':         2000,
+    'unknown':      2000,
+    }
+
+DEFAULT_PRIORITY = 2 ** 31  # beanstalkc's default
+
+
+class Policy:
+
+    def __init__(self, settings=None):
+        settings = settings or {}
+
+        self.types = dict(DEFAULT_TYPES)
+        self.types.update(settings.get('types') or {})
+        self.codes = dict(settings.get('codes') or {})
+        self.default = settings.get('default', DEFAULT_PRIORITY)
+
+    def priority(self, event):
+        # Command echos carry the raw command as a list rather than a code
+        # string, those just fall through to their type.
+        code = event.get('code')
+        if isinstance(code, basestring) and code in self.codes:
+            return self.codes[code]
+        return self.types.get(event.get('type'), self.default)
@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+#
+# Read-only query API for envisalinkd, so local dashboards can ask for the
+# current state of the alarm rather than sending `status` and picking through
+# the events it causes. Served over HTTP on a loopback port (`query_port`
+# under `envisalinkd`), answering JSON:
+#
+#   /state                      Zones, partitions and keypad LEDs as last
+#                               reported by the panel, and the connection.
+#   /events?limit=N             The most recent events, oldest first, from the
+#                               live feed's history (see tail.py).
+#   /events?zone=005&since=T    Filtered by zone, type and/or code, and to
+#                               events since unix time T.
+#   /zones                      Activity statistics for each zone (see
+#                               zonestats.py).
+#
+# Everything is answered from memory kept up to date as events are published,
+# without going near the TPI socket or the queue. Requests are handled on
+# threads of their own, and the state is only encoded again once it changes.
+#
+
+import json
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import tail
+
+
+# Zone codes, the flag they set and to what.
+ZONE_STATES = {
+    '601': ('alarm', True),
+    '602': ('alarm', False),
+    '603': ('tamper', True),
+    '604': ('tamper', False),
+    '605': ('fault', True),
+    '606': ('fault', False),
+    '609': ('open', True),
+    '610': ('open', False),
+    }
+
+# Partition codes and the state they put the partition in, readiness to arm
+# being reported separately.
+PARTITION_READY = {'650': True, '651': False}
+
+PARTITION_STATES = {
+    '652': 'armed',
+    '654': 'alarm',
+    '655': 'disarmed',
+    '656': 'exit delay',
+    '657': 'entry delay',
+    '658': 'keypad lockout',
+    '659': 'failed to arm',
+    '672': 'failed to arm',
+    '673': 'busy',
+    '674': 'arming',
+    '701': 'armed',
+    '702': 'armed',
+    '750': 'disarmed',
+    '751': 'disarmed',
+    }
+
+LED_STATES = {'510': 'lit', '511': 'flashing'}
+
+
+class State:
+    # Alarm state built up from the events envisalinkd publishes. leds are the
+    # names of the keypad LED bits, lowest first.
+
+    def __init__(self, leds):
+        self.leds = [led.strip() for led in leds]
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.partitions = {}
+        self.keypad = {'lit': [], 'flashing': []}
+        self.version = 0
+        self.updated = None
+
+    def apply(self, event):
+        code = event.get('code')
+        if not isinstance(code, basestring):
+            return  # command echos carry a list
+
+        if code in ZONE_STATES:
+            zone = event.get('zone')
+            if zone is None:
+                return
+            field, value = ZONE_STATES[code]
+            self.lock.acquire()
+            try:
+                self.zones.setdefault(zone, {'open': False, 'alarm': False, 'tamper': False, 'fault': False})[field] = value
+                self.changed(event)
+            finally:
+                self.lock.release()
+
+        elif code in PARTITION_STATES or code in PARTITION_READY:
+            raw = event.get('raw', '')
+            partition = raw[3:4]
+            self.lock.acquire()
+            try:
+                state = self.partitions.setdefault(partition, {})
+                if code in PARTITION_READY:
+                    state['ready'] = PARTITION_READY[code]
+                else:
+                    state['state'] = PARTITION_STATES[code]
+                if code == '652':
+                    state['mode'] = raw[4:5]
+                self.changed(event)
+            finally:
+                self.lock.release()
+
+        elif code in LED_STATES:
+            try:
+                bits = int(event.get('raw', '')[3:5], 16)
+            except ValueError:
+                return
+            self.lock.acquire()
+            try:
+                self.keypad[LED_STATES[code]] = [led for bit, led in enumerate(self.leds) if bits & (1 << bit)]
+                self.changed(event)
+            finally:
+                self.lock.release()
+
+    def changed(self, event):
+        # Must hold lock.
+        self.version += 1
+        self.updated = event.get('timestamp')
+
+    def snapshot(self):
+        # Returns (version, copy of the state).
+        self.lock.acquire()
+        try:
+            return self.version, {
+                'zones':        dict((zone, dict(flags)) for zone, flags in self.zones.items()),
+                'partitions':   dict((partition, dict(state)) for partition, state in self.partitions.items()),
+                'keypad':       dict((key, list(leds)) for key, leds in self.keypad.items()),
+                'updated':      self.updated,
+                }
+        finally:
+            self.lock.release()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in urlparse.parse_qs(url.query).items())
+
+        try:
+            if url.path == '/state':
+                body = self.server.render_state()
+            elif url.path == '/events':
+                body = self.server.render_events(params)
+            elif url.path == '/zones' and self.server.zonestats:
+                body = json.dumps(self.server.zonestats.snapshot())
+            else:
+                self.send_error(404)
+                return
+        except ValueError as err:
+            self.send_error(400, str(err))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # SocketServer's default listen backlog of 5 overflows with a handful of
+    # clients connecting at once, stalling them for a second or more while
+    # their connection is retried.
+    request_queue_size = 128
+
+    def __init__(self, address, state, feed, status, zonestats=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.state = state
+        self.feed = feed
+        self.status = status
+        self.zonestats = zonestats
+        self.cache = (None, None)
+
+    def render_state(self):
+        # Encoded again only when the state or connection status changes.
+        system = self.status()
+        key, body = self.cache
+        if key is not None and key == (self.state.version, system):
+            return body
+
+        version, state = self.state.snapshot()
+        state['system'] = system
+        body = json.dumps(state)
+        self.cache = ((version, system), body)
+        return body
+
+    def render_events(self, params):
+        limit = int(params.get('limit', 0)) or None
+        since = int(params['since']) if 'since' in params else None
+        match = tail.Filter({'types': split(params.get('type')), 'codes': split(params.get('code')), 'zones': split(params.get('zone'))})
+        return '[' + ','.join(self.feed.recent(match, limit, since)) + ']'
+
+
+def split(value):
+    return [item for item in (value or '').split(',') if item]
+
+
+def serve(port, state, feed, status, zonestats=None, host='127.0.0.1'):
+    # Serve the API from a background thread, status returns the connection
+    # status to report.
+    server = Server((host, port), state, feed, status, zonestats)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+#
+# Token bucket rate limiting for the alert sinks, so a storm of events from
+# the panel (dozens of alarm/fault events in a few seconds) doesn't become
+# dozens of phone calls and emails. Configured per sink with a `rate_limit`
+# block:
+#
+#   rate                Notifications per minute, sustained.
+#   burst               Notifications allowed back to back before the rate
+#                       applies.
+#   destination_rate    The same, for each destination (phone number, URL)
+#   destination_burst   of the sink on it's own.
+#   bypass_codes        Event codes never limited, by default the fire,
+#                       auxiliary/medical, panic and smoke alarms.
+#   bypass_types        Event types never limited.
+#
+# Events over the limit are dropped and counted, and the next notification
+# that gets through says how many were suppressed ("and 17 more events").
+# The count is only cleared once that notification has been delivered, so a
+# failed delivery doesn't lose it. Only an event's first delivery attempt is
+# limited, retrying one that was admitted always goes ahead.
+#
+
+import time
+import threading
+
+
+DEFAULT_BYPASS_CODES = ('621', '623', '625', '631')
+
+
+class Bucket:
+
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.suppressed = 0
+
+    def take(self, rate, burst, now):
+        # rate is per second
+        self.tokens = min(float(burst), self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Limiter:
+
+    def __init__(self, settings=None):
+        settings = settings or {}
+
+        self.rate               = settings.get('rate')
+        self.burst              = settings.get('burst', 1)
+        self.destination_rate   = settings.get('destination_rate')
+        self.destination_burst  = settings.get('destination_burst', 1)
+        self.bypass_codes       = frozenset(settings.get('bypass_codes', DEFAULT_BYPASS_CODES))
+        self.bypass_types       = frozenset(settings.get('bypass_types', ()))
+
+        self.lock = threading.Lock()
+        self.buckets = {}   # destination (None for the sink) -> Bucket
+
+    def inherit(self, previous):
+        # Carry the buckets over a configuration reload, so reloading
+        # doesn't hand out a fresh burst.
+        self.buckets = previous.buckets
+
+    def limits(self, destination):
+        if destination is None:
+            return self.rate, self.burst
+        return self.destination_rate, self.destination_burst
+
+    def admit(self, event, destination=None):
+        # Returns None if the event should be suppressed, otherwise the number
+        # of events suppressed since the last one delivered.
+        rate, burst = self.limits(destination)
+        if rate is None:
+            return 0
+
+        code = event.get('code')
+        bypass = (isinstance(code, basestring) and code in self.bypass_codes) or event.get('type') in self.bypass_types
+
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(destination)
+            if bucket is None:
+                bucket = self.buckets[destination] = Bucket(burst)
+
+            if bypass or bucket.take(rate / 60.0, burst, time.time()):
+                return bucket.suppressed
+            bucket.suppressed += 1
+            return None
+        finally:
+            self.lock.release()
+
+    def reported(self, count, destination=None):
+        # A notification mentioning count suppressed events was delivered.
+        if not count:
+            return
+        self.lock.acquire()
+        try:
+            bucket = self.buckets.get(destination)
+            if bucket is not None:
+                bucket.suppressed = max(0, bucket.suppressed - count)
+        finally:
+            self.lock.release()
+
+
+def annotate(event, count):
+    # Copy of event noting the suppressed events, for the notification.
+    if not count:
+        return event
+    event = dict(event)
+    event['suppressed'] = count
+    event['message'] = event.get('message', '') + ' (and ' + str(count) + ' more event' + ('s' if count != 1 else '') + ')'
+    return event
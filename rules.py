@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+#
+# Routes alarm events to the alert sinks according to the `rules` config
+# section, eg:
+#
+#   rules:
+#     - name: fire
+#       codes: ['621', '631', '842']
+#       sinks: [alert_plivo, alert_email]
+#     - name: study alarm
+#       types: [alarm]
+#       zones: ['005']
+#       sinks: [alert_plivo]
+#     - name: overnight info
+#       types: [info]
+#       between: '22:00-06:00'
+#       sinks: [alert_email]
+#
+# A rule matches an event when every criteria it gives matches (codes, types
+# and zones are each any-of), and the event is routed to the sinks of every
+# matching rule. Sinks that no rule names keep using their own `triggers`.
+#
+# Rules are compiled into indexes by code, zone and type, each rule filed
+# under it's most selective criteria, so only the handful of rules that could
+# match an event are ever looked at. The result for each (code, type, zone)
+# is then memoised, split into the periods of the day between the edges of
+# any time windows, leaving a single lookup of the current period per event.
+# Matching cost therefore doesn't grow with the number of rules.
+#
+
+import time
+import bisect
+
+
+# Bound on memoised routes, in case events carry unbounded codes.
+MEMO_LIMIT = 10000
+
+
+class Rule:
+
+    def __init__(self, settings):
+        self.name       = settings.get('name', '')
+        self.codes      = frozenset(settings.get('codes') or ())
+        self.types      = frozenset(settings.get('types') or ())
+        self.zones      = frozenset(settings.get('zones') or ())
+        self.between    = settings.get('between')
+        self.sinks      = frozenset(settings['sinks'])
+
+    def matches(self, code, event_type, zone):
+        return ((not self.codes or code in self.codes) and
+                (not self.types or event_type in self.types) and
+                (not self.zones or zone in self.zones))
+
+    def active(self, minute):
+        # Time windows may wrap past midnight, eg 22:00-06:00.
+        start, end = self.between
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+
+class Rules:
+
+    def __init__(self, settings=None, triggers=None):
+        # settings is the `rules` config section, triggers maps sink name to
+        # the event types it handles when no rule names it.
+        self.rules = [Rule(rule) for rule in settings or []]
+
+        self.sinks = set()
+        for rule in self.rules:
+            self.sinks.update(rule.sinks)
+
+        for sink, types in sorted((triggers or {}).items()):
+            if sink not in self.sinks:
+                self.rules.append(Rule({'name': sink + ' triggers', 'types': types, 'sinks': [sink]}))
+
+        self.by_code = {}
+        self.by_zone = {}
+        self.by_type = {}
+        self.wildcard = []
+
+        for rule in self.rules:
+            if rule.codes:
+                index, keys = self.by_code, rule.codes
+            elif rule.zones:
+                index, keys = self.by_zone, rule.zones
+            elif rule.types:
+                index, keys = self.by_type, rule.types
+            else:
+                self.wildcard.append(rule)
+                continue
+            for key in keys:
+                index.setdefault(key, []).append(rule)
+
+        self.memo = {}
+
+    def lookup(self, code, event_type, zone):
+        # Returns (period start minutes, sinks routed to in each period).
+        candidates = self.wildcard
+        for index, key in ((self.by_code, code), (self.by_zone, zone), (self.by_type, event_type)):
+            if key in index:
+                candidates = candidates + index[key]
+
+        sinks = set()
+        timed = []
+        for rule in candidates:
+            if rule.matches(code, event_type, zone):
+                if rule.between:
+                    timed.append(rule)
+                else:
+                    sinks.update(rule.sinks)
+
+        starts = set([0])
+        for rule in timed:
+            starts.update(minute % 1440 for minute in rule.between)
+        starts = sorted(starts)
+
+        periods = []
+        for start in starts:
+            period = set(sinks)
+            for rule in timed:
+                if rule.active(start):
+                    period.update(rule.sinks)
+            periods.append(frozenset(period))
+        return starts, periods
+
+    def route(self, event):
+        # Names of the sinks the event should be delivered to.
+        code = event.get('code')
+        if not isinstance(code, basestring):
+            code = None     # command echos carry a list
+        key = (code, event.get('type'), event.get('zone'))
+
+        try:
+            starts, periods = self.memo[key]
+        except KeyError:
+            if len(self.memo) >= MEMO_LIMIT:
+                self.memo = {}
+            starts, periods = self.memo[key] = self.lookup(*key)
+
+        if len(periods) == 1:
+            return periods[0]
+
+        try:
+            when = time.localtime(float(event['timestamp']))
+        except (KeyError, TypeError, ValueError):
+            when = time.localtime()
+        return periods[bisect.bisect_right(starts, when.tm_hour * 60 + when.tm_min) - 1]
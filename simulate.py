@@ -2,53 +2,107 @@
 #
 # Simulate each of the different alarm conditions.
 #
+# Run with --rate it's instead a load generator, putting events at the given
+# rate for --duration seconds to see how many events per second beanstalkd
+# and each of the sinks sustain:
+#
+#   ./simulate.py --rate 200 --duration 30 --profile storm
+#   ./simulate.py --rate 50 --mix info=90,alarm=5,621=1 --tubes alert_url
+#
+# Events are built from every response envisalinkd decodes (it's responses
+# table, for each configured zone and partition), so they're exactly what the
+# sinks would receive from the panel. Profiles shape when they're sent:
+#
+#   steady  Evenly spaced.
+#   storm   Everything for STORM_PERIOD seconds at once, then nothing, as
+#           when a break-in trips zone after zone.
+#   dump    Repeated status dumps, the burst of zone and partition events
+#           the panel sends in answer to a status report. Ignores --mix.
+#
+# The mix weighs event types and codes (any all digit key is a code), with
+# events picked uniformly within each. Sends are pipelined whenever the
+# generator falls behind, so it's limited by the queue rather than round
+# trips.
+#
 
 import socket
 import sys
 import time
-import datetime
-import string
-import re
-import signal
+import bisect
+import random
 import select
-import threading
-import yaml         # requires pyyaml third party package
-import beanstalkc   # requires beanstalkc third party package
+import argparse
+import json
+import config
+import priority
+import rules
+import tracing
+import transport
+
+
+# Frames for responses envisalinkd doesn't decode from it's tables.
+SAMPLE_DATA = {
+    '550': ['1230011919'],
+    '561': ['0021'],
+    '562': ['0004'],
+    '900': [''],
+    }
+
+DEFAULT_MIX = {
+    'steady':   'info=90,armed=2,disarmed=2,alarm=2,recovery=2,fault=2',
+    'storm':    'alarm=6,recovery=3,fault=1',
+    'dump':     '',
+    }
+
+STORM_PERIOD = 5.0
+
+# What the panel reports in a status dump.
+DUMP_CODES = ('510', '511', '610', '650', '655', '841', '849')
 
 class HowAlarmingCLI:
     def __init__(self):
         # Load configuration from YAML file and assign configuration values.
         try:
-            self.config         = yaml.load(open('config.yaml', 'r'))
+            self.config         = config.load()
 
-            # Beanstalkd Message Queue settings
-            self.beanstalk_host             = self.config['beanstalkd']['host']
-            self.beanstalk_port             = int(self.config['beanstalkd']['port'])
+            # Message Queue settings
             self.beanstalk_tubes_commands   = self.config['beanstalkd']['tubes']['commands']
             self.beanstalk_tubes_events     = self.config['beanstalkd']['tubes']['events']
 
+            self.priorities = priority.Policy(self.config.get('priorities'))
+            self.routes     = rules.Rules(self.config.get('rules'))
+
         except IOError:
             print 'Fatal: Could not open configuration file'
             raise
 
+        except config.ConfigError as err:
+            print 'Fatal: Invalid configuration, ' + str(err)
+            raise
+
         except (KeyError, AttributeError) as err:
             print 'Fatal: Unable to find required configuration in config.yaml'
             raise
 
 
     def beanstalk_connect(self):
+        # The in-process broker lives inside envisalinkd, we can't reach it.
+        if transport.backend(self.config) == 'inprocess':
+            print 'Fatal: The inprocess transport can only be used by envisalinkd and the dispatcher'
+            raise BaseException
+
         try:
-            self.beanstalk = beanstalkc.Connection(host=self.beanstalk_host, port=self.beanstalk_port)
-            print 'system: Beanstalkd connected on ' + str(self.beanstalk_host) + ' on port ' + str(self.beanstalk_port)
-        except socket.error, (value,message):
-            print "Fatal: Unable to connect to beanstalkd"
+            self.beanstalk = transport.connect(self.config)
+            print 'system: connected to ' + transport.describe(self.config)
+        except transport.TransportError:
+            print "Fatal: Unable to connect to " + transport.describe(self.config)
             raise
 
     def beanstalk_push(self, message):
         # Send outputs to all defined event tubes (queues in beanstalk speak).
-        for tube in self.beanstalk_tubes_events:
-            self.beanstalk.use(tube)
-            self.beanstalk.put(message)
+        message_priority = self.priorities.priority(json.loads(message))
+
+        self.beanstalk.put(self.beanstalk_tubes_events, message, priority=message_priority)
         return
 
     def keyboard_poll(self):
@@ -63,29 +117,233 @@ class HowAlarmingCLI:
 		timestamp = str(int(time.time()))
 
                 if k == 'command':
-                    self.beanstalk_push('{"type": "command", "code": "123", "message": "Arm alarm command issued", "raw": "123 command issued", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "command", "code": "123", "message": "Arm alarm command issued", "raw": "123 command issued", "timestamp": '+ timestamp +'}')
                 elif k == 'info':
-                    self.beanstalk_push('{"type": "info", "code": "236", "message": "Some kind of general information event occured", "raw": "236 INFO GENERAL", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "info", "code": "236", "message": "Some kind of general information event occured", "raw": "236 INFO GENERAL", "timestamp": '+ timestamp +'}')
                 elif k == 'armed':
-                    self.beanstalk_push('{"type": "armed", "code": "535", "message": "Alarm now armed", "raw": "535 ARMED", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "armed", "code": "535", "message": "Alarm now armed", "raw": "535 ARMED", "timestamp": '+ timestamp +'}')
                 elif k == 'disarmed':
-                    self.beanstalk_push('{"type": "disarmed", "code": "525", "message": "Alarm is disarmed", "raw": "525 disarmed", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "disarmed", "code": "525", "message": "Alarm is disarmed", "raw": "525 disarmed", "timestamp": '+ timestamp +'}')
                 elif k == 'response':
-                    self.beanstalk_push('{"type": "response", "code": "123", "message": "ACK of command", "raw": "123 response", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "response", "code": "123", "message": "ACK of command", "raw": "123 response", "timestamp": '+ timestamp +'}')
                 elif k == 'alarm':
-                    self.beanstalk_push('{"type": "alarm", "code": "911", "message": "Alarm triggered in sector 5", "raw": "911 ALARM ALARM", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "alarm", "code": "911", "message": "Alarm triggered in sector 5", "raw": "911 ALARM ALARM", "timestamp": '+ timestamp +'}')
                 elif k == 'recovery':
-                    self.beanstalk_push('{"type": "recovery", "code": "1332", "message": "Alarm recovered", "raw": "1332 recovery", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "recovery", "code": "1332", "message": "Alarm recovered", "raw": "1332 recovery", "timestamp": '+ timestamp +'}')
                 elif k == 'fault':
-                    self.beanstalk_push('{"type": "fault", "code": "666", "message": "Flux Capaciter Failed", "raw": "666 FLUXERR", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "fault", "code": "666", "message": "Flux Capaciter Failed", "raw": "666 FLUXERR", "timestamp": '+ timestamp +'}')
                 elif k == 'unknown':
-                    self.beanstalk_push('{"type": "unknown", "code": "???", "message": "unknown", "raw": "Unknown error, there\s no helping you now son", "timestamp": "'+ timestamp +'"}')
+                    self.beanstalk_push('{"type": "unknown", "code": "???", "message": "unknown", "raw": "Unknown error, there\'s no helping you now son", "timestamp": '+ timestamp +'}')
                 else:
                     print "Request a specific alarm event to simulate from: [command|info|armed|disarmed|response|alarm|recovery|fault|unknown]"
         return
 
+    def tubes(self, event, tubes=None):
+        # As envisalinkd would route it, unless given tubes.
+        if tubes:
+            return tubes
+        if self.routes.sinks:
+            routed = self.routes.route(event)
+            return [tube for tube in self.beanstalk_tubes_events if tube in routed or tube not in self.routes.sinks]
+        return self.beanstalk_tubes_events
+
+    def load(self, options):
+        templates = build_templates()
+        schedule = PROFILES[options.profile](options.rate, templates, Mix(options.mix or DEFAULT_MIX[options.profile], templates))
+        tubes = split(options.tubes)
+        traced = bool((self.config.get('trace') or {}).get('enabled'))
+
+        print 'system: sending ' + options.profile + ' load at ' + str(options.rate) + ' events/s for ' + str(options.duration) + ' seconds'
+
+        pending = []
+        sent = 0
+        self.sending = 0.0
+        behind = 0.0
+        begin = time.time()
+        second = begin + 1
+        counted = 0
+
+        for offset, template in schedule:
+            if offset >= options.duration:
+                break
+
+            wait = begin + offset - time.time()
+            if wait > 0:
+                # Caught up, send what's queued before sleeping.
+                self.send(pending)
+                sent += len(pending)
+                pending = []
+                wait = begin + offset - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            behind = max(behind, -wait)
+
+            event = dict(template)
+            event['timestamp'] = int(time.time())
+            if traced:
+                # Never saw a panel, so traced from publishing.
+                event['trace'] = tracing.start()
+                event['trace']['publish'] = tracing.clock()
+            pending.append((self.tubes(event, tubes), json.dumps(event), self.priorities.priority(event)))
+            if len(pending) >= transport.PIPELINE:
+                self.send(pending)
+                sent += len(pending)
+                pending = []
+
+            if time.time() >= second:
+                print 'system: %d events/s, %.1fs behind' % (sent - counted, max(0.0, -wait))
+                counted = sent
+                second += 1
+
+        self.send(pending)
+        sent += len(pending)
+        elapsed = time.time() - begin
+
+        # Sending rate is what the queue accepted while it was kept busy,
+        # the most it sustains when the generator is behind.
+        print 'system: sent %d events in %.1fs, %.1f events/s (%.1f requested), at most %.2fs behind' % (sent, elapsed, sent / elapsed, options.rate, behind)
+        print 'system: %.1fs spent sending, %.1f events/s while sending' % (self.sending, sent / max(self.sending, 1e-6))
+
+    def send(self, puts):
+        if puts:
+            begin = time.time()
+            self.beanstalk.put_many(puts)
+            self.sending += time.time() - begin
+
+
+def build_templates():
+    # code -> every event envisalinkd reports for it, found by decoding a
+    # frame for each configured zone and partition.
+    import envisalinkd
+    e = envisalinkd.Envisalink()
+    e.resetData()
+    e.tracing = False
+    e.panelstate.changed = lambda event: True
+    events = []
+    e.printNormal = lambda msg: None
+    e.sendCommand = lambda *args: None
+    e.beanstalk_push = events.append
+
+    sample = dict(SAMPLE_DATA)
+    sample['500'] = sorted(e.commands)
+    sample['502'] = sorted(e.errorCodes)
+    sample['505'] = ['1', '3']
+
+    for cmd in sorted(e.responses):
+        if cmd in e.decoders:
+            start, end, table = e.decoders[cmd]
+            # Hex bitmasks are in the tables in both cases.
+            data = [key for key in sorted(table) if key == key.upper()]
+        else:
+            data = sample.get(cmd, [])
+        for key in data:
+            e.decodeResponse(cmd + key)
+
+    templates = {}
+    for event in events:
+        del event['timestamp']
+        templates.setdefault(event['code'], []).append(event)
+    return templates
+
+
+class Mix:
+    # Picks events according to weights given as "key=weight,..." where a key
+    # is an event type or code.
+
+    def __init__(self, spec, templates):
+        self.cumulative = []
+        self.choices = []
+        total = 0.0
+
+        for item in split([spec]):
+            key, _, weight = item.partition('=')
+            if key.isdigit():
+                codes = [key] if key in templates else []
+            else:
+                codes = sorted(code for code, events in templates.items() if events[0]['type'] == key)
+            if not codes:
+                print 'Fatal: No events of type or code ' + key + ' to simulate'
+                raise BaseException
+
+            total += float(weight or 1)
+            self.cumulative.append(total)
+            self.choices.append([templates[code] for code in codes])
+        self.total = total
+
+    def pick(self):
+        events = self.choices[bisect.bisect(self.cumulative, random.random() * self.total)]
+        return random.choice(random.choice(events))
+
+
+def steady(rate, templates, mix):
+    i = 0
+    while True:
+        yield i / rate, mix.pick()
+        i += 1
+
+
+def storm(rate, templates, mix):
+    size = max(1, int(rate * STORM_PERIOD))
+    period = size / rate
+    burst = 0
+    while True:
+        for i in xrange(size):
+            yield burst * period, mix.pick()
+        burst += 1
+
+
+def dump(rate, templates, mix):
+    # Bitmask codes report once, not once per value.
+    events = []
+    for code in DUMP_CODES:
+        if code in ('510', '511', '849'):
+            events.extend(templates.get(code, [])[:1])
+        else:
+            events.extend(templates.get(code, []))
+
+    period = len(events) / rate
+    burst = 0
+    while True:
+        for event in events:
+            yield burst * period, event
+        burst += 1
+
+
+PROFILES = {
+    'steady':   steady,
+    'storm':    storm,
+    'dump':     dump,
+    }
+
+
+def split(values):
+    return [value for option in values or [] for value in option.split(',') if value]
+
 
 if __name__ == '__main__':
+        parser = argparse.ArgumentParser(description='Simulate alarm events, interactively or as a load generator')
+        parser.add_argument('--rate', type=float, help='generate load at this many events per second')
+        parser.add_argument('--duration', type=float, default=10, help='seconds of load to generate (default 10)')
+        parser.add_argument('--profile', choices=sorted(PROFILES), default='steady', help='shape of the load (default steady)')
+        parser.add_argument('--mix', help='weights of event types and codes, eg info=90,alarm=5,621=1')
+        parser.add_argument('--tubes', action='append', help='only put to these tubes, rather than routing as envisalinkd would')
+        parser.add_argument('--seed', type=int, help='random seed, for repeatable runs')
+        options = parser.parse_args()
+
+        if options.rate is not None:
+            if options.rate <= 0:
+                parser.error('--rate must be positive')
+            random.seed(options.seed)
+            try:
+                c = HowAlarmingCLI()
+                c.beanstalk_connect()
+                c.load(options)
+            except KeyboardInterrupt:
+                print 'system: User Terminated'
+            except transport.TransportError, err:
+                print 'system: transport error ' + str(err)
+            sys.exit(0)
+
         try:
             c = HowAlarmingCLI()
             c.beanstalk_connect()
@@ -98,3 +356,5 @@ if __name__ == '__main__':
             print 'system: User Terminated'
         except socket.error, err:
             print 'system: socket error ' + str(err[0])
+        except transport.TransportError, err:
+            print 'system: transport error ' + str(err)
@@ -0,0 +1,195 @@
+#! /usr/bin/env python
+#
+# Store-and-forward spool for the alert sinks. When a sink can't deliver an
+# event (SMTP relay or webhook down), the consumer writes it here and moves
+# on, rather than holding it on the queue. A retrier per sink then delivers
+# the spool oldest first, backing off while the sink is still failing. Fresh
+# events are still tried straight away, so they aren't held up behind the
+# backlog.
+#
+# Each spool is an append-only journal of JSON lines, an `add` record for
+# each event spooled (again if it's replaced) and a `done` record once it's
+# delivered (or evicted).
+# Appends are made durable with group commit: each waits on an fsync, but
+# one fsync covers every append made before it, so concurrent workers share
+# them rather than queueing one each. The journal is compacted down to the
+# outstanding events when it's mostly done records, and on load.
+#
+# The spool's events are held within `spool_max_bytes`. Once full, the least
+# important events (by queue priority, see priority.py) are evicted first,
+# oldest first among equals, so a backlog of info events never pushes out an
+# alarm.
+#
+
+import os
+import json
+import threading
+import collections
+
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+# Compact once done records outnumber outstanding events by this much.
+COMPACT_RATIO = 4
+COMPACT_MIN = 1000
+
+
+class Spool:
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+        self.entries = collections.OrderedDict()   # id -> (priority, body)
+        self.bytes = 0
+        self.next_id = 1
+        self.dead = 0           # done records in the journal
+        self.written = 0        # appends made
+        self.synced = 0         # appends covered by an fsync
+
+        self.load()
+
+    def load(self):
+        # Replay the journal, then rewrite it with just what's outstanding.
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # torn write at the end of the journal
+                    if 'add' in record:
+                        self.entries[record['add']] = (record['pri'], record['body'].encode('utf-8'))
+                        self.next_id = max(self.next_id, record['add'] + 1)
+                    elif record.get('done') in self.entries:
+                        del self.entries[record['done']]
+        except IOError:
+            pass
+
+        self.bytes = sum(len(body) for priority, body in self.entries.values())
+        self.compact()
+
+    def compact(self):
+        # Must hold lock, or be loading.
+        temp = self.path + '.' + str(os.getpid())
+        with open(temp, 'w') as f:
+            for jid, (priority, body) in self.entries.items():
+                f.write(json.dumps({'add': jid, 'pri': priority, 'body': body}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.path)
+
+        if hasattr(self, 'file'):
+            self.file.close()
+        self.file = open(self.path, 'a')
+        self.dead = 0
+
+    def append(self, record):
+        # Must hold lock. Returns the append's number, to pass to sync.
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.written += 1
+        return self.written
+
+    def sync(self, number):
+        # Wait until append number is on disk, sharing the fsync with any
+        # other appends made meanwhile.
+        self.sync_lock.acquire()
+        try:
+            if self.synced >= number:
+                return
+            # The descriptor is dup'd so appends can carry on during the
+            # fsync, and compact can close (and reopen) the journal, it
+            # fsyncs the journal it writes itself.
+            self.lock.acquire()
+            try:
+                written = self.written
+                fileno = os.dup(self.file.fileno())
+            finally:
+                self.lock.release()
+            try:
+                os.fsync(fileno)
+            finally:
+                os.close(fileno)
+            self.synced = written
+        finally:
+            self.sync_lock.release()
+
+    def add(self, body, priority):
+        # Spool an event, returning the events evicted to make room for it.
+        self.lock.acquire()
+        try:
+            jid = self.next_id
+            self.next_id += 1
+            number = self.append({'add': jid, 'pri': priority, 'body': body})
+            self.entries[jid] = (priority, body)
+            self.bytes += len(body)
+
+            evicted = []
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                # Highest priority number is least important, the first of
+                # them in the ordered dict the oldest.
+                victim = max(self.entries, key=lambda key: (self.entries[key][0], -key))
+                evicted.append(self.entries[victim][1])
+                self.remove(victim)
+            self.ready.notify_all()
+        finally:
+            self.lock.release()
+
+        self.sync(number)
+        return evicted
+
+    def replace(self, jid, body):
+        # Swap the body of a spooled event, keeping it's place (eg narrowed
+        # to the destinations still failing).
+        self.lock.acquire()
+        try:
+            if jid not in self.entries:
+                return
+            priority, previous = self.entries[jid]
+            number = self.append({'add': jid, 'pri': priority, 'body': body})
+            self.entries[jid] = (priority, body)
+            self.bytes += len(body) - len(previous)
+            self.dead += 1
+        finally:
+            self.lock.release()
+
+        self.sync(number)
+
+    def remove(self, jid):
+        # Must hold lock.
+        priority, body = self.entries.pop(jid)
+        self.bytes -= len(body)
+        self.append({'done': jid})
+        self.dead += 1
+        if self.dead > COMPACT_MIN and self.dead > len(self.entries) * COMPACT_RATIO:
+            self.compact()
+
+    def done(self, jid):
+        # The event has been delivered. Not synced, at worst it's delivered
+        # again after a crash.
+        self.lock.acquire()
+        try:
+            if jid in self.entries:
+                self.remove(jid)
+        finally:
+            self.lock.release()
+
+    def oldest(self, timeout=None):
+        # Returns (id, body) of the oldest event, waiting up to timeout
+        # seconds for one, or None.
+        self.lock.acquire()
+        try:
+            if not self.entries:
+                self.ready.wait(timeout)
+            for jid, (priority, body) in self.entries.items():
+                return jid, body
+            return None
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
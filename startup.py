@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+#
+# Startup time profiling for the daemons. Pass --profile-startup to any of
+# envisalinkd, dispatcher or the alert_* consumers and they will report how
+# long the interpreter, each import and each initialisation phase took, then
+# exit rather than entering their main loop. Handy for keeping restart time
+# down on small hosts where systemd respawns are part of recovering from a
+# fault.
+#
+# Optionally give a budget in milliseconds (eg --profile-startup=500) and the
+# exit status will be 1 if the total startup time exceeds it.
+#
+# This module needs to be the first import of the application so it can time
+# the imports that follow it. When profiling isn't requested it does nothing
+# beyond checking the command line.
+#
+
+import os
+import sys
+import time
+import __builtin__
+
+
+enabled = False
+budget = None
+
+for arg in sys.argv[1:]:
+    if arg == '--profile-startup' or arg.startswith('--profile-startup='):
+        enabled = True
+        if '=' in arg:
+            budget = float(arg.split('=', 1)[1])
+        sys.argv.remove(arg)
+        break
+
+started = time.time()
+last = started
+interpreter = 0.0
+phases = []
+imports = []
+
+original_import = __builtin__.__import__
+depth = [0]
+
+
+def process_age():
+    # Time since the process was exec'd, to capture the interpreter's own
+    # startup before we got control. Linux only, zero elsewhere.
+    try:
+        ticks = float(open('/proc/self/stat').read().rsplit(')', 1)[1].split()[19])
+        uptime = float(open('/proc/uptime').read().split()[0])
+        return max(0.0, uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return 0.0
+
+
+def timed_import(name, *args, **kwargs):
+    # Records how long the first import of each module takes, nested two
+    # deep so the report shows what pulled in the heavy libraries.
+    if name in sys.modules or depth[0] > 1:
+        return original_import(name, *args, **kwargs)
+
+    entry = [depth[0], name, 0]
+    imports.append(entry)
+    depth[0] += 1
+    begin = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        entry[2] = time.time() - begin
+
+
+def phase(name):
+    # Mark the end of a named startup phase.
+    global last
+    if enabled:
+        now = time.time()
+        phases.append((name, now - last))
+        last = now
+
+
+def finish():
+    # Report and exit, if profiling.
+    if not enabled:
+        return
+
+    __builtin__.__import__ = original_import
+
+    print 'startup: %-28s %8.1f ms' % ('interpreter', interpreter * 1000)
+    for name, duration in phases:
+        print 'startup: %-28s %8.1f ms' % (name, duration * 1000)
+        if name == 'imports':
+            for level, module, seconds in imports:
+                print 'startup: %-28s %8.1f ms' % ('  ' * (level + 1) + module, seconds * 1000)
+
+    total = interpreter + (last - started)
+    if budget is None:
+        print 'startup: %-28s %8.1f ms' % ('total', total * 1000)
+        sys.exit(0)
+
+    print 'startup: %-28s %8.1f ms (budget %.0f ms)' % ('total', total * 1000, budget)
+    sys.exit(1 if total * 1000 > budget else 0)
+
+
+if enabled:
+    interpreter = process_age() - (time.time() - started)
+    __builtin__.__import__ = timed_import
@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+#
+# envisalinkd's live panel state published to a small memory mapped file
+# (`state_map` under `envisalinkd`), for local tools (dashboards, home
+# automation bridges, `cli.py --state`) that want the current arming and zone
+# states. Reading it is just reading memory: no socket, no queue traffic and
+# no commands sent to the panel, however many readers there are or however
+# often they look.
+#
+# The file has a fixed layout, all little endian:
+#
+#   offset  size
+#   0       8       magic "HOWALARM"
+#   8       4       layout version (1)
+#   12      4       sequence, odd while being written
+#   16      8       unix time of the last change (signed)
+#   24      1       connection status, index into SYSTEM
+#   25      1       keypad LEDs lit, bit per LEDS
+#   26      1       keypad LEDs flashing, bit per LEDS
+#   27      5       unused
+#   32      4 x 8   partitions 1 to 8: state (index into PARTITION), ready
+#                   (0 unknown, 1 not ready, 2 ready), arming mode ('0' to
+#                   '3', 0 if not armed), unused
+#   64      64      zones 1 to 64, one byte of ZONE_* flags each
+#
+# Writes are guarded by a seqlock: the writer makes the sequence odd, writes
+# the state and makes it even again. A reader copies the state between
+# reading the sequence twice, and tries again if it was odd or has changed,
+# so never sees a half written state and never holds up the writer.
+#
+# The file is updated in place, so readers can keep it mapped across
+# envisalinkd restarts.
+#
+
+import os
+import mmap
+import time
+import struct
+
+
+MAGIC = 'HOWALARM'
+VERSION = 1
+SIZE = 128
+
+HEADER = struct.Struct('<8sII')
+STATE = struct.Struct('<qBBB5x' + '4B' * 8 + '64B')
+SEQUENCE_OFFSET = 12
+STATE_OFFSET = 16
+
+PARTITIONS = 8
+ZONES = 64
+
+SYSTEM = ('unknown', 'connected', 'logged in', 'armed', 'disarmed')
+PARTITION = (None, 'disarmed', 'armed', 'exit delay', 'entry delay', 'arming', 'alarm', 'keypad lockout', 'failed to arm', 'busy')
+LEDS = ('ready', 'armed', 'memory', 'bypass', 'trouble', 'program', 'fire', 'backlight')
+
+ZONE_OPEN = 1
+ZONE_ALARM = 2
+ZONE_TAMPER = 4
+ZONE_FAULT = 8
+ZONE_REPORTED = 128     # the panel has reported the zone
+ZONE_FLAGS = (('open', ZONE_OPEN), ('alarm', ZONE_ALARM), ('tamper', ZONE_TAMPER), ('fault', ZONE_FAULT))
+
+# Reads attempted before giving up on a writer that never finishes.
+READ_ATTEMPTS = 10000
+
+# Decoding tables, zone ids and each flags byte's zone state.
+ZONE_IDS = ['%03d' % (index + 1) for index in range(ZONES)]
+ZONE_STATES = [tuple((name, bool(flags & flag)) for name, flag in ZONE_FLAGS) for flags in range(256)]
+LED_NAMES = [[led for bit, led in enumerate(LEDS) if bits & (1 << bit)] for bits in range(256)]
+
+
+def leds(names):
+    bits = 0
+    for name in names:
+        if name in LEDS:
+            bits |= 1 << LEDS.index(name)
+    return bits
+
+
+def encode(state, system):
+    # Pack a query.State snapshot.
+    values = [int(state.get('updated') or 0), SYSTEM.index(system) if system in SYSTEM else 0,
+              leds(state['keypad'].get('lit', [])), leds(state['keypad'].get('flashing', []))]
+
+    for partition in range(1, PARTITIONS + 1):
+        current = state['partitions'].get(str(partition), {})
+        ready = current.get('ready')
+        mode = current.get('mode') if current.get('state') == 'armed' else None
+        values.extend((PARTITION.index(current.get('state')) if current.get('state') in PARTITION else 0,
+                       0 if ready is None else 2 if ready else 1,
+                       ord(mode) if mode else 0,
+                       0))
+
+    flags = [0] * ZONES
+    for zone, current in state['zones'].items():
+        index = int(zone) - 1
+        if 0 <= index < ZONES:
+            flags[index] = ZONE_REPORTED | sum(flag for name, flag in ZONE_FLAGS if current.get(name))
+    values.extend(flags)
+    return STATE.pack(*values)
+
+
+def decode(data, sequence):
+    values = STATE.unpack(data)
+    updated, system, lit, flashing = values[:4]
+
+    partitions = {}
+    for index in range(PARTITIONS):
+        state, ready, mode, unused = values[4 + index * 4:8 + index * 4]
+        if state or ready:
+            current = partitions[str(index + 1)] = {}
+            if state:
+                current['state'] = PARTITION[state] if state < len(PARTITION) else None
+            if ready:
+                current['ready'] = ready == 2
+            if mode:
+                current['mode'] = chr(mode)
+
+    zones = {}
+    for zone, flags in zip(ZONE_IDS, values[4 + PARTITIONS * 4:]):
+        if flags & ZONE_REPORTED:
+            zones[zone] = dict(ZONE_STATES[flags])
+
+    return {
+        'sequence':     sequence,
+        'updated':      updated or None,
+        'system':       SYSTEM[system] if system < len(SYSTEM) else 'unknown',
+        'partitions':   partitions,
+        'zones':        zones,
+        'keypad':       {'lit': list(LED_NAMES[lit]), 'flashing': list(LED_NAMES[flashing])},
+        }
+
+
+class Publisher:
+    # The writer, envisalinkd.
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size != SIZE:
+                os.ftruncate(fd, SIZE)
+            self.map = mmap.mmap(fd, SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        # Carry on from the sequence already there, clearing the state like
+        # any other write, so readers that have kept it mapped see the change
+        # rather than the state from before the restart.
+        magic, version, sequence = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            sequence = 0
+        self.sequence = (sequence + (sequence & 1)) & 0xFFFFFFFF
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.sequence)
+        self.write('\0' * (SIZE - STATE_OFFSET))
+        self.published = None
+
+    def write(self, data):
+        struct.pack_into('<I', self.map, SEQUENCE_OFFSET, (self.sequence + 1) & 0xFFFFFFFF)
+        self.map[STATE_OFFSET:SIZE] = data
+        self.sequence = (self.sequence + 2) & 0xFFFFFFFF
+        struct.pack_into('<I', self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def publish(self, version, state, system):
+        # Only written if the state's version or the connection status
+        # changed since last time.
+        if self.published == (version, system):
+            return False
+        self.write(encode(state, system))
+        self.published = (version, system)
+        return True
+
+    def close(self):
+        self.map.close()
+
+
+class Reader:
+    # Reads the state published by envisalinkd, eg:
+    #
+    #   state = statemap.Reader('/dev/shm/howalarming.state')
+    #   print state.read()['partitions']['1']['state']
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+        magic, version, sequence = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(path + ' is not a HowAlarming state map (version ' + str(VERSION) + ')')
+
+    def sequence(self):
+        # Changes whenever the state does, cheap to poll for changes.
+        return struct.unpack_from('<I', self.map, SEQUENCE_OFFSET)[0]
+
+    def read(self):
+        for attempt in xrange(READ_ATTEMPTS):
+            before = struct.unpack_from('<I', self.map, SEQUENCE_OFFSET)[0]
+            if before & 1:
+                time.sleep(0)   # mid write, let the writer finish
+                continue
+            data = self.map[STATE_OFFSET:SIZE]
+            if struct.unpack_from('<I', self.map, SEQUENCE_OFFSET)[0] == before:
+                return decode(data, before)
+        raise IOError('state map ' + self.path + ' is stuck mid write')
+
+    def close(self):
+        self.map.close()
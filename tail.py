@@ -0,0 +1,190 @@
+#! /usr/bin/env python
+#
+# Live feed of alarm events for any number of viewers (eg `cli.py --tail`),
+# served by envisalinkd on a Unix domain socket. Unlike the tubes, watching
+# the feed doesn't consume anything, so viewers can come and go without
+# affecting each other or the alert sinks.
+#
+# A viewer connects and sends one JSON line with it's filters, eg:
+#
+#   {"history": 20, "types": ["alarm", "fault"], "codes": ["621"], "zones": ["005"]}
+#
+# All keys are optional. It's sent the most recent `history` matching events
+# from a ring buffer, then each matching event as it happens, one JSON
+# message per line.
+#
+# Every viewer has a bounded queue of it's own, so a viewer that stops
+# reading only loses events itself and never holds up envisalinkd.
+#
+
+import os
+import json
+import socket
+import Queue
+import threading
+import collections
+import SocketServer
+
+
+DEFAULT_SOCKET = '/tmp/howalarming-tail.sock'
+DEFAULT_HISTORY = 100
+
+# Events buffered per viewer before it starts losing them.
+BACKLOG = 1000
+
+
+class Filter:
+
+    def __init__(self, request):
+        self.types = frozenset(request.get('types') or ())
+        self.codes = frozenset(str(code).zfill(3) for code in request.get('codes') or ())
+        self.zones = frozenset(str(zone).zfill(3) for zone in request.get('zones') or ())
+
+    def matches(self, event):
+        code = event.get('code')
+        return ((not self.types or event.get('type') in self.types) and
+                (not self.codes or (isinstance(code, basestring) and code in self.codes)) and
+                (not self.zones or event.get('zone') in self.zones))
+
+
+class Viewer:
+
+    def __init__(self, filter):
+        self.filter = filter
+        self.queue = Queue.Queue(BACKLOG)
+        self.dropped = 0
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        feed = self.server.feed
+
+        try:
+            request = json.loads(self.rfile.readline() or '{}')
+            if not isinstance(request, dict):
+                raise ValueError('filters must be an object')
+            history = int(request.get('history') or 0)
+        except (ValueError, TypeError) as err:
+            self.send(json.dumps({'error': 'bad request: ' + str(err)}))
+            return
+
+        viewer = Viewer(Filter(request))
+        history = feed.subscribe(viewer, history)
+        try:
+            for line in history:
+                self.send(line)
+
+            while True:
+                line = viewer.queue.get()
+                if viewer.dropped:
+                    self.send(json.dumps({'type': 'info', 'code': 'tail', 'message': str(viewer.dropped) + ' events not shown, viewer too slow'}))
+                    viewer.dropped = 0
+                self.send(line)
+        except socket.error:
+            pass
+        finally:
+            feed.unsubscribe(viewer)
+
+    def send(self, line):
+        self.wfile.write(line + '\n')
+        self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Feed:
+
+    def __init__(self, path=DEFAULT_SOCKET, history=DEFAULT_HISTORY):
+        self.path = path
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=history)
+        self.viewers = []
+
+    def start(self):
+        # Remove a stale socket left behind by a previous run.
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.server = Server(self.path, Handler)
+        self.server.feed = self
+        os.chmod(self.path, 0660)
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, event, line):
+        # event is the decoded message, line it's JSON encoding.
+        self.lock.acquire()
+        try:
+            self.history.append((event, line))
+            for viewer in self.viewers:
+                if viewer.filter.matches(event):
+                    try:
+                        viewer.queue.put_nowait(line)
+                    except Queue.Full:
+                        viewer.dropped += 1
+        finally:
+            self.lock.release()
+
+    def subscribe(self, viewer, history):
+        # Returns the most recent history lines matching the viewer's
+        # filters, atomically with it starting to receive new ones.
+        self.lock.acquire()
+        try:
+            self.viewers.append(viewer)
+            if history <= 0:
+                return []
+            lines = [line for event, line in self.history if viewer.filter.matches(event)]
+            return lines[-history:]
+        finally:
+            self.lock.release()
+
+    def recent(self, filter, limit=None, since=None):
+        # Lines of the most recent matching events, oldest first, going back
+        # no further than the unix time since.
+        self.lock.acquire()
+        try:
+            history = list(self.history)
+        finally:
+            self.lock.release()
+
+        lines = []
+        for event, line in reversed(history):
+            stamp = event.get('timestamp')
+            if since is not None and stamp is not None and stamp < since:
+                break
+            if filter.matches(event):
+                lines.append(line)
+                if len(lines) == limit:
+                    break
+        lines.reverse()
+        return lines
+
+    def unsubscribe(self, viewer):
+        self.lock.acquire()
+        try:
+            self.viewers.remove(viewer)
+        finally:
+            self.lock.release()
+
+
+def follow(path, history=0, types=None, codes=None, zones=None):
+    # Client side, yields each event line from the feed.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(json.dumps({'history': history, 'types': types, 'codes': codes, 'zones': zones}) + '\n')
+
+    stream = sock.makefile('rb')
+    try:
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            yield line.rstrip('\n')
+    finally:
+        stream.close()
+        sock.close()
@@ -0,0 +1,79 @@
+#
+# Shared helpers for the tests: scratch configurations and a stub HTTP server
+# standing in for the endpoints the alert sinks deliver to.
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import yaml
+import config
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def settings(**sections):
+    # Minimal valid configuration data, with the given sections added.
+    data = {
+        'beanstalkd':   {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': []}},
+        'transport':    {'backend': 'inprocess'},
+        }
+    data.update(sections)
+    return data
+
+
+class Scratch:
+    # A temporary directory holding a config.yaml, removed on close.
+
+    def __init__(self, data):
+        self.path = tempfile.mkdtemp(prefix='howalarming-test-')
+        self.config_path = os.path.join(self.path, 'config.yaml')
+        with open(self.config_path, 'w') as f:
+            yaml.safe_dump(data, f, default_flow_style=False)
+
+    def load(self):
+        return config.load(self.config_path)
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Endpoint:
+    # HTTP server answering every request with status (settable while
+    # running), recording the paths requested.
+
+    def __init__(self, status=200):
+        self.status = status
+        self.requests = []
+        endpoint = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                endpoint.requests.append((self.command, self.path, self.rfile.read(length)))
+                self.send_response(endpoint.status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = respond
+            do_POST = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_port) + '/'
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def paths(self):
+        return [path for command, path, body in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
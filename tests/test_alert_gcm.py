@@ -0,0 +1,194 @@
+#
+# alert_gcm against a local stub of the FCM v1 push API.
+#
+
+import json
+import time
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+import alert_gcm
+import consumer
+import transport
+from tests import support
+
+
+DEVICES = ['device-a-token', 'device-b-token', 'device-c-token']
+
+STATUS = {400: 'INVALID_ARGUMENT', 401: 'UNAUTHENTICATED', 404: 'UNREGISTERED', 429: 'QUOTA_EXCEEDED'}
+
+
+class PushService:
+    # Accepts every push, except that the statuses queued in failures for a
+    # token (or topic) are answered first, one per push. Records the target,
+    # authorization and client port of each push.
+
+    def __init__(self):
+        self.failures = {}
+        self.retry_after = None
+        self.pushes = []
+        service = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['message']
+                target = message.get('token') or '/topics/' + message['topic']
+                service.pushes.append((target, self.headers.get('Authorization'), self.client_address[1], message))
+
+                status = 200
+                if service.failures.get(target):
+                    status = service.failures[target].pop(0)
+                body = json.dumps({'name': 'projects/test/messages/1'} if status == 200 else {'error': {'code': status, 'status': STATUS.get(status, 'UNAVAILABLE')}})
+                self.send_response(status)
+                if status != 200 and service.retry_after is not None:
+                    self.send_header('Retry-After', str(service.retry_after))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:' + str(self.server.server_port) + '/v1/projects/test/messages:send'
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def targets(self):
+        return [push[0] for push in self.pushes]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Credentials:
+    # Stands in for the service account's OAuth2 tokens.
+
+    def __init__(self, path, session):
+        self.project_id = 'test'
+
+    def token(self):
+        return 'test-token'
+
+
+class StubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.credentials, alert_gcm.Credentials = alert_gcm.Credentials, Credentials
+        self.backoff, alert_gcm.BACKOFF = alert_gcm.BACKOFF, 0.05
+        self.service = PushService()
+
+    def tearDown(self):
+        alert_gcm.Credentials = self.credentials
+        alert_gcm.BACKOFF = self.backoff
+        self.service.close()
+
+
+class PushTest(StubTestCase):
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.alerter = alert_gcm.Alerter({'service_account': 'test.json', 'devices': DEVICES, 'topic': 'howalarming', 'url': self.service.url})
+        self.event = {'type': 'alarm', 'code': '601', 'zone': '005', 'message': 'Fire Alarm', 'sequence': {'event': 7}}
+
+    def handle(self):
+        self.alerter.handle(self.event, json.dumps(self.event))
+
+    def test_connection_reused(self):
+        for i in range(3):
+            self.handle()
+        self.assertEqual(len(self.service.pushes), 3 * (len(DEVICES) + 1))
+        self.assertEqual(len(set(push[2] for push in self.service.pushes)), 1)
+
+    def test_devices_batched(self):
+        # One push per device and the topic, each the same message.
+        self.handle()
+        self.assertEqual(self.service.targets(), DEVICES + ['/topics/howalarming'])
+        self.assertEqual(set(push[1] for push in self.service.pushes), set(['Bearer test-token']))
+
+        message = self.service.pushes[0][3]
+        self.assertEqual(message['data']['message'], 'Fire Alarm')
+        self.assertEqual(json.loads(message['data']['sequence']), {'event': 7})
+        self.assertEqual(message['android']['priority'], 'HIGH')
+        for push in self.service.pushes[1:]:
+            self.assertEqual(dict(push[3], token=None, topic=None), dict(message, token=None, topic=None))
+
+    def test_backoff_on_server_error(self):
+        # Failing devices are retried together after each backoff.
+        self.service.failures = {DEVICES[0]: [503, 500], DEVICES[2]: [503]}
+        begin = time.time()
+        self.handle()
+        elapsed = time.time() - begin
+
+        self.assertEqual(self.service.targets(), DEVICES + ['/topics/howalarming', DEVICES[0], DEVICES[2], DEVICES[0]])
+        self.assertTrue(elapsed >= 0.05 + 0.1, elapsed)
+
+    def test_retry_after_honoured(self):
+        self.service.failures = {DEVICES[1]: [429]}
+        self.service.retry_after = 0.5
+        begin = time.time()
+        self.handle()
+        self.assertTrue(time.time() - begin >= 0.5)
+        self.assertEqual(self.service.targets().count(DEVICES[1]), 2)
+
+    def test_partial_failure_retried(self):
+        # Still failing after every backoff, only that device is pushed to
+        # again when the consumer retries.
+        self.service.failures = {DEVICES[1]: [503] * (alert_gcm.RETRIES + 1)}
+        with self.assertRaises(consumer.DeliveryError) as raised:
+            self.handle()
+        self.assertEqual(raised.exception.destinations, [DEVICES[1]])
+
+        del self.service.pushes[:]
+        self.alerter.retry(self.event, json.dumps(self.event), raised.exception.destinations)
+        self.assertEqual(self.service.targets(), [DEVICES[1]])
+
+    def test_unregistered_device_not_retried(self):
+        self.service.failures = {DEVICES[0]: [404]}
+        self.handle()
+        self.assertEqual(self.service.targets().count(DEVICES[0]), 1)
+
+
+class RejectedTest(StubTestCase):
+
+    def tearDown(self):
+        self.consumer.stopping.set()
+        for thread in self.consumer.threads:
+            thread.join()
+        self.scratch.close()
+        StubTestCase.tearDown(self)
+
+    def test_refused_credentials_dropped(self):
+        # Retrying can't help, the event is dropped rather than retried.
+        self.service.failures = {DEVICES[0]: [401] * 5}
+        self.scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_gcm']}},
+            consumer    = {'retry_delay': 0, 'max_attempts': 3},
+            alert_gcm   = {'service_account': 'test.json', 'devices': DEVICES[:1], 'url': self.service.url},
+            ))
+        self.consumer = consumer.Consumer('alert_gcm', alert_gcm.Alerter, self.scratch.load())
+        self.consumer.start()
+
+        queue = transport.connect(self.consumer.config)
+        queue.put(['alert_gcm'], json.dumps({'type': 'alarm', 'code': '601', 'message': 'Zone alarm'}))
+        queue.close()
+
+        deadline = time.time() + 5
+        while not self.service.pushes and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)     # any retries that shouldn't arrive
+        self.assertEqual(len(self.service.pushes), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#
+# alert_plivo's locally served answer XML, with a stub standing in for Plivo.
+#
+
+import sys
+import json
+import types
+import urllib2
+import unittest
+import alert_plivo
+
+
+class RestAPI:
+    # Stands in for plivo.RestAPI, recording the calls placed, which are all
+    # over by the time they're checked on.
+    calls = []
+
+    def __init__(self, auth_id, auth_token, url=None):
+        pass
+
+    def make_call(self, params):
+        RestAPI.calls.append(params)
+        return 201, {}
+
+    def get_live_calls(self):
+        return 200, {'calls': []}
+
+
+class AnswerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plivo = sys.modules.get('plivo')
+        sys.modules['plivo'] = types.ModuleType('plivo')
+        sys.modules['plivo'].RestAPI = RestAPI
+        del RestAPI.calls[:]
+
+        # The answer server is started by the first alerter, on any free
+        # port, and shared by the rest.
+        self.alerter = alert_plivo.Alerter({'auth_id': 'MATEST', 'auth_token': 'test', 'call_from': '666', 'call_to': ['1001', '1002'],
+                                            'triggers': ['alarm'], 'answer_url': 'http://unset/', 'answer_port': 0, 'answer_bind': '127.0.0.1'})
+        self.answers = self.alerter.answers
+        self.base = 'http://127.0.0.1:' + str(self.answers.server_address[1])
+        self.alerter.answer_url = self.base + '/'
+
+    def tearDown(self):
+        if self.plivo is None:
+            del sys.modules['plivo']
+        else:
+            sys.modules['plivo'] = self.plivo
+
+    def fetch(self, path):
+        return urllib2.urlopen(self.base + path, timeout=5).read()
+
+    def test_answered_with_event_message(self):
+        event = {'type': 'alarm', 'code': '601', 'message': 'alarm. partition = 1 zone = Kids & Guests <upstairs>'}
+        self.alerter.handle(event, json.dumps(event))
+
+        self.assertEqual([call['to'] for call in RestAPI.calls], ['1001', '1002'])
+        answer_url = RestAPI.calls[0]['answer_url']
+        self.assertTrue(answer_url.startswith(self.base + '/answer/'))
+        self.assertTrue(answer_url.endswith('.xml'))
+        self.assertEqual(set(call['answer_url'] for call in RestAPI.calls), set([answer_url]))
+
+        xml = self.fetch(answer_url[len(self.base):])
+        self.assertTrue('<Speak>Alarm! Alarm!' in xml)
+        self.assertTrue('zone = Kids &amp; Guests &lt;upstairs&gt;.</Speak>' in xml)
+
+    def test_unknown_event_generic(self):
+        self.assertEqual(self.fetch('/answer/0123456789abcdef.xml'), self.answers.generic)
+        self.assertEqual(self.fetch('/'), self.answers.generic)
+        self.assertTrue(alert_plivo.SPEAK_DEFAULT in self.answers.generic)
+
+    def test_bound_to_address(self):
+        self.assertEqual(self.answers.server_address[0], '127.0.0.1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#
+# alert_url's delivery modes.
+#
+
+import json
+import time
+import unittest
+import alert_url
+import consumer
+import transport
+from tests import support
+
+
+class BatchTest(unittest.TestCase):
+
+    def start(self, workers, count):
+        self.endpoint = support.Endpoint()
+        self.scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_url']}},
+            consumer    = {'workers': workers},
+            alert_url   = {'urls': [self.endpoint.url], 'triggers': ['alarm'], 'method': 'post',
+                           'batch': {'max_size': 4, 'max_latency': 2.0}},
+            ))
+        self.consumer = consumer.Consumer('alert_url', alert_url.Alerter, self.scratch.load())
+        self.consumer.start()
+
+        queue = transport.connect(self.consumer.config)
+        for i in range(count):
+            queue.put(['alert_url'], json.dumps({'type': 'alarm', 'code': '601', 'message': 'Zone alarm ' + str(i)}))
+        queue.close()
+
+    def tearDown(self):
+        self.consumer.stopping.set()
+        for thread in self.consumer.threads:
+            thread.join()
+        self.endpoint.close()
+        self.scratch.close()
+
+    def received(self, count, timeout):
+        deadline = time.time() + timeout
+        while len(self.endpoint.requests) < count and time.time() < deadline:
+            time.sleep(0.02)
+        return [json.loads(body) for command, path, body in self.endpoint.requests]
+
+    def test_batched(self):
+        self.start(4, 4)
+        posted = self.received(1, 1.0)
+        self.assertEqual(len(posted), 1)
+        self.assertEqual(len(posted[0]), 4)
+
+    def test_single_worker_not_batched(self):
+        # Each event would otherwise wait out max_latency on it's own.
+        self.start(1, 2)
+        posted = self.received(2, 1.0)
+        self.assertEqual([event['message'] for event in posted], ['Zone alarm 0', 'Zone alarm 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
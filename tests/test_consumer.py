@@ -0,0 +1,76 @@
+#
+# Retrying failed deliveries, through the queue and the spool.
+#
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import alert_url
+import consumer
+import transport
+from tests import support
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.mkdtemp(prefix='howalarming-test-')
+
+    def start(self, **settings):
+        self.good = support.Endpoint()
+        self.flaky = support.Endpoint(status=500)
+        self.scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_url']}},
+            consumer    = settings,
+            alert_url   = {'urls': [self.good.url, self.flaky.url], 'triggers': ['alarm']},
+            ))
+        self.consumer = consumer.Consumer('alert_url', alert_url.Alerter, self.scratch.load())
+        self.consumer.start()
+
+        queue = transport.connect(self.consumer.config)
+        queue.put(['alert_url'], json.dumps({'type': 'alarm', 'code': '601', 'message': 'Zone alarm'}))
+        queue.close()
+
+    def tearDown(self):
+        self.consumer.stopping.set()
+        for thread in self.consumer.threads:
+            thread.join()
+        self.good.close()
+        self.flaky.close()
+        self.scratch.close()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def wait(self, endpoint, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(endpoint.requests) < count and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)     # anything more that shouldn't arrive
+
+    def test_only_failed_destinations_retried(self):
+        self.start(retry_delay=0, max_attempts=3)
+        self.wait(self.flaky, 3)
+        self.assertEqual(len(self.flaky.requests), 3)
+        self.assertEqual(len(self.good.requests), 1)
+
+    def test_only_failed_destinations_spooled(self):
+        self.start(retry_delay=1, spool_dir=self.spool_dir)
+        self.wait(self.flaky, 1)
+        self.flaky.status = 200
+        self.wait(self.flaky, 2)
+        self.assertEqual(len(self.flaky.requests), 2)
+        self.assertEqual(len(self.good.requests), 1)
+
+    def test_spooled_alerters_not_requeued(self):
+        # One alerter's spool can't be written, only it's left to the queue.
+        self.start(retry_delay=30, spool_dir=self.spool_dir)
+        os.mkdir(os.path.join(self.spool_dir, 'broken.spool'))
+        remaining = self.consumer.store(['alert_url', 'broken'], {'type': 'alarm'}, '{"type": "alarm"}', 7)
+        self.assertEqual(remaining, ['broken'])
+        self.assertTrue(7 in [priority for priority, body in self.consumer.spools['alert_url'].entries.values()])
+
+
+if __name__ == '__main__':
+    unittest.main()
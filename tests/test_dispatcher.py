@@ -0,0 +1,75 @@
+#
+# The dispatcher starting up, standalone and hosted.
+#
+
+import os
+import sys
+import json
+import time
+import signal
+import unittest
+import subprocess
+import dispatcher
+import transport
+from tests import support
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = support.Endpoint()
+        self.scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['dispatcher']}},
+            dispatcher  = {'sinks': ['alert_url']},
+            alert_url   = {'urls': [self.endpoint.url], 'triggers': ['armed']},
+            ))
+
+    def tearDown(self):
+        self.endpoint.close()
+        self.scratch.close()
+
+    def test_standalone_starts(self):
+        env = dict(os.environ, HOWALARMING_CONFIG=self.scratch.config_path)
+        process = subprocess.Popen([sys.executable, os.path.join(support.ROOT, 'dispatcher.py')],
+                                   env=env, cwd=self.scratch.path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            output = ''
+            while 'dispatching alerts' not in output:
+                line = process.stdout.readline()
+                if not line:
+                    break
+                output += line
+            self.assertIn('system: dispatching alerts to alert_url', output)
+        finally:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+            deadline = time.time() + 10
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if process.poll() is None:
+                process.kill()
+            output += process.stdout.read()
+            process.wait()
+        self.assertEqual(process.returncode, 0, output)
+
+    def test_hosted_delivers(self):
+        d = dispatcher.Dispatcher(self.scratch.load())
+        d.start()
+        try:
+            self.assertEqual([name for name, alerter in d.routing[0]], ['alert_url'])
+            queue = transport.connect(d.config)
+            queue.put(['dispatcher'], json.dumps({'type': 'armed', 'code': '652', 'message': 'Armed'}))
+            queue.close()
+
+            deadline = time.time() + 5
+            while not self.endpoint.requests and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(self.endpoint.paths(), ['/armed'])
+        finally:
+            d.stopping.set()
+            for thread in d.threads:
+                thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
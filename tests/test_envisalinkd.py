@@ -0,0 +1,141 @@
+#
+# envisalinkd publishing from the main loop and timer threads at once, through
+# its publisher thread, and what it drops when that falls behind.
+#
+
+import os
+import json
+import shutil
+import tempfile
+import time
+import threading
+import unittest
+import envisalinkd
+import tail
+from tests import support
+
+
+class Socket:
+    # Stands in for the connection to the alarm.
+
+    def send(self, data):
+        return len(data)
+
+
+class SlowQueue:
+    # Stands in for a connection to a slow beanstalkd.
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.bodies = []
+
+    def put_many(self, puts):
+        time.sleep(self.delay)
+        for tubes, body, priority in puts:
+            for tube in tubes:
+                self.bodies.append((tube, json.loads(body)))
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = tempfile.mkdtemp(prefix='howalarming-test-')
+        self.scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_url', 'cli']}},
+            envisalinkd = {'host': '127.0.0.1', 'port': 4025, 'password': 'test', 'code_master': '1234', 'code_installer': '5555',
+                           'zones': dict(('%03d' % zone, 'Zone ' + str(zone)) for zone in range(1, 9)),
+                           'state_file': os.path.join(self.data, 'state.json'),
+                           'zone_stats': os.path.join(self.data, 'zonestats.json')},
+            ))
+        self.environ = os.environ.get('HOWALARMING_CONFIG')
+        os.environ['HOWALARMING_CONFIG'] = self.scratch.config_path
+
+        self.e = envisalinkd.Envisalink()
+        self.e.resetData()
+        self.e.printNormal = lambda msg: None
+        self.e.panelstate.changed = lambda event: True
+        self.e.inSnapshot = lambda event: False
+        self.e.feed = tail.Feed(os.path.join(self.data, 'tail.sock'), 100)
+        self.e.socket = Socket()
+
+    def tearDown(self):
+        self.e.stopPublisher()
+        if self.environ is None:
+            del os.environ['HOWALARMING_CONFIG']
+        else:
+            os.environ['HOWALARMING_CONFIG'] = self.environ
+        self.scratch.close()
+        shutil.rmtree(self.data, ignore_errors=True)
+
+    def start(self, delay):
+        self.e.publisher_queue = SlowQueue(delay)
+        self.e.publisher = threading.Thread(target=self.e.publisherRun)
+        self.e.publisher.daemon = True
+        self.e.publisher.start()
+
+    def test_concurrent_publishing(self):
+        # Timer threads sending commands while the main loop decodes frames,
+        # with a queue slow enough to back up.
+        delay = 0.2
+        self.start(delay)
+        zones = sorted(self.e.zones)
+        frames = ['609' + zone for zone in zones] + ['610' + zone for zone in zones]
+        count = 400
+        timers = 4
+        sends = []
+        lock = threading.Lock()
+
+        def timer():
+            for i in range(count / timers / 4):
+                begin = time.time()
+                self.e.sendCommand(0, 'poll')
+                took = time.time() - begin
+                lock.acquire()
+                sends.append(took)
+                lock.release()
+                time.sleep(0.001)
+
+        threads = [threading.Thread(target=timer) for i in range(timers)]
+        for thread in threads:
+            thread.start()
+        decodes = []
+        for i in range(count):
+            begin = time.time()
+            self.e.decodeResponse(frames[i % len(frames)])
+            decodes.append(time.time() - begin)
+        for thread in threads:
+            thread.join()
+
+        # Neither waited on the queue.
+        self.assertLess(max(sends), delay / 2)
+        self.assertLess(max(decodes), delay / 2)
+
+        expected = count + len(sends)
+        deadline = time.time() + 30
+        while self.e.sequence < expected and time.time() < deadline:
+            time.sleep(0.01)
+        self.e.stopPublisher()
+
+        # Every event put exactly once on each tube, numbered in order.
+        for tube in ('alert_url', 'cli'):
+            published = [body for name, body in self.e.publisher_queue.bodies if name == tube]
+            events = [body['sequence']['event'] for body in published]
+            self.assertEqual(sorted(events), range(1, expected + 1))
+            self.assertEqual([body['sequence']['tube'] for body in published], range(1, expected + 1))
+
+    def test_full_outbox_drops_info_first(self):
+        # Nothing published, so the outbox fills.
+        backlog = envisalinkd.PUBLISH_BACKLOG
+        envisalinkd.PUBLISH_BACKLOG = 4
+        try:
+            for message in ('armed', 'info', 'info', 'armed', 'info', 'alarm', 'fault', 'recovery', 'alarm', 'disarmed'):
+                self.e.beanstalk_push({'type': message})
+        finally:
+            envisalinkd.PUBLISH_BACKLOG = backlog
+
+        self.assertEqual([message['type'] for message in self.e.outbox], ['alarm', 'fault', 'recovery', 'alarm'])
+        self.assertEqual(self.e.outbox_dropped, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
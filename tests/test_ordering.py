@@ -0,0 +1,138 @@
+#
+# Keeping each zone's events in order across workers, and spotting lost ones.
+#
+
+import json
+import time
+import threading
+import unittest
+import alert_url
+import consumer
+import ordering
+import transport
+from tests import support
+
+
+def event(tube, in_stream, stream='zone 005'):
+    return {'type': 'info', 'sequence': {'run': 1, 'event': tube, 'stream': stream, 'tube': tube, 'in_stream': in_stream}}
+
+
+class SequencerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logged = []
+        self.sequencer = ordering.Sequencer(1.0, self.logged.append)
+        self.delivered = []
+
+    def deliver(self, alarm_event):
+        ticket = self.sequencer.begin(alarm_event)
+        self.delivered.append(alarm_event['sequence']['in_stream'])
+        self.sequencer.end(ticket)
+
+    def test_first_events_reserved_out_of_order(self):
+        # A worker reaches the stream's second event before another worker
+        # has begun the first, the first must still go first.
+        later = threading.Thread(target=self.deliver, args=(event(2, 2),))
+        later.start()
+        time.sleep(0.05)
+        self.deliver(event(1, 1))
+        later.join()
+        self.assertEqual(self.delivered, [1, 2])
+        self.assertEqual(self.logged, [])
+
+    def test_started_part_way_through(self):
+        # Earlier events delivered before the consumer started are only
+        # waited on briefly.
+        begin = time.time()
+        self.deliver(event(17, 17))
+        self.assertLess(time.time() - begin, ordering.FRESH_WAIT + 0.2)
+        self.deliver(event(18, 18))
+        self.assertEqual(self.delivered, [17, 18])
+
+    def test_late_event_warned(self):
+        self.sequencer.wait = 0.1
+        self.deliver(event(1, 1))
+        self.deliver(event(3, 3))
+        self.deliver(event(2, 2))
+        self.assertEqual(self.delivered, [1, 3, 2])
+        self.assertTrue(any('delivered without 1 earlier' in line for line in self.logged))
+        self.assertTrue(any('event 2 arrived after later events' in line for line in self.logged))
+
+
+class GapsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logged = []
+        self.gaps = ordering.Gaps(self.logged.append, gap_wait=0.1)
+
+    def test_missing_logged(self):
+        for number in (1, 2, 4, 5):
+            self.gaps.arrived(event(number, number))
+        self.assertEqual(self.logged, [])
+        time.sleep(0.15)
+        self.gaps.arrived(event(6, 6))
+        self.assertEqual(self.logged, ['Warning: 1 event(s) missing from the tube before event 4, lost'])
+
+    def test_late_not_logged(self):
+        self.gaps.arrived(event(1, 1))
+        self.gaps.arrived(event(3, 3))
+        self.gaps.arrived(event(2, 2))
+        time.sleep(0.15)
+        self.gaps.arrived(event(4, 4))
+        self.assertEqual(self.logged, [])
+
+
+class ConsumerOrderingTest(unittest.TestCase):
+
+    def load(self, **settings):
+        scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_url']}},
+            consumer    = settings,
+            alert_url   = {'urls': ['http://127.0.0.1:9/'], 'triggers': ['alarm']},
+            ))
+        try:
+            return consumer.Consumer('alert_url', alert_url.Alerter, scratch.load())
+        finally:
+            scratch.close()
+
+    def test_off_by_default(self):
+        # Ordering sends a zone's events one at a time, defeating batching.
+        self.assertIsNone(self.load(workers=8).sequencer)
+
+    def test_gaps_detected_by_default(self):
+        # Including around events no alerter wanted.
+        endpoint = support.Endpoint()
+        scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_url']}},
+            alert_url   = {'urls': [endpoint.url], 'triggers': ['alarm']},
+            ))
+        receiver = consumer.Consumer('alert_url', alert_url.Alerter, scratch.load())
+        logged = []
+        receiver.gaps.log = logged.append
+        receiver.gaps.gap_wait = 0.1
+        receiver.start()
+        try:
+            queue = transport.connect(receiver.config)
+            for number, event_type in ((1, 'info'), (3, 'alarm'), (4, 'info')):
+                queue.put(['alert_url'], json.dumps(dict(event(number, number), type=event_type)))
+                time.sleep(0.15)
+            queue.close()
+
+            deadline = time.time() + 5
+            while not logged and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(logged, ['Warning: 1 event(s) missing from the tube before event 3, lost'])
+        finally:
+            receiver.stopping.set()
+            for thread in receiver.threads:
+                thread.join()
+            endpoint.close()
+            scratch.close()
+
+    def test_opt_in(self):
+        self.assertIsNotNone(self.load(workers=8, order_wait=1.0).sequencer)
+        self.assertIsNone(self.load(workers=1, order_wait=1.0).sequencer)
+
+
+if __name__ == '__main__':
+    unittest.main()
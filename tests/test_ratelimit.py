@@ -0,0 +1,52 @@
+#
+# Rate limiting of the alert sinks' deliveries.
+#
+
+import json
+import time
+import unittest
+import alert_url
+import consumer
+import transport
+from tests import support
+
+
+class DestinationLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = support.Endpoint(status=500)
+        self.scratch = support.Scratch(support.settings(
+            beanstalkd  = {'host': '127.0.0.1', 'port': 11300, 'tubes': {'commands': ['commands'], 'events': ['alert_url']}},
+            consumer    = {'retry_delay': 0, 'max_attempts': 3},
+            alert_url   = {'urls': [self.endpoint.url], 'triggers': ['alarm'],
+                           'rate_limit': {'destination_rate': 0.2, 'destination_burst': 1}},
+            ))
+        self.consumer = consumer.Consumer('alert_url', alert_url.Alerter, self.scratch.load())
+        self.consumer.start()
+
+    def tearDown(self):
+        self.consumer.stopping.set()
+        for thread in self.consumer.threads:
+            thread.join()
+        self.endpoint.close()
+        self.scratch.close()
+
+    def wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.endpoint.requests) < count and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)     # anything more that shouldn't arrive
+
+    def test_retries_not_suppressed(self):
+        # The URL was admitted on the first attempt, it's retries mustn't be
+        # suppressed by it's (now empty) bucket and the event lost.
+        queue = transport.connect(self.consumer.config)
+        queue.put(['alert_url'], json.dumps({'type': 'alarm', 'code': '601', 'message': 'Zone alarm'}))
+        queue.close()
+
+        self.wait(3)
+        self.assertEqual(self.endpoint.paths(), ['/alarm'] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#
+# The state map published for local readers.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+import statemap
+
+
+STATE = {
+    'zones':        {'005': {'open': True, 'alarm': False, 'tamper': False, 'fault': False}},
+    'partitions':   {'1': {'state': 'armed', 'ready': False, 'mode': '0'}},
+    'keypad':       {'lit': ['armed'], 'flashing': []},
+    'updated':      1500000000,
+    }
+
+
+class RestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp(prefix='howalarming-test-')
+        self.path = os.path.join(self.scratch, 'howalarming.state')
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def test_reader_sees_reset(self):
+        # A reader keeping the map open across a restart sees the state
+        # cleared, with a new sequence, not the old state.
+        publisher = statemap.Publisher(self.path)
+        publisher.publish(1, STATE, 'armed')
+        reader = statemap.Reader(self.path)
+        before = reader.read()
+        self.assertEqual(before['partitions']['1']['state'], 'armed')
+        publisher.close()
+
+        statemap.Publisher(self.path).close()
+        after = reader.read()
+        self.assertNotEqual(after['sequence'], before['sequence'])
+        self.assertEqual(after['sequence'] % 2, 0)
+        self.assertEqual(after['zones'], {})
+        self.assertEqual(after['partitions'], {})
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#
+# Zone activity statistics.
+#
+
+import time
+import unittest
+import zonestats
+
+
+def dump(*timers):
+    # A zone timer dump, each timer 16 bit little endian.
+    return ''.join('%02X%02X' % (timer & 0xFF, timer >> 8) for timer in timers)
+
+
+class SeedTest(unittest.TestCase):
+
+    def test_open_zone_not_counted_again(self):
+        # Counted before a restart, and open in the dump once reconnected.
+        stats = zonestats.ZoneStats()
+        now = time.time()
+        stats.zones['001'] = zonestats.Zone({'opens': 1, 'last_activity': now - 60})
+        stats.seed(dump(zonestats.TIMER_OPEN), now)
+        self.assertEqual(stats.zones['001'].opens, 1)
+        self.assertEqual(stats.zones['001'].last_activity, now)
+
+        stats.apply({'code': '610', 'zone': '001', 'timestamp': now + 30})
+        self.assertEqual(stats.zones['001'].opens, 1)
+        self.assertEqual(stats.zones['001'].dwell, 30)
+
+    def test_seeding_repeatedly(self):
+        stats = zonestats.ZoneStats()
+        now = time.time()
+        for offset in range(3):
+            stats.seed(dump(zonestats.TIMER_OPEN, 0), now + offset)
+        self.assertEqual(stats.zones['001'].opens, 0)
+        self.assertEqual(stats.zones['001'].opened_at, now)
+        self.assertEqual(stats.zones['002'].opens, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+#
+# End-to-end latency tracing of alarm events, from the frame arriving from the
+# panel to the alert sink having delivered it. Enabled by the `trace` section:
+#
+#   trace:
+#     enabled: true
+#     log: /tmp/howalarming-trace.log
+#
+# envisalinkd then adds a trace block to each event it decodes, with an event
+# id and monotonic nanosecond stamps as it's received from the TPI, decoded
+# and published. The consumers stamp it again when it's reserved and when
+# each sink completes delivery, and append the trace to the log, one JSON
+# object per line. The trace block is removed before the event is handed to
+# the sinks, so it never shows up in alerts.
+#
+# Run this file to summarise the log, with p50/p95/p99 of each hop and of each
+# sink's delivery:
+#
+#   ./tracing.py [log]
+#
+# The stamps come from the system's monotonic clock, which is only comparable
+# between processes on the same host - with the sinks elsewhere, only the hops
+# within envisalinkd and within each consumer mean anything.
+#
+
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+
+
+DEFAULT_LOG = '/tmp/howalarming-trace.log'
+
+# In the order an event passes through them.
+STAGES = ('recv', 'decode', 'publish', 'reserve', 'complete')
+
+CLOCK_MONOTONIC = 1
+
+
+try:
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c')).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def clock():
+        # Nanoseconds on the monotonic clock, shared by every process on the
+        # host and unaffected by changes to the time of day.
+        spec = timespec()
+        _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec))
+        return spec.tv_sec * 1000000000 + spec.tv_nsec
+
+except (ImportError, OSError, AttributeError, TypeError):
+    # No clock_gettime (eg not Linux), wall clock time will have to do.
+    def clock():
+        return int(time.time() * 1e9)
+
+
+_ids = itertools.count(1)
+
+def start(received=None):
+    # New trace block for an event received from the panel at received, if
+    # it came from the panel.
+    block = {'id': '%d-%d' % (os.getpid(), next(_ids)), 'decode': clock()}
+    if received is not None:
+        block['recv'] = received
+    return block
+
+
+class Recorder:
+    # Appends completed traces to the log. Lines are written whole with a
+    # single write, so several consumers can share the one log.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', 0)
+
+    def record(self, block, sink):
+        line = json.dumps(dict(block, sink=sink, complete=clock())) + '\n'
+        self.lock.acquire()
+        try:
+            self.file.write(line)
+        finally:
+            self.lock.release()
+
+
+def recorder(settings):
+    # Recorder for the `trace` configuration, None when tracing is off.
+    trace = settings.get('trace') or {}
+    if not trace.get('enabled'):
+        return None
+    return Recorder(trace.get('log', DEFAULT_LOG))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(lines):
+    # Latency of each hop between consecutive stages, then of each sink's
+    # delivery and overall. Traces missing a stage (eg events from
+    # simulate.py) are left out of the hops that need it.
+    hops = [(STAGES[i], STAGES[i + 1]) for i in range(len(STAGES) - 1)]
+    samples = dict((hop, []) for hop in hops)
+    sinks = {}
+    total = []
+
+    for line in lines:
+        try:
+            block = json.loads(line)
+        except ValueError:
+            continue
+        for start, end in hops:
+            if start in block and end in block:
+                samples[(start, end)].append(block[end] - block[start])
+        if 'reserve' in block:
+            sinks.setdefault(block.get('sink'), []).append(block['complete'] - block['reserve'])
+        if 'recv' in block:
+            total.append(block['complete'] - block['recv'])
+
+    rows = [(start + ' -> ' + end, samples[(start, end)]) for start, end in hops]
+    rows += [('sink ' + str(sink), values) for sink, values in sorted(sinks.items())]
+    rows.append(('recv -> complete', total))
+
+    print '%-24s %8s %10s %10s %10s' % ('hop', 'count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+    for name, values in rows:
+        if values:
+            print '%-24s %8d %10.3f %10.3f %10.3f' % (name, len(values), percentile(values, 0.5) / 1e6,
+                                                      percentile(values, 0.95) / 1e6, percentile(values, 0.99) / 1e6)
+        else:
+            print '%-24s %8d %10s %10s %10s' % (name, 0, '-', '-', '-')
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        import config
+        try:
+            path = (config.load().get('trace') or {}).get('log', DEFAULT_LOG)
+        except IOError:
+            path = DEFAULT_LOG
+
+    try:
+        log = open(path)
+    except IOError:
+        print 'Fatal: Could not open trace log ' + path
+        raise
+
+    report(log)
@@ -0,0 +1,567 @@
+#! /usr/bin/env python
+#
+# Message transport between the HowAlarming applications. Every application
+# talks to a Connection, which puts messages onto named tubes and reserves them
+# back off again with beanstalkd's work queue semantics (priorities, delays,
+# release/bury/touch of reserved jobs). The backend is chosen by the
+# `transport` section of the configuration:
+#
+#   beanstalk   The beanstalkd server from the `beanstalkd` section (default).
+#
+#   inprocess   A Broker inside the current process. Messages are handed over
+#               by reference, with a single copy of each message shared by all
+#               the tubes it was put on. Only useful when the producer and
+#               consumers share a process, ie envisalinkd hosting the
+#               dispatcher (see the README).
+#
+#   unix        The same Broker run by broker.py and reached over a Unix domain
+#               socket. A message put on several tubes is sent to the broker
+#               once and stored once, rather than once per tube.
+#
+# Connections also offer put_many, for producers with a burst of messages to
+# send. It pipelines the puts, writing a chunk of them before reading any of
+# the replies, instead of waiting a round trip per put.
+#
+# The Broker holds everything in memory, much like beanstalkd without it's
+# binlog - messages queued when it stops are lost.
+#
+
+import os
+import fcntl
+import json
+import heapq
+import select
+import socket
+import itertools
+import threading
+import time
+
+
+DEFAULT_PRIORITY = 2 ** 31
+DEFAULT_TTR = 120
+DEFAULT_SOCKET = '/tmp/howalarming.sock'
+
+# Most puts written by put_many before reading their replies, bounding what
+# either end has to buffer.
+PIPELINE = 100
+
+
+class TransportError(Exception):
+    # The connection to the backend has failed.
+    pass
+
+
+class JobLost(Exception):
+    # A reserved job could not be acted on, usually because it's TTR expired
+    # and it has been handed to someone else.
+    pass
+
+
+def backend(settings):
+    return (settings.get('transport') or {}).get('backend', 'beanstalk')
+
+
+def describe(settings):
+    # Human readable description of where messages go, for logging.
+    name = backend(settings)
+    if name == 'beanstalk':
+        return 'beanstalkd on ' + str(settings['beanstalkd']['host']) + ' on port ' + str(settings['beanstalkd']['port'])
+    if name == 'unix':
+        return 'broker on ' + (settings.get('transport') or {}).get('socket', DEFAULT_SOCKET)
+    return 'in-process broker'
+
+
+def connect(settings):
+    name = backend(settings)
+    if name == 'beanstalk':
+        return BeanstalkConnection(settings['beanstalkd']['host'], settings['beanstalkd']['port'])
+    if name == 'unix':
+        return UnixConnection((settings.get('transport') or {}).get('socket', DEFAULT_SOCKET))
+    return LocalConnection(local_broker())
+
+
+
+#
+# beanstalkd backend
+#
+
+class BeanstalkConnection:
+
+    def __init__(self, host, port):
+        import beanstalkc   # requires beanstalkc third party package
+        self.beanstalkc = beanstalkc
+        self.using = 'default'
+        self.beanstalk = self.call(beanstalkc.Connection, host=host, port=port)
+
+    def call(self, function, *args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except self.beanstalkc.SocketError as err:
+            raise TransportError(str(err))
+
+    def job_call(self, function, *args, **kwargs):
+        try:
+            return self.call(function, *args, **kwargs)
+        except self.beanstalkc.CommandFailed as err:
+            raise JobLost(str(err))
+
+    def put(self, tubes, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        for tube in tubes:
+            if tube != self.using:
+                self.call(self.beanstalk.use, tube)
+                self.using = tube
+            self.call(self.beanstalk.put, body, priority=priority, delay=delay, ttr=ttr)
+
+    def put_many(self, puts):
+        # puts is a list of (tubes, body, priority). beanstalkc waits for the
+        # reply to each command, so pipelined commands are written to it's
+        # socket directly.
+        for i in range(0, len(puts), PIPELINE):
+            commands = []
+            for tubes, body, priority in puts[i:i + PIPELINE]:
+                for tube in tubes:
+                    if tube != self.using:
+                        commands.append('use %s\r\n' % tube)
+                        self.using = tube
+                    commands.append('put %d 0 %d %d\r\n%s\r\n' % (priority, DEFAULT_TTR, len(body), body))
+
+            # Every reply is read even after a failure, keeping the
+            # connection in step.
+            failed = []
+            try:
+                self.beanstalk._socket.sendall(''.join(commands))
+                for command in commands:
+                    reply = self.beanstalk._socket_file.readline()
+                    if not reply:
+                        raise TransportError('beanstalkd closed the connection')
+                    if reply.split()[0] not in ('USING', 'INSERTED'):
+                        failed.append(reply.strip())
+            except socket.error as err:
+                raise TransportError(str(err))
+
+            if failed:
+                raise TransportError('put failed: ' + ', '.join(failed))
+
+    def watch(self, tubes):
+        for tube in tubes:
+            self.call(self.beanstalk.watch, tube)
+        for tube in self.call(self.beanstalk.watching):
+            if tube not in tubes:
+                self.call(self.beanstalk.ignore, tube)
+
+    def reserve(self, timeout=None):
+        try:
+            job = self.call(self.beanstalk.reserve, timeout=timeout)
+        except self.beanstalkc.CommandFailed:
+            return None     # DEADLINE_SOON, treat as a timeout
+        if job:
+            return BeanstalkJob(self, job)
+        return None
+
+    def close(self):
+        self.beanstalk.close()
+
+
+class BeanstalkJob:
+
+    def __init__(self, connection, job):
+        self.connection = connection
+        self.job = job
+        self.jid = job.jid
+        self.body = job.body
+
+    def stats(self):
+        return self.connection.job_call(self.job.stats)
+
+    def delete(self):
+        self.connection.job_call(self.job.delete)
+
+    def release(self, priority=None, delay=0):
+        self.connection.job_call(self.job.release, priority=priority, delay=delay)
+
+    def bury(self, priority=None):
+        self.connection.job_call(self.job.bury, priority=priority)
+
+    def touch(self):
+        self.connection.job_call(self.job.touch)
+
+
+
+#
+# Broker, used in-process and by broker.py
+#
+
+class Entry:
+
+    def __init__(self, jid, tube, body, priority, ttr):
+        self.jid        = jid
+        self.tube       = tube
+        self.body       = body
+        self.priority   = priority
+        self.ttr        = ttr
+        self.state      = 'ready'
+        self.releases   = 0
+        self.created    = time.time()
+        self.deadline   = None
+        self.owner      = None
+
+
+class Waiter:
+    # Lets a reserve block until something is put, with a timeout, without
+    # the 50ms polling of Python 2's Condition.wait(timeout).
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+
+        # A waiter that isn't waiting can have wakes pile up, these must
+        # never block the broker.
+        for fd in (self.r, self.w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.w, 'x')
+        except OSError:
+            pass
+
+    def wait(self, timeout):
+        if select.select([self.r], [], [], timeout)[0]:
+            try:
+                os.read(self.r, 4096)
+            except OSError:
+                pass
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+class Broker:
+    # In-memory work queue with beanstalkd's semantics for the parts we use.
+    # Jobs are reserved lowest priority value first across the watched tubes,
+    # then in the order they were put.
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.ids        = itertools.count(1)
+        self.order      = itertools.count()
+        self.ready      = {}    # tube -> heap of (priority, order, entry)
+        self.delayed    = []    # heap of (due, order, entry)
+        self.jobs       = {}    # jid -> entry
+        self.reserved   = {}    # jid -> entry, for those reserved
+        self.waiters    = set()
+
+    def put(self, tubes, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        # The body is shared between tubes, not copied.
+        self.lock.acquire()
+        try:
+            ids = []
+            for tube in tubes:
+                entry = Entry(next(self.ids), tube, body, priority, ttr)
+                self.jobs[entry.jid] = entry
+                self.schedule(entry, delay)
+                ids.append(entry.jid)
+
+            for waiter in self.waiters:
+                waiter.wake()
+            return ids
+        finally:
+            self.lock.release()
+
+    def schedule(self, entry, delay):
+        self.reserved.pop(entry.jid, None)
+        entry.owner = None
+        entry.deadline = None
+        if delay:
+            entry.state = 'delayed'
+            heapq.heappush(self.delayed, (time.time() + delay, next(self.order), entry))
+        else:
+            entry.state = 'ready'
+            heapq.heappush(self.ready.setdefault(entry.tube, []), (entry.priority, next(self.order), entry))
+
+    def tick(self, now):
+        # Promote delayed jobs that are due and requeue reserved jobs whose
+        # TTR has run out. Returns when the next of these is due.
+        while self.delayed and self.delayed[0][0] <= now:
+            entry = heapq.heappop(self.delayed)[2]
+            if entry.state == 'delayed':
+                self.schedule(entry, 0)
+
+        due = self.delayed[0][0] if self.delayed else None
+        for entry in self.reserved.values():
+            if entry.deadline <= now:
+                self.schedule(entry, 0)
+            elif due is None or entry.deadline < due:
+                due = entry.deadline
+        return due
+
+    def reserve(self, tubes, timeout, waiter, owner):
+        end = None if timeout is None else time.time() + timeout
+
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                due = self.tick(now)
+
+                best = None
+                for tube in tubes:
+                    heap = self.ready.get(tube)
+                    if heap and (best is None or heap[0] < self.ready[best][0]):
+                        best = tube
+
+                if best is not None:
+                    self.waiters.discard(waiter)
+                    entry = heapq.heappop(self.ready[best])[2]
+                    entry.state = 'reserved'
+                    entry.owner = owner
+                    entry.deadline = now + entry.ttr
+                    self.reserved[entry.jid] = entry
+                    return entry
+
+                if end is not None and now >= end:
+                    self.waiters.discard(waiter)
+                    return None
+
+                self.waiters.add(waiter)
+            finally:
+                self.lock.release()
+
+            wait = None
+            for limit in (end, due):
+                if limit is not None:
+                    wait = max(0, limit - now) if wait is None else min(wait, max(0, limit - now))
+            waiter.wait(wait)
+
+    def owned(self, jid, owner):
+        entry = self.jobs.get(jid)
+        if entry is None or entry.state != 'reserved' or entry.owner is not owner:
+            raise JobLost('job ' + str(jid) + ' is not reserved by this connection')
+        return entry
+
+    def delete(self, jid, owner):
+        self.lock.acquire()
+        try:
+            self.owned(jid, owner)
+            del self.jobs[jid]
+            del self.reserved[jid]
+        finally:
+            self.lock.release()
+
+    def release(self, jid, owner, priority=None, delay=0):
+        self.lock.acquire()
+        try:
+            entry = self.owned(jid, owner)
+            entry.releases += 1
+            if priority is not None:
+                entry.priority = priority
+            self.schedule(entry, delay)
+            for waiter in self.waiters:
+                waiter.wake()
+        finally:
+            self.lock.release()
+
+    def bury(self, jid, owner, priority=None):
+        self.lock.acquire()
+        try:
+            entry = self.owned(jid, owner)
+            if priority is not None:
+                entry.priority = priority
+            entry.state = 'buried'
+            entry.owner = None
+            del self.reserved[jid]
+        finally:
+            self.lock.release()
+
+    def touch(self, jid, owner):
+        self.lock.acquire()
+        try:
+            entry = self.owned(jid, owner)
+            entry.deadline = time.time() + entry.ttr
+        finally:
+            self.lock.release()
+
+    def stats(self, jid):
+        entry = self.jobs.get(jid)
+        if entry is None:
+            raise JobLost('job ' + str(jid) + ' not found')
+        return {'id': entry.jid, 'tube': entry.tube, 'state': entry.state, 'pri': entry.priority,
+                'age': int(time.time() - entry.created), 'ttr': entry.ttr, 'releases': entry.releases}
+
+    def disconnect(self, owner):
+        # Requeue anything a departing connection had reserved.
+        self.lock.acquire()
+        try:
+            self.waiters = set(waiter for waiter in self.waiters if waiter is not owner.waiter)
+            for entry in self.reserved.values():
+                if entry.owner is owner:
+                    self.schedule(entry, 0)
+        finally:
+            self.lock.release()
+
+
+broker = None
+brokerMutex = threading.Lock()
+
+def local_broker():
+    # The broker shared by everything in this process.
+    global broker
+    brokerMutex.acquire()
+    try:
+        if broker is None:
+            broker = Broker()
+        return broker
+    finally:
+        brokerMutex.release()
+
+
+
+#
+# In-process backend
+#
+
+class LocalConnection:
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.waiter = Waiter()
+        self.tubes = ['default']
+
+    def put(self, tubes, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        self.broker.put(tubes, body, priority, delay, ttr)
+
+    def put_many(self, puts):
+        # Nothing to pipeline, every put is a function call.
+        for tubes, body, priority in puts:
+            self.broker.put(tubes, body, priority, 0, DEFAULT_TTR)
+
+    def watch(self, tubes):
+        self.tubes = list(tubes)
+
+    def reserve(self, timeout=None):
+        entry = self.broker.reserve(self.tubes, timeout, self.waiter, self)
+        if entry:
+            return LocalJob(self, entry.jid, entry.body)
+        return None
+
+    def close(self):
+        self.broker.disconnect(self)
+        self.waiter.close()
+
+
+class LocalJob:
+
+    def __init__(self, connection, jid, body):
+        self.connection = connection
+        self.jid = jid
+        self.body = body
+
+    def stats(self):
+        return self.connection.broker.stats(self.jid)
+
+    def delete(self):
+        self.connection.broker.delete(self.jid, self.connection)
+
+    def release(self, priority=None, delay=0):
+        self.connection.broker.release(self.jid, self.connection, priority, delay)
+
+    def bury(self, priority=None):
+        self.connection.broker.bury(self.jid, self.connection, priority)
+
+    def touch(self):
+        self.connection.broker.touch(self.jid, self.connection)
+
+
+
+#
+# Unix domain socket backend, talking to broker.py with one JSON request and
+# response per line.
+#
+
+class UnixConnection:
+
+    def __init__(self, path):
+        self.path = path
+        self.tubes = ['default']
+        try:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(path)
+            self.file = self.socket.makefile('rb')
+        except socket.error as err:
+            raise TransportError('unable to connect to broker on ' + path + ': ' + str(err))
+
+    def call(self, request):
+        try:
+            self.socket.sendall(json.dumps(request) + '\n')
+            line = self.file.readline()
+        except socket.error as err:
+            raise TransportError(str(err))
+
+        if not line:
+            raise TransportError('broker closed the connection')
+
+        response = json.loads(line)
+        if not response['ok']:
+            raise JobLost(response['error'])
+        return response
+
+    def put(self, tubes, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR):
+        self.call({'op': 'put', 'tubes': tubes, 'body': body, 'pri': priority, 'delay': delay, 'ttr': ttr})
+
+    def put_many(self, puts):
+        # The broker answers each connection's requests in order, so a chunk
+        # of puts can be written before reading their replies.
+        for i in range(0, len(puts), PIPELINE):
+            chunk = puts[i:i + PIPELINE]
+            failed = []
+            try:
+                self.socket.sendall(''.join(json.dumps({'op': 'put', 'tubes': tubes, 'body': body, 'pri': priority, 'delay': 0, 'ttr': DEFAULT_TTR}) + '\n'
+                                            for tubes, body, priority in chunk))
+                for put in chunk:
+                    line = self.file.readline()
+                    if not line:
+                        raise TransportError('broker closed the connection')
+                    response = json.loads(line)
+                    if not response['ok']:
+                        failed.append(response['error'])
+            except socket.error as err:
+                raise TransportError(str(err))
+
+            if failed:
+                raise TransportError('put failed: ' + ', '.join(failed))
+
+    def watch(self, tubes):
+        self.tubes = list(tubes)
+
+    def reserve(self, timeout=None):
+        job = self.call({'op': 'reserve', 'tubes': self.tubes, 'timeout': timeout})['job']
+        if job:
+            return UnixJob(self, job['id'], job['body'].encode('utf-8'))
+        return None
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class UnixJob:
+
+    def __init__(self, connection, jid, body):
+        self.connection = connection
+        self.jid = jid
+        self.body = body
+
+    def stats(self):
+        return self.connection.call({'op': 'stats', 'id': self.jid})['stats']
+
+    def delete(self):
+        self.connection.call({'op': 'delete', 'id': self.jid})
+
+    def release(self, priority=None, delay=0):
+        self.connection.call({'op': 'release', 'id': self.jid, 'pri': priority, 'delay': delay})
+
+    def bury(self, priority=None):
+        self.connection.call({'op': 'bury', 'id': self.jid, 'pri': priority})
+
+    def touch(self):
+        self.connection.call({'op': 'touch', 'id': self.jid})
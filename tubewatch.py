@@ -0,0 +1,267 @@
+#! /usr/bin/env python
+#
+# Watches the depth and age of every configured beanstalkd tube and enforces a
+# per-tube overflow policy, so that a tube nobody is consuming (eg `cli` when
+# cli.py isn't running, or the tube of a crashed alert consumer) can't grow
+# without bound and exhaust the host's memory.
+#
+# For each tube the policy can set:
+#
+#   max_depth   Maximum jobs waiting (ready or buried) before dropping some.
+#   max_age     Seconds after which waiting jobs are expired.
+#   overflow    Which jobs to drop when over max_depth, either `drop-oldest`
+#               or `drop-info-first` (least important by priority, then
+#               oldest - so alarms are the last thing to go).
+#
+# beanstalkd can't list the jobs in a tube, so we track job ids ourselves: each
+# sweep scans ids created since the last sweep (up to scan_limit per sweep, so
+# the first sweeps after starting against a long running beanstalkd catch up
+# gradually), caching each job's tube, priority, age and state. Rather than
+# checking every cached job again each sweep, which would cost a round trip
+# per job in the backlog, only the oldest scan_limit are, as they're the ones
+# most likely to have been consumed and the ones max_age and the reported
+# ages depend on. A sweep therefore costs up to 2 x scan_limit stats-job round
+# trips in all (not per tube), lower scan_limit on a slow host. How many to
+# drop is decided from the tube's own counts, so stale cached jobs never cause
+# more to be dropped than needed.
+#
+# Only the beanstalk transport is supported, the in-memory broker used by the
+# other transports is sized by it's host process.
+#
+# Depths, ages and drop counts are logged and optionally exposed in Prometheus
+# format on a loopback port.
+#
+
+import os
+import sys
+import time
+import heapq
+import config
+import metrics
+import transport
+
+# Unbuffered Logging
+sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
+
+
+DEFAULT_POLICY = {
+    'max_depth':    10000,
+    'max_age':      None,
+    'overflow':     'drop-info-first',
+    }
+
+# Only jobs waiting in these states are subject to the policy. Reserved jobs
+# are being worked on, and delayed jobs are retries that will be due soon.
+WAITING = ('ready', 'buried')
+
+
+class TubeWatch:
+
+    def __init__(self):
+        # Load configuration from YAML file and assign configuration values.
+        try:
+            self.config         = config.load()
+
+            # Beanstalkd Message Queue settings
+            self.beanstalk_host             = self.config['beanstalkd']['host']
+            self.beanstalk_port             = self.config['beanstalkd']['port']
+
+            self.loadConfig()
+
+        except IOError:
+            print 'Fatal: Could not open configuration file'
+            raise
+
+        except config.ConfigError as err:
+            print 'Fatal: Invalid configuration, ' + str(err)
+            raise
+
+        self.known = {}     # jid -> (tube, pri, created, state)
+        self.cursor = 1
+
+        self.metrics = metrics.Registry()
+        self.metrics.describe('howalarming_tube_jobs', 'gauge', 'Jobs in the tube by state.')
+        self.metrics.describe('howalarming_tube_watching', 'gauge', 'Connections watching the tube.')
+        self.metrics.describe('howalarming_tube_oldest_seconds', 'gauge', 'Age of the oldest waiting job.')
+        self.metrics.describe('howalarming_tube_dropped_total', 'counter', 'Jobs dropped by the overflow policy.')
+
+
+    def loadConfig(self):
+        settings = self.config.get('tubewatch') or {}
+
+        self.interval   = settings.get('interval', 10)
+        self.scan_limit = settings.get('scan_limit', 10000)   # up to 2 x this stats-job calls a sweep
+        self.metrics_port = settings.get('metrics_port')
+
+        default = dict(DEFAULT_POLICY)
+        default.update(settings.get('default') or {})
+
+        # Every tube in use, plus any others given a policy explicitly.
+        tubes = set(self.config['beanstalkd']['tubes']['commands'])
+        tubes.update(self.config['beanstalkd']['tubes']['events'])
+        tubes.update((settings.get('tubes') or {}).keys())
+
+        self.policies = {}
+        for tube in tubes:
+            policy = dict(default)
+            policy.update((settings.get('tubes') or {}).get(tube) or {})
+            self.policies[tube] = policy
+
+
+    def reloadConfig(self, previous):
+        self.loadConfig()
+        print 'system: configuration reloaded'
+
+
+    def beanstalk_connect(self):
+        if transport.backend(self.config) != 'beanstalk':
+            print 'Fatal: tubewatch only supports the beanstalk transport'
+            raise BaseException
+
+        import beanstalkc   # requires beanstalkc third party package
+        self.beanstalkc = beanstalkc
+
+        try:
+            self.beanstalk = beanstalkc.Connection(host=self.beanstalk_host, port=self.beanstalk_port)
+            print 'system: Beanstalkd connected on ' + str(self.beanstalk_host) + ' on port ' + str(self.beanstalk_port)
+        except beanstalkc.SocketError:
+            print "Fatal: Unable to connect to beanstalkd"
+            raise
+
+
+    def scan(self):
+        # Returns {tube: [(jid, pri, age, state), ...]} for every job we know
+        # of in the tubes we police.
+        newest = self.beanstalk.stats()['total-jobs']
+        if newest < self.cursor - 1:
+            # beanstalkd restarted, job ids start again
+            self.known = {}
+            self.cursor = 1
+
+        last = min(newest, self.cursor + self.scan_limit - 1)
+        ids = heapq.nsmallest(self.scan_limit, self.known) + range(self.cursor, last + 1)
+        self.cursor = last + 1
+        self.catching_up = last < newest
+
+        for jid in ids:
+            self.refresh(jid)
+
+        now = time.time()
+        jobs = {}
+        for jid, (tube, pri, created, state) in self.known.items():
+            if tube in self.policies:
+                jobs.setdefault(tube, []).append((jid, pri, int(now - created), state))
+        return jobs
+
+
+    def refresh(self, jid):
+        # Cache the job's current stats, or forget it if it's gone.
+        try:
+            stats = self.beanstalk.stats_job(jid)
+        except self.beanstalkc.CommandFailed:
+            self.known.pop(jid, None)
+            return    # job has since been deleted
+
+        if stats['tube'] in self.policies:
+            self.known[jid] = (stats['tube'], stats['pri'], time.time() - stats['age'], stats['state'])
+        else:
+            self.known.pop(jid, None)
+
+
+    def sweep(self):
+        jobs = self.scan()
+
+        for tube, policy in sorted(self.policies.items()):
+            try:
+                stats = self.beanstalk.stats_tube(tube)
+            except self.beanstalkc.CommandFailed:
+                continue    # tube doesn't exist (yet)
+
+            waiting = [job for job in jobs.get(tube, []) if job[3] in WAITING]
+            dropped = self.enforce(tube, policy, waiting, stats['current-jobs-ready'] + stats['current-jobs-buried'])
+            if dropped:
+                stats = self.beanstalk.stats_tube(tube)
+
+            for state in ('ready', 'reserved', 'delayed', 'buried'):
+                self.metrics.set('howalarming_tube_jobs', stats['current-jobs-' + state], tube=tube, state=state)
+            self.metrics.set('howalarming_tube_watching', stats['current-watching'], tube=tube)
+
+            remaining = [job for job in waiting if job[0] not in dropped]
+            oldest = max([job[2] for job in remaining] or [0])
+            self.metrics.set('howalarming_tube_oldest_seconds', oldest, tube=tube)
+
+            if remaining or dropped:
+                print 'tube ' + tube + ': ' + str(stats['current-jobs-ready']) + ' ready, ' + str(stats['current-jobs-buried']) + ' buried, oldest ' + str(oldest) + 's, ' + str(stats['current-watching']) + ' watching' + (', dropped ' + str(len(dropped)) if dropped else '')
+
+        if self.catching_up:
+            print 'system: still scanning existing jobs, ages may be understated'
+
+
+    def enforce(self, tube, policy, waiting, depth):
+        # Decide which jobs to drop, returning their ids. depth is the number
+        # waiting by the tube's own count, waiting may include cached jobs
+        # consumed since they were last checked.
+        drop = set()
+
+        if policy['max_age'] is not None:
+            drop.update(job[0] for job in waiting if job[2] > policy['max_age'])
+
+        excess = min(len(waiting), depth) - len(drop) - policy['max_depth']
+        if excess > 0:
+            candidates = [job for job in waiting if job[0] not in drop]
+            if policy['overflow'] == 'drop-oldest':
+                candidates.sort(key=lambda job: job[0])
+            else:
+                # Highest priority value is least important
+                candidates.sort(key=lambda job: (-job[1], job[0]))
+            drop.update(job[0] for job in candidates[:excess])
+
+        dropped = set()
+        for jid in drop:
+            try:
+                self.beanstalk.delete(jid)
+                dropped.add(jid)
+            except self.beanstalkc.CommandFailed:
+                # Reserved by a consumer in the meantime, or consumed since
+                # it was cached.
+                self.refresh(jid)
+
+        for jid in dropped:
+            del self.known[jid]
+        if dropped:
+            self.metrics.inc('howalarming_tube_dropped_total', len(dropped), tube=tube)
+        return dropped
+
+
+    def run(self):
+        print 'system: watching ' + ', '.join(sorted(self.policies))
+        try:
+            while(True):
+                try:
+                    self.config.poll()
+                except config.ConfigError as err:
+                    print 'system: unable to reload configuration, keeping current settings: ' + str(err)
+
+                self.sweep()
+                time.sleep(self.interval)
+
+        except self.beanstalkc.SocketError, err:
+            print 'system: socket error ' + str(err)
+
+
+
+if __name__ == '__main__':
+        try:
+            w = TubeWatch()
+            w.config.on_reload(w.reloadConfig)
+            w.config.install_reload_handler()
+            w.beanstalk_connect()
+
+            if w.metrics_port:
+                w.metrics.serve(w.metrics_port)
+                print 'system: metrics available on http://127.0.0.1:' + str(w.metrics_port) + '/metrics'
+
+            w.run()
+
+        except KeyboardInterrupt:
+            print 'system: User Terminated'
@@ -0,0 +1,199 @@
+#! /usr/bin/env python
+#
+# Zone activity statistics for envisalinkd, kept as zones open and close:
+# for each zone, how often it opens and how long it stays open, by hour of
+# the day and by day of the week, and when it was last active. Useful for
+# occupancy (which rooms are used when) and spotting sensors gone quiet.
+#
+# Every zone has fixed size arrays, so each open/close is a constant time
+# update however long envisalinkd has been running. Time open is counted
+# against the hour and day the zone was opened.
+#
+# On connecting envisalinkd asks the panel for it's zone timer dump (615),
+# which has how long ago each zone was last closed, seeding the time since
+# activity (and closing out zones that closed while we weren't connected).
+# Zones open in the dump are marked open without counting another open, so
+# restarting doesn't inflate the counts.
+#
+# Statistics are saved to `zone_stats` under `envisalinkd` (by default
+# .zonestats.json in the working directory) every `zone_stats_interval`
+# seconds, and loaded again on start.
+#
+
+import os
+import json
+import time
+import threading
+
+
+DEFAULT_PATH = '.zonestats.json'
+DEFAULT_INTERVAL = 300
+
+# Zones in the timer dump, each 4 hex digits.
+DUMP_ZONES = 64
+
+# Timer dump values are 16 bit little endian, counting down from FFFF every
+# 5 seconds since the zone was closed. FFFF means it's open now, 0000 that
+# the timer has run out (over 91 hours).
+TIMER_OPEN = 0xFFFF
+TIMER_TICK = 5
+
+
+class Zone:
+
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.opens          = saved.get('opens', 0)
+        self.dwell          = saved.get('dwell', 0)
+        self.opens_by_hour  = saved.get('opens_by_hour') or [0] * 24
+        self.dwell_by_hour  = saved.get('dwell_by_hour') or [0] * 24
+        self.opens_by_day   = saved.get('opens_by_day') or [0] * 7
+        self.dwell_by_day   = saved.get('dwell_by_day') or [0] * 7
+        self.last_activity  = saved.get('last_activity')
+        self.opened_at      = saved.get('opened_at')
+
+    def open(self, when):
+        if self.opened_at is not None:
+            return  # already open, eg repeated by a status dump
+        local = time.localtime(when)
+        self.opens += 1
+        self.opens_by_hour[local.tm_hour] += 1
+        self.opens_by_day[local.tm_wday] += 1
+        self.opened_at = when
+        self.last_activity = when
+
+    def seed_open(self, when):
+        # Open according to the timer dump. We don't know when it opened, it
+        # may well have been counted before a restart, so it's time open is
+        # counted from now but it isn't counted as another open.
+        if self.opened_at is None:
+            self.opened_at = when
+        self.last_activity = max(when, self.last_activity or 0)
+
+    def close(self, when):
+        if self.opened_at is not None:
+            dwell = max(0, when - self.opened_at)
+            local = time.localtime(self.opened_at)
+            self.dwell += dwell
+            self.dwell_by_hour[local.tm_hour] += dwell
+            self.dwell_by_day[local.tm_wday] += dwell
+            self.opened_at = None
+        self.last_activity = max(when, self.last_activity or 0)
+
+    def save(self):
+        return {
+            'opens':            self.opens,
+            'dwell':            self.dwell,
+            'opens_by_hour':    self.opens_by_hour,
+            'dwell_by_hour':    self.dwell_by_hour,
+            'opens_by_day':     self.opens_by_day,
+            'dwell_by_day':     self.dwell_by_day,
+            'last_activity':    self.last_activity,
+            'opened_at':        self.opened_at,
+            }
+
+
+class ZoneStats:
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.zones = {}
+        self.configured = None  # zones to take from the timer dump, None for all
+        self.dirty = False
+
+    def apply(self, event):
+        # Called with every event published.
+        code = event.get('code')
+        if code == '609' or code == '610':
+            zone = event.get('zone')
+            if zone is None:
+                return
+            self.lock.acquire()
+            try:
+                stats = self.zones.get(zone)
+                if stats is None:
+                    stats = self.zones[zone] = Zone()
+                if code == '609':
+                    stats.open(event['timestamp'])
+                else:
+                    stats.close(event['timestamp'])
+                self.dirty = True
+            finally:
+                self.lock.release()
+        elif code == '615':
+            self.seed(event['raw'][3:], event['timestamp'])
+
+    def seed(self, dump, now):
+        # From the zone timer dump.
+        self.lock.acquire()
+        try:
+            for index in range(min(DUMP_ZONES, len(dump) / 4)):
+                zone = '%03d' % (index + 1)
+                if self.configured is not None and zone not in self.configured:
+                    continue
+                try:
+                    timer = int(dump[index * 4 + 2:index * 4 + 4] + dump[index * 4:index * 4 + 2], 16)
+                except ValueError:
+                    continue
+
+                stats = self.zones.get(zone)
+                if stats is None:
+                    stats = self.zones[zone] = Zone()
+                if timer == TIMER_OPEN:
+                    stats.seed_open(now)
+                elif timer:
+                    stats.close(now - (TIMER_OPEN - timer) * TIMER_TICK)
+                elif stats.opened_at is not None:
+                    # Closed so long ago the timer ran out.
+                    stats.close(now)
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+    def snapshot(self, now=None):
+        now = now or time.time()
+        self.lock.acquire()
+        try:
+            snapshot = {}
+            for zone, stats in self.zones.items():
+                snapshot[zone] = stats.save()
+                snapshot[zone]['open'] = stats.opened_at is not None
+                snapshot[zone]['since_activity'] = None if stats.last_activity is None else max(0, int(now - stats.last_activity))
+            return snapshot
+        finally:
+            self.lock.release()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.lock.acquire()
+        try:
+            self.zones = dict((str(zone), Zone(stats)) for zone, stats in saved.get('zones', {}).items())
+        finally:
+            self.lock.release()
+        return True
+
+    def save(self):
+        # Written to a temporary file and renamed, so a crash mid-save never
+        # leaves a partial file.
+        self.lock.acquire()
+        try:
+            if not self.dirty:
+                return
+            data = json.dumps({'saved': int(time.time()), 'zones': dict((zone, stats.save()) for zone, stats in self.zones.items())})
+            self.dirty = False
+        finally:
+            self.lock.release()
+
+        temp = self.path + '.' + str(os.getpid())
+        try:
+            with open(temp, 'w') as f:
+                f.write(data)
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            self.dirty = True
+            raise